@@ -0,0 +1,520 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# Micro benchmarks for the lobby client hot paths.
+#
+#   python2 benchmark.py framedecoder [stream.bin ...]
+#   python2 benchmark.py userlist [--users N ...]
+#   python2 benchmark.py schemas [--count N]
+#   python2 benchmark.py replay capture.cap [--realtime] [--repeat N]
+#   python2 benchmark.py players [--users N] [--changes N]
+#   python2 benchmark.py pings [--count N]
+#   python2 benchmark.py geoip GeoLite2-City.mmdb [--ips N]
+#   python2 benchmark.py chat [--count N]
+#
+
+import argparse
+import cgi
+import os
+import random
+import re
+import struct
+import sys
+import time
+
+from ggpo.common.chatrenderer import ChatRenderer
+from ggpo.common.framedecoder import FrameDecoder
+from ggpo.common.pingpayload import PingPayload
+from ggpo.common.playerstate import PlayerStates
+from ggpo.common.playerstore import PlayerStore
+from ggpo.common.protocol import MessageSchema, Protocol
+
+RECV_SIZE = 16384
+
+
+def timeit(func, *args):
+    t0 = time.time()
+    result = func(*args)
+    return time.time() - t0, result
+
+
+def report(name, seconds, nbytes=0, count=0):
+    line = '{:<40} {:>9.3f} ms'.format(name, seconds * 1000)
+    if nbytes:
+        line += '  {:>8.1f} MB/s'.format(nbytes / seconds / 1048576 if seconds else 0)
+    if count:
+        line += '  {:>10.0f} /s'.format(count / seconds if seconds else 0)
+    print line
+
+
+def chunked(data, size=RECV_SIZE):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def frame(seq, payload):
+    return struct.pack('!II', len(payload) + 4, seq) + payload
+
+
+def syntheticStream(megabytes):
+    """ a mix of large LIST_USERS style replies and bursts of small out of band frames """
+    rnd = random.Random(42)
+    frames = []
+    size = 0
+    seq = 1
+    while size < megabytes * 1048576:
+        if rnd.random() < 0.01:
+            payload = ''.join(chr(rnd.randint(0, 255)) for _ in xrange(rnd.randint(50000, 200000)))
+            f = frame(seq, payload)
+            seq += 1
+        else:
+            f = frame(0xfffffffd, 'x' * rnd.randint(40, 120))
+        frames.append(f)
+        size += len(f)
+    return ''.join(frames)
+
+
+class LegacyTcpReader(object):
+    """ the string based reader the controller used before FrameDecoder """
+
+    (STATE_TCP_READ_LEN, STATE_TCP_READ_DATA) = range(2)
+
+    def __init__(self):
+        self.tcpData = ''
+        self.tcpReadState = self.STATE_TCP_READ_LEN
+        self.tcpResponseLen = 0
+        self.count = 0
+
+    def feed(self, data):
+        self.tcpData += data
+        self.handleTcpResponse()
+
+    def handleTcpResponse(self):
+        if self.tcpReadState == self.STATE_TCP_READ_LEN:
+            if len(self.tcpData) >= 4:
+                self.tcpResponseLen, = struct.unpack('!I', self.tcpData[:4])
+                self.tcpData = self.tcpData[4:]
+                self.tcpReadState = self.STATE_TCP_READ_DATA
+                self.handleTcpResponse()
+        elif self.tcpReadState == self.STATE_TCP_READ_DATA:
+            if len(self.tcpData) >= self.tcpResponseLen:
+                data = self.tcpData[:self.tcpResponseLen]
+                self.tcpData = self.tcpData[self.tcpResponseLen:]
+                self.tcpResponseLen = 0
+                self.tcpReadState = self.STATE_TCP_READ_LEN
+                if len(data) >= 4:
+                    self.count += 1
+                self.handleTcpResponse()
+
+
+def benchFrameDecoder(args):
+    streams = []
+    for fname in args.files:
+        streams.append((fname, open(fname, 'rb').read()))
+    if not streams:
+        streams.append(('synthetic {}MB'.format(args.megabytes), syntheticStream(args.megabytes)))
+
+    for name, data in streams:
+        chunks = chunked(data)
+        print '{}: {} bytes in {} chunks'.format(name, len(data), len(chunks))
+
+        def runDecoder():
+            decoder = FrameDecoder()
+            count = 0
+            for chunk in chunks:
+                count += len(decoder.feed(chunk))
+            return count
+
+        def runLegacy():
+            reader = LegacyTcpReader()
+            for chunk in chunks:
+                reader.feed(chunk)
+            return reader.count
+
+        seconds, count = timeit(runDecoder)
+        report('FrameDecoder', seconds, len(data), count)
+        try:
+            seconds, count = timeit(runLegacy)
+            report('legacy string reader', seconds, len(data), count)
+        except RuntimeError, ex:
+            print 'legacy string reader failed: {}'.format(ex)
+
+
+def syntheticUserList(users):
+    """ a LIST_USERS reply payload with the given number of user records """
+    rnd = random.Random(users)
+    tlv = Protocol.packTLV
+    pack = Protocol.packInt
+    records = [pack(0), pack(0)]
+    for i in xrange(users):
+        state = rnd.randint(0, 2)
+        records.append(''.join([
+            tlv('player{}'.format(i)), pack(state), tlv('player{}'.format(i + 1) if state == 2 else ''),
+            tlv('10.{}.{}.{}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)), pack(0), pack(0),
+            tlv('City'), tlv('US'), tlv('United States'), pack(6009), pack(0x1000000), pack(rnd.randint(0, 5))]))
+    return ''.join(records)
+
+
+def legacyParseUserList(data):
+    """ the slice and return parsing parseListUsersResponse used before PacketReader """
+    users = []
+    status, data = Protocol.extractInt(data)
+    status2, data = Protocol.extractInt(data)
+    while len(data) > 8:
+        p1, data = Protocol.extractTLV(data)
+        state, data = Protocol.extractInt(data)
+        p2, data = Protocol.extractTLV(data)
+        ip, data = Protocol.extractTLV(data)
+        unk1, data = Protocol.extractInt(data)
+        unk2, data = Protocol.extractInt(data)
+        city, data = Protocol.extractTLV(data)
+        cc, data = Protocol.extractTLV(data)
+        country, data = Protocol.extractTLV(data)
+        port, data = Protocol.extractInt(data)
+        color, data = Protocol.extractInt(data)
+        spectators, data = Protocol.extractInt(data)
+        users.append((p1, state, p2, ip, city, cc, country, port, color, spectators))
+    return users
+
+
+def readerParseUserList(data):
+    users = []
+    reader = Protocol.PacketReader(data)
+    status = reader.readInt()
+    status2 = reader.readInt()
+    while reader.remaining() > 8:
+        p1 = reader.readTLV()
+        state = reader.readInt()
+        p2 = reader.readTLV()
+        ip = reader.readTLV()
+        unk1 = reader.readInt()
+        unk2 = reader.readInt()
+        city = reader.readTLV()
+        cc = reader.readTLV()
+        country = reader.readTLV()
+        port = reader.readInt()
+        color = reader.readInt()
+        spectators = reader.readInt()
+        users.append((p1, state, p2, ip, city, cc, country, port, color, spectators))
+    return users
+
+
+def schemaParseUserList(data):
+    users = []
+    reader = Protocol.PacketReader(data)
+    status, status2 = Protocol.Schemas['LIST_USERS'].decode(reader)
+    decodeUser = Protocol.Schemas['USER'].decode
+    while reader.remaining() > 8:
+        p1, state, p2, ip, unk1, unk2, city, cc, country, port, color, spectators = decodeUser(reader)
+        users.append((p1, state, p2, ip, city, cc, country, port, color, spectators))
+    return users
+
+
+def benchUserList(args):
+    for users in args.users:
+        data = syntheticUserList(users)
+        print '{} users: {} bytes'.format(users, len(data))
+        seconds, parsed = timeit(schemaParseUserList, data)
+        report('USER schema', seconds, len(data), len(parsed))
+        seconds, parsed = timeit(readerParseUserList, data)
+        report('PacketReader', seconds, len(data), len(parsed))
+        seconds, legacy = timeit(legacyParseUserList, data)
+        report('extractTLV/extractInt slicing', seconds, len(data), len(legacy))
+        assert parsed == legacy
+
+
+def sampleValues(schema):
+    samples = {MessageSchema.INT: 7, MessageSchema.TLV: 'sample', MessageSchema.REST: '[1, 2, 3]'}
+    values = []
+    for kind, st, count in schema.steps:
+        values.extend([samples[kind]] * count)
+    return values
+
+
+def benchSchemas(args):
+    for name in sorted(Protocol.Schemas):
+        schema = Protocol.Schemas[name]
+        values = sampleValues(schema)
+        data = schema.encode(*values)
+        assert schema.decode(Protocol.PacketReader(data)) == values
+
+        def runDecode():
+            for _ in xrange(args.count):
+                schema.decode(Protocol.PacketReader(data))
+
+        def runEncode():
+            for _ in xrange(args.count):
+                schema.encode(*values)
+
+        seconds, _ = timeit(runDecode)
+        report('decode ' + name, seconds, len(data) * args.count, args.count)
+        seconds, _ = timeit(runEncode)
+        report('encode ' + name, seconds, len(data) * args.count, args.count)
+
+
+def benchReplay(args):
+    # the controller needs PyQt, set the same sip api as main.py before importing it
+    import sip
+    sip.setapi('QString', 2)
+    sip.setapi('QVariant', 2)
+    from ggpo.common.controller import Controller
+    from ggpo.common.wirecapture import replayCapture
+
+    # one offline controller for every repeat, so only the first pass pays for setting it up
+    controller = Controller(offline=True)
+    for i in xrange(args.repeat):
+        stats = replayCapture(controller, args.capture, args.realtime)
+        report('replay {} ({} records)'.format(args.capture, stats['records']),
+               stats['elapsed'], stats['tcpBytes'], stats['records'])
+    controller.stop()
+
+
+class LegacyPlayer:
+    """ the __dict__ based record the controller used before PlayerStore """
+
+    def __init__(self, **kwargs):
+        self.id = 0
+        self.player = ''
+        self.ip = ''
+        self.port = 6009
+        self.city = ''
+        self.cc = ''
+        self.country = ''
+        self.ping = ''
+        self.lastPingTime = 0
+        self.loc = ''
+        self.color = None
+        self.spectators = 0
+        vars(self).update(kwargs)
+
+
+def syntheticPlayers(users):
+    rnd = random.Random(users)
+    return [dict(player='player{}'.format(i), ip='10.{}.{}.{}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+                 port=6009, city='City', cc='us', country='United States', color=None,
+                 spectators=rnd.randint(1, 5)) for i in xrange(users)]
+
+
+def syntheticStateChanges(users, changes):
+    rnd = random.Random(changes)
+    states = [PlayerStates.AVAILABLE, PlayerStates.AFK, PlayerStates.PLAYING, PlayerStates.QUIT]
+    return [('player{}'.format(rnd.randrange(users)), rnd.choice(states), 'player{}'.format(rnd.randrange(users)))
+            for _ in xrange(changes)]
+
+
+def legacyApplyChanges(available, awayfromkb, playing, changes):
+    for name, state, p2 in changes:
+        if state == PlayerStates.AVAILABLE:
+            available[name] = True
+            awayfromkb.pop(name, None)
+            playing.pop(name, None)
+        elif state == PlayerStates.AFK:
+            awayfromkb[name] = True
+            available.pop(name, None)
+            playing.pop(name, None)
+        elif state == PlayerStates.PLAYING:
+            playing[name] = p2
+            available.pop(name, None)
+            awayfromkb.pop(name, None)
+        else:
+            available.pop(name, None)
+            awayfromkb.pop(name, None)
+            playing.pop(name, None)
+
+
+def storeApplyChanges(store, changes):
+    setState = store.setState
+    for name, state, p2 in changes:
+        setState(name, state, p2)
+
+
+def benchPlayers(args):
+    for users in args.users:
+        infos = syntheticPlayers(users)
+        changes = syntheticStateChanges(users, args.changes)
+        print '{} players, {} state changes'.format(users, len(changes))
+
+        legacy = [LegacyPlayer(**info) for info in infos]
+        store = PlayerStore()
+        for info in infos:
+            store.add(**info)
+            store.setState(info['player'], PlayerStates.AVAILABLE)
+        legacySize = sum(sys.getsizeof(p) + sys.getsizeof(vars(p)) for p in legacy) / float(users)
+        storeSize = sum(sys.getsizeof(p) for p in store.players.itervalues()) / float(users)
+        print '{:<40} {:>9.0f} bytes'.format('LegacyPlayer record + __dict__', legacySize)
+        print '{:<40} {:>9.0f} bytes'.format('slotted Player record', storeSize)
+
+        available = dict((info['player'], True) for info in infos)
+        seconds, _ = timeit(legacyApplyChanges, available, {}, {}, changes)
+        report('three dicts pop/push', seconds, count=len(changes))
+        seconds, _ = timeit(storeApplyChanges, store, changes)
+        report('PlayerStore.setState', seconds, count=len(changes))
+
+
+def legacyPings(count):
+    pinglist = {}
+    for i in xrange(count):
+        secret = str(random.randint(500000, 30000000)) + " " + str(random.randint(4000000, 900000000))
+        pinglist[secret] = ('10.0.0.1', 'player{}'.format(i), time.time())
+    size = sys.getsizeof(pinglist) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in pinglist.iteritems())
+    for secret in pinglist.keys():
+        dgram = "GGPO PONG {}".format(secret)
+        secret = dgram[10:]
+        if secret in pinglist:
+            ip, name, t1 = pinglist[secret]
+            int((time.time() - t1) * 1000)
+            del pinglist[secret]
+    return size
+
+
+def payloadPings(count):
+    payload = PingPayload()
+    pack, unpack = payload.pack, payload.unpack
+    dgrams = ["GGPO PONG " + pack('10.0.0.1', i) for i in xrange(count)]
+    for dgram in dgrams:
+        unpack(dgram[10:], '10.0.0.1')
+    return 0
+
+
+def benchPings(args):
+    seconds, size = timeit(legacyPings, args.count)
+    report('text secret + pinglist', seconds, count=args.count)
+    print '{:<40} {:>9.0f} bytes'.format('pinglist state per probe', size / float(args.count))
+    seconds, _ = timeit(payloadPings, args.count)
+    report('PingPayload pack + verify', seconds, count=args.count)
+    print '{:<40} {:>9.0f} bytes'.format('payload state per probe', 0)
+
+
+def syntheticAddresses(count):
+    # lobbies cluster on a few hundred ISP ranges
+    rnd = random.Random(count)
+    ranges = [(rnd.randint(1, 223), rnd.randint(0, 255)) for _ in xrange(300)]
+    return ['{}.{}.{}.{}'.format(a, b, rnd.randint(0, 255), rnd.randint(1, 254))
+            for a, b in (rnd.choice(ranges) for _ in xrange(count))]
+
+
+def benchGeoip(args):
+    # geolookup reads Settings, which needs PyQt, set the same sip api as main.py before importing it
+    import sip
+    sip.setapi('QString', 2)
+    sip.setapi('QVariant', 2)
+    from ggpo.common import geolookup
+    from ggpo.common.runtime import GeoIP2Reader, MaxMindOpenDatabase
+    if not MaxMindOpenDatabase:
+        print 'maxminddb is not installed'
+        return
+    if not os.path.isfile(args.db):
+        print 'cannot find {}'.format(args.db)
+        return
+    ips = syntheticAddresses(args.ips)
+    if GeoIP2Reader:
+        # the lookup geolookup() did before the prefix cache
+        reader = GeoIP2Reader(args.db)
+
+        def cityLookups():
+            for ip in ips:
+                # noinspection PyBroadException
+                try:
+                    reader.city(ip)
+                except:
+                    pass
+
+        seconds, _ = timeit(cityLookups)
+        report('Reader.city() per address', seconds, count=len(ips))
+    geolookup.geolookupInit(args.db)
+    seconds, _ = timeit(map, geolookup.geolookup, ips)
+    report('geolookup cold', seconds, count=len(ips))
+    seconds, _ = timeit(map, geolookup.geolookup, ips)
+    report('geolookup warm', seconds, count=len(ips))
+    print '{:<40} {:>9}'.format('cached networks', sum(len(c) for c in geolookup._prefixCache.itervalues()))
+
+
+def syntheticChat(count):
+    rnd = random.Random(count)
+    words = 'gg nice one who wants to play sf3 anyone 3s ranked lag fix your connection lol'.split()
+    extras = ['https://www.youtube.com/watch?v=abc123&t=42', 'challenge-1234-1393539605.46@sfiii3n',
+              'Tester', 'tester:', '<3', 'R&D']
+    messages = []
+    for _ in xrange(count):
+        line = [rnd.choice(words) for _ in xrange(rnd.randint(3, 15))]
+        if rnd.random() < 0.2:
+            line.insert(rnd.randrange(len(line)), rnd.choice(extras))
+        messages.append(u' '.join(line))
+    return messages
+
+
+def legacyRenderChat(messages, username):
+    # GGPOWindow.onChatReceived before the single pass renderer, util helpers inlined
+    for txt in messages:
+        if (username+" ".lower() in txt.lower() or " "+username.lower() in txt.lower() or
+                txt.lower() == username.lower()):
+            txt = cgi.escape(txt.strip()).replace(username, "<b>{}</b>".format(username))
+        else:
+            txt = cgi.escape(txt.strip())
+        urls = re.findall(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', txt)
+        if urls:
+            txt = re.sub(r'(https?:\/\/\S+)', r'<a href="\1"><font color=green>\1</font></a>', txt)
+        re.sub(r'(challenge\-[0-9]{4}\-[0-9]{10,11}[.][0-9]{2}(\@[a-z0-9_]+)?)',
+               r'<a href="replay:\1"><font color=green>\1</font></a>', txt)
+
+
+def rendererRenderChat(messages, username):
+    render = ChatRenderer(username).render
+    for txt in messages:
+        render(txt.strip())
+
+
+def benchChat(args):
+    messages = syntheticChat(args.count)
+    seconds, _ = timeit(legacyRenderChat, messages, 'Tester')
+    report('escape + mention scans + 3 regex passes', seconds, count=len(messages))
+    seconds, _ = timeit(rendererRenderChat, messages, 'Tester')
+    report('ChatRenderer single pass', seconds, count=len(messages))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='lobby client micro benchmarks')
+    sub = parser.add_subparsers()
+
+    p = sub.add_parser('framedecoder', help='TCP stream frame decoding')
+    p.add_argument('files', nargs='*', help='raw TCP stream dumps to replay')
+    p.add_argument('--megabytes', type=int, default=8, help='size of the synthetic stream')
+    p.set_defaults(func=benchFrameDecoder)
+
+    p = sub.add_parser('userlist', help='LIST_USERS reply parsing')
+    p.add_argument('--users', type=int, nargs='+', default=[2000, 10000], help='lobby sizes to parse')
+    p.set_defaults(func=benchUserList)
+
+    p = sub.add_parser('schemas', help='encode/decode of every registered message schema')
+    p.add_argument('--count', type=int, default=100000, help='messages per schema')
+    p.set_defaults(func=benchSchemas)
+
+    p = sub.add_parser('players', help='player record memory and state change cost')
+    p.add_argument('--users', type=int, nargs='+', default=[1000, 5000], help='lobby sizes')
+    p.add_argument('--changes', type=int, default=200000, help='state changes to apply')
+    p.set_defaults(func=benchPlayers)
+
+    p = sub.add_parser('pings', help='ping secret bookkeeping against the self describing payload')
+    p.add_argument('--count', type=int, default=200000, help='pings to send and answer')
+    p.set_defaults(func=benchPings)
+
+    p = sub.add_parser('geoip', help='GeoIP lookups with and without the network prefix cache')
+    p.add_argument('db', help='GeoLite2 City or Country mmdb file')
+    p.add_argument('--ips', type=int, default=5000, help='addresses to look up')
+    p.set_defaults(func=benchGeoip)
+
+    p = sub.add_parser('chat', help='chat message to html rendering')
+    p.add_argument('--count', type=int, default=100000, help='messages to render')
+    p.set_defaults(func=benchChat)
+
+    p = sub.add_parser('replay', help='push a wire capture through the controller')
+    p.add_argument('capture', help='capture recorded with the wireCapture setting')
+    p.add_argument('--realtime', action='store_true', help='keep the recorded pacing')
+    p.add_argument('--repeat', type=int, default=3, help='number of replays')
+    p.set_defaults(func=benchReplay)
+
+    args = parser.parse_args(argv[1:])
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import cgi
+import re
+
+URL_PATTERN = r'https?://\S+'
+REPLAY_PATTERN = r'challenge-[0-9]{4}-[0-9]{10,11}[.][0-9]{2}(?:@[a-z0-9_]+)?'
+
+
+class ChatRenderer(object):
+    """
+    Turns a chat message into the HTML shown in the chat history.
+
+    Links, replay ids and mentions of the local user are found by one
+    regular expression, compiled when the username changes, in a single
+    scan of the raw text; the text between them is escaped as it is copied
+    to the output.  A lookahead on the possible first characters lets the
+    scan skip most positions without trying every alternative.
+    """
+
+    def __init__(self, username=''):
+        self.username = None
+        self.pattern = None
+        self.setUsername(username)
+
+    def render(self, text):
+        """
+        @return: (html, True if the local user is mentioned)
+        """
+        out = []
+        pos = 0
+        mentioned = False
+        for match in self.pattern.finditer(text):
+            start = match.start()
+            if start > pos:
+                out.append(cgi.escape(text[pos:start]))
+            kind = match.lastgroup
+            token = cgi.escape(match.group(), True)
+            if kind == 'mention':
+                mentioned = True
+                out.append('<b>{}</b>'.format(token))
+            elif kind == 'url':
+                out.append('<a href="{0}"><font color=green>{0}</font></a>'.format(token))
+            else:
+                out.append('<a href="replay:{0}"><font color=green>{0}</font></a>'.format(token))
+            pos = match.end()
+        if pos < len(text):
+            out.append(cgi.escape(text[pos:]))
+        return ''.join(out), mentioned
+
+    def setUsername(self, username):
+        if username == self.username:
+            return
+        self.username = username
+        alternatives = ['(?P<url>{})'.format(URL_PATTERN), '(?P<replay>{})'.format(REPLAY_PATTERN)]
+        firsts = set('hc')
+        if username:
+            # case insensitive for the name only, python 2 has no scoped (?i:) groups
+            name = ''.join('[{}{}]'.format(re.escape(c.lower()), re.escape(c.upper())) if c.lower() != c.upper()
+                           else re.escape(c) for c in username)
+            alternatives.append(r'(?P<mention>(?<!\w){}(?!\w))'.format(name))
+            firsts.update([username[0].lower(), username[0].upper()])
+        lookahead = '(?=[{}])'.format(''.join(re.escape(c) for c in sorted(firsts)))
+        self.pattern = re.compile('{}(?:{})'.format(lookahead, '|'.join(alternatives)), re.UNICODE)
@@ -22,6 +22,8 @@ class CLI:
         ("/ignore", [REQUIRED_ARG, "ignore a player"]),
         ("/unignore", [REQUIRED_ARG, "unignore a player"]),
         ("/motd", [NO_ARG, "clear screen and show message of the day"]),
+        ("/stats", [NO_ARG, "show server response times"]),
+        ("/search", [REQUIRED_ARG, "search the chat and play history log"]),
         ("/help", [NO_ARG, "display help menu"])
     ])
 
@@ -107,6 +109,13 @@ class CLI:
         def climotd():
             controller.sendMOTDRequest()
 
+        def clisearch(text):
+            controller.searchUserLog(text)
+
+        def clistats():
+            for line in controller.requestStats():
+                controller.sigStatusMessage.emit(line)
+
         def cliunignore(name):
             if name in controller.ignored:
                 controller.removeIgnore(name)
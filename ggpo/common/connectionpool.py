@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import errno
+import socket
+import struct
+import threading
+import time
+from Queue import Queue, Empty
+from ggpo.common.framedecoder import FrameDecoder
+from ggpo.common.protocol import Protocol
+from ggpo.common.util import logdebug
+
+
+class PooledConnection(object):
+    __slots__ = ('sock', 'port', 'sequence', 'decoder', 'created')
+
+    def __init__(self, sock, port, sequence, decoder):
+        self.sock = sock
+        self.port = port
+        self.sequence = sequence
+        self.decoder = decoder
+        self.created = time.time()
+
+
+class ConnectionPool(object):
+    """
+    Lobby connections opened ahead of time for other channel ports.
+
+    Switching to a channel served on another port means a new connection plus
+    WELCOME and AUTH round trips.  The pool connects and sends WELCOME ahead
+    of time on a background thread for the ports of favourite channels, so
+    the switch only has to take() the socket and send AUTH and JOIN_CHANNEL
+    on it.  AUTH is never sent from the pool: the server closes clone
+    sessions of a logged in account, so the pooled socket must only log in
+    once the old session is gone.  Connections older than MAX_IDLE seconds
+    are closed by the pool thread, checked every EXPIRE_INTERVAL seconds.
+    """
+
+    MAX_CONNECTIONS = 2
+    MAX_IDLE = 300
+    EXPIRE_INTERVAL = 30
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, host, welcome):
+        """
+        @param welcome: WELCOME request body
+        """
+        self.host = host
+        self.welcome = welcome
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.pending = set()
+        self.requests = Queue()
+        # bumped by close(), connections opened for an earlier generation are shut
+        self.generation = 0
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        with self.lock:
+            self.generation += 1
+            self.pending.clear()
+            connections = self.connections.values()
+            self.connections.clear()
+        for conn in connections:
+            self._close(conn.sock)
+
+    def take(self, port):
+        """
+        @return: a welcomed PooledConnection for port, or None, AUTH goes next with conn.sequence
+        """
+        with self.lock:
+            conn = self.connections.pop(port, None)
+        if conn and (time.time() - conn.created > self.MAX_IDLE or not self._alive(conn.sock)):
+            self._close(conn.sock)
+            conn = None
+        if conn:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return conn
+
+    def warm(self, ports):
+        """ open connections for the given ports in the background, most wanted first """
+        with self.lock:
+            for port in ports:
+                if len(self.connections) + len(self.pending) >= self.MAX_CONNECTIONS:
+                    break
+                if port in self.connections or port in self.pending:
+                    continue
+                self.pending.add(port)
+                self.requests.put((port, self.generation))
+            if self.pending and not self.thread:
+                self.thread = threading.Thread(target=self._run, name='ConnectionPool')
+                self.thread.daemon = True
+                self.thread.start()
+
+    @staticmethod
+    def _alive(sock):
+        # a closed connection reads as EOF, an idle one would block
+        # noinspection PyBroadException
+        try:
+            sock.setblocking(0)
+            return sock.recv(1, socket.MSG_PEEK) != ''
+        except socket.error, ex:
+            return ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+        except:
+            return False
+
+    @staticmethod
+    def _close(sock):
+        # noinspection PyBroadException
+        try:
+            sock.close()
+        except:
+            pass
+
+    @staticmethod
+    def _frame(seq, command, data):
+        return struct.pack('!III', len(data) + 8, seq, command) + data
+
+    def _open(self, port):
+        sock = socket.create_connection((self.host, port), self.CONNECT_TIMEOUT)
+        try:
+            # any answer stays in the socket buffer for the controller, which remembers WELCOME as seq 1
+            sock.sendall(self._frame(1, Protocol.WELCOME, self.welcome))
+            return PooledConnection(sock, port, 2, FrameDecoder())
+        except:
+            self._close(sock)
+            raise
+
+    def _expire(self):
+        oldest = time.time() - self.MAX_IDLE
+        with self.lock:
+            expired = [conn for conn in self.connections.itervalues() if conn.created < oldest]
+            for conn in expired:
+                del self.connections[conn.port]
+        for conn in expired:
+            logdebug().info("Closing idle pooled connection for port {}".format(conn.port))
+            self._close(conn.sock)
+
+    def _run(self):
+        while True:
+            try:
+                port, generation = self.requests.get(timeout=self.EXPIRE_INTERVAL)
+            except Empty:
+                port = None
+            self._expire()
+            if port is None:
+                continue
+            with self.lock:
+                if generation != self.generation:
+                    continue
+            conn = None
+            try:
+                conn = self._open(port)
+                logdebug().info("Pooled connection ready for port {}".format(port))
+            except (socket.error, socket.timeout, struct.error), ex:
+                logdebug().error("Cannot pool connection for port {}: {}".format(port, ex))
+            with self.lock:
+                if generation != self.generation:
+                    # the pool was closed while this one was connecting
+                    if conn:
+                        self._close(conn.sock)
+                    continue
+                self.pending.discard(port)
+                if conn:
+                    old = self.connections.get(port)
+                    self.connections[port] = conn
+                    if old:
+                        self._close(old.sock)
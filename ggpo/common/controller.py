@@ -11,18 +11,30 @@ import errno
 import fileinput
 import threading
 import calendar
+from contextlib import contextmanager
 from shutil import copyfile
 from random import randint
 from subprocess import Popen
 from PyQt4 import QtCore, QtGui
 from ggpo.common.runtime import *
-from ggpo.common.geolookup import geolookup, isUnknownCountryCode
-from ggpo.common.player import Player
+from ggpo.common.connectionpool import ConnectionPool
+from ggpo.common.eventloop import EventLoop, EVENT_READ, EVENT_WRITE
+from ggpo.common.framedecoder import FrameDecoder
+from ggpo.common.geolookup import GeoResolver, isUnknownCountryCode
+from ggpo.common.latencycache import LatencyCache
+from ggpo.common.pingpayload import PingPayload
+from ggpo.common.pingscheduler import PingScheduler
 from ggpo.common.playerstate import PlayerStates
+from ggpo.common.playerstore import PlayerStore
 from ggpo.common.protocol import Protocol
+from ggpo.common.requesttracker import RequestTracker
+from ggpo.common.rttstats import RttStats
 from ggpo.common.settings import Settings
 from ggpo.common.unsupportedsavestates import readLocalJsonDigest
-from ggpo.common.util import findFba, logdebug, loguser, packagePathJoin, findGamesavesDir, sha256digest
+from ggpo.common.userlog import UserLog, CHAT, GAME
+from ggpo.common.util import findFba, logdebug, packagePathJoin, findGamesavesDir, sha256digest
+from ggpo.common.wirecapture import WireRecorder, TCP_IN, TCP_OUT, TCP_OPEN, UDP_IN, UDP_OUT
+from ggpo.common.writequeue import WriteQueue
 from ggpo.gui.colortheme import ColorTheme
 from ggpo.common import copyright
 from ggpo.common.extensions.extension import Extension
@@ -43,12 +55,23 @@ class Controller(QtCore.QObject):
     sigMotdReceived = QtCore.pyqtSignal(str, str, str)
     sigNewVersionAvailable = QtCore.pyqtSignal(str, str)
     sigPlayerNewlyJoined = QtCore.pyqtSignal(str)
+    sigPlayerPingChanged = QtCore.pyqtSignal(str)
     sigPlayerStateChange = QtCore.pyqtSignal(str, int)
+    sigPlayerStatesChanged = QtCore.pyqtSignal(list)
+    sigPlayersGeoResolved = QtCore.pyqtSignal(list)
     sigPlayersLoaded = QtCore.pyqtSignal()
+    sigRequestTimedOut = QtCore.pyqtSignal(int, int)
     sigServerDisconnected = QtCore.pyqtSignal()
     sigStatusMessage = QtCore.pyqtSignal(str)
 
-    (STATE_TCP_READ_LEN, STATE_TCP_READ_DATA) = range(2)
+    DEFAULT_SERVER_HOST = 'ggpo-ng.com'
+    WELCOME_PAYLOAD = '\x00\x00\x00\x00\x00\x00\x00\x1d\x00\x00\x00\x01'
+    DEFAULT_REQUEST_TIMEOUT = 30
+    REQUEST_EXPIRE_INTERVAL = 5
+    PING_TICK = 0.25
+    KEEPALIVE_IDLE = 60
+    KEEPALIVE_INTERVAL = 15
+    LATENCY_STATS_COMMANDS = (Protocol.AUTH, Protocol.LIST_USERS, Protocol.JOIN_CHANNEL, Protocol.SEND_CHALLENGE)
 
     def __del__(self):
         # noinspection PyBroadException
@@ -58,20 +81,37 @@ class Controller(QtCore.QObject):
         except:
             pass
 
-    def __init__(self):
+    def __init__(self, offline=False):
+        """
+        @param offline: for replaying captures, never open connections, start the emulator
+        or write the user log and latency cache
+        """
         super(Controller, self).__init__()
-        self.selectTimeout = 1
+        self.offline = offline
+        self.loop = EventLoop()
         self.sequence = 0x1
         self.tcpSock = None
         self.tcpConnected = False
-        self.tcpData = ''
-        self.tcpReadState = self.STATE_TCP_READ_LEN
-        self.tcpResponseLen = 0
-        self.tcpCommandsWaitingForResponse = dict()
+        self.tcpDecoder = FrameDecoder()
+        self.tcpQueue = WriteQueue()
+        self.tcpFlushScheduled = False
+        self.tcpWatchingWrites = False
+        try:
+            timeout = int(Settings.value(Settings.REQUEST_TIMEOUT))
+        except (TypeError, ValueError):
+            timeout = self.DEFAULT_REQUEST_TIMEOUT
+        self.pendingRequests = RequestTracker(timeout)
+        self.loop.callEvery(self.REQUEST_EXPIRE_INTERVAL, self.expireRequests)
+        self.pingTimer = None
         self.udpSock = None
         self.udpConnected = False
-        self.selectLoopRunning = True
         self.switchingServer = False
+        self.serverHost = Settings.value(Settings.SERVER_HOST) or self.DEFAULT_SERVER_HOST
+        self.statsProviders = []
+        self.wireRecorder = None
+        if Settings.value(Settings.WIRE_CAPTURE) and not offline:
+            self.startWireCapture()
+        self.connectionPool = ConnectionPool(self.serverHost, self.WELCOME_PAYLOAD)
 
         self.username = ''
         self.password = ''
@@ -88,19 +128,31 @@ class Controller(QtCore.QObject):
         self.challengers = set()
         self.challenged = None
         self.channels = {}
-        self.pinglist = {}
-        self.players = {}
-        self.available = {}
-        self.playing = {}
-        self.awayfromkb = {}
+        self.playerStore = PlayerStore()
+        self.pingScheduler = PingScheduler(self.pingPlayer, lambda name: name in self.playerStore.byState[
+            PlayerStates.AVAILABLE], self.updatePlayerPingLost)
+        self.pingPayload = None if Settings.value(Settings.TEXT_PING) else PingPayload()
+        # addresses that never answered a binary ping, they get the old text secret
+        self.textPingPeers = set()
+        self.latencyCache = LatencyCache(os.path.join(os.path.abspath(os.path.expanduser("~")),
+                                                      'fightcade-latency.cache'))
+        if not offline:
+            self.latencyCache.load()
+        self.userLog = UserLog(os.path.join(os.path.abspath(os.path.expanduser("~")), 'fightcade-log.sqlite'))
+        self.geoResolver = GeoResolver(lambda results: self.loop.callSoon(self.applyGeoResults, results))
+        self.statsProviders.append(self.pingScheduler.stats)
         self.ignored = Settings.pythonValue(Settings.IGNORED) or set()
+        self.disableAutoColorNicks = bool(Settings.value(Settings.DISABLE_AUTOCOLOR_NICKS))
+        # (name, useFlag) -> chat prefix html, built for prefixTheme
+        self.prefixCache = {}
+        self.prefixTheme = ColorTheme.SELECTED
         self.sigStatusMessage.connect(logdebug().info)
 
         tmp = calendar.timegm(time.localtime()) - calendar.timegm(time.gmtime())
         self.utcoffset = tmp if tmp > 0 else 24*60*60 - tmp  # packInt can't do negative numbers.
         self.os = 1 if IS_WINDOWS else (2 if IS_LINUX else (3 if IS_OSX else 0))
 
-        self.sendLock = threading.Lock()  # Protect self.sequence/self.tcpCommandsWaitingForResponse in sync if extensions
+        self.sendLock = threading.Lock()  # Protect self.sequence/self.pendingRequests in sync if extensions
                                           # send messages from different threads.
 
     def addIgnore(self, name):
@@ -109,22 +161,59 @@ class Controller(QtCore.QObject):
             self.saveIgnored()
             self.sigIgnoreAdded.emit(name)
 
+    @property
+    def available(self):
+        return self.playerStore.byState[PlayerStates.AVAILABLE]
+
+    @property
+    def awayfromkb(self):
+        return self.playerStore.byState[PlayerStates.AFK]
+
+    @property
+    def playing(self):
+        return self.playerStore.byState[PlayerStates.PLAYING]
+
+    @property
+    def players(self):
+        return self.playerStore.players
+
     def addUser(self, **kwargs):
         if 'player' in kwargs:
             name = kwargs['player']
-            if name not in self.available and name not in self.awayfromkb and name not in self.playing:
+            if not self.playerStore.isPresent(name):
                 self.sigPlayerNewlyJoined.emit(name)
-            if name in self.players:
-                p = self.players[name]
-                for k, v in kwargs.items():
-                    if (v and not (k == 'cc' and isUnknownCountryCode(v))) or (k == 'color'):
-                        setattr(p, k, v)
+            p = self.playerStore.get(name)
+            if p:
+                changes = dict((k, v) for k, v in kwargs.items()
+                               if (v and not (k == 'cc' and isUnknownCountryCode(v))) or (k == 'color'))
+                if 'cc' in changes and changes['cc'] != p.cc:
+                    self.invalidatePlayerPrefix(name)
+                self.playerStore.update(p, **changes)
             else:
-                p = Player(**kwargs)
-                self.players[name] = p
-                self.sendPingQuery(p)
+                p = self.playerStore.add(**kwargs)
+                self.invalidatePlayerPrefix(name)
                 if isUnknownCountryCode(p.cc):
-                    p.cc, p.country, p.city = geolookup(p.ip)
+                    location = self.geoResolver.cached(p.ip)
+                    if location:
+                        p.cc, p.country, p.city = location
+                    else:
+                        self.geoResolver.resolve(p.ip)
+                # shown as stale until the first ping of this session is answered
+                estimate = self.latencyCache.estimate(p.ip)
+                if estimate:
+                    p.ping = estimate[0]
+            self.pingScheduler.add(name)
+
+    def applyGeoResults(self, results):
+        names = []
+        for ip, (cc, country, city) in results:
+            for p in self.playerStore.playersAt(ip):
+                if isUnknownCountryCode(p.cc):
+                    p.cc, p.country, p.city = cc, country, city
+                    self.invalidatePlayerPrefix(p.player)
+                    names.append(p.player)
+        if names:
+            self.sigPlayersGeoResolved.emit(names)
 
     def checkInstallation(self):
         fba = findFba()
@@ -136,6 +225,10 @@ class Controller(QtCore.QObject):
             self.sigStatusMessage.emit("ERROR: ggpofba-ng.exe not found in fightcade folder: you will not be able to play or spectate! Did you extract FightCade from the zip before running it?")
             return False
 
+    def invalidatePlayerPrefix(self, name):
+        self.prefixCache.pop((name, True), None)
+        self.prefixCache.pop((name, False), None)
+
     def isRomAvailable(self, channel):
         if channel=='lobby':
             # always true for lobby
@@ -180,19 +273,63 @@ class Controller(QtCore.QObject):
                             self.unsupportedRom = os.path.splitext(k)[0]
                             break
 
+    def adoptConnection(self, conn):
+        # take over a welcomed socket from the connection pool, the caller logs in on it
+        self.closeTcp()
+        self.tcpQueue.clear()
+        self.pendingRequests.clear()
+        self.tcpDecoder = conn.decoder
+        self.tcpSock = conn.sock
+        self.pendingRequests.add(conn.sequence - 1, Protocol.WELCOME)
+        self.sequence = conn.sequence
+        self.attachTcp()
+
+    def attachTcp(self):
+        if self.wireRecorder:
+            try:
+                peer = self.tcpSock.getpeername()
+            except socket.error:
+                peer = ('0.0.0.0', int(self.channelport))
+            self.wireRecorder.record(TCP_OPEN, '', peer)
+        self.tcpSock.setblocking(0)
+        self.setKeepalive(self.tcpSock)
+        self.tcpWatchingWrites = False
+        self.loop.register(self.tcpSock, EVENT_READ, self.onTcpEvent)
+        self.tcpConnected = True
+
+    def authPayload(self, username, password):
+        try:
+            port = self.udpSock.getsockname()[1]
+        except:
+            port=6009
+            #raise
+
+        # piggyback the OS and timezone onto the login request since there doesn't seem to be another convenient place to send it.
+        # There's a string conversion error here if packInt returns any non-ascii bytes.
+        # Send utcoffset as a string for now.
+        return Protocol.encode('AUTH', username, password, port, copyright.versionNum(), self.os, str(self.utcoffset))
+
+    def closeTcp(self):
+        if self.tcpSock:
+            self.loop.unregister(self.tcpSock)
+            self.tcpSock.close()
+        self.tcpConnected = False
+
     def connectTcp(self):
         self.tcpConnected = False
         #noinspection PyBroadException
         try:
-            if self.tcpSock:
-                self.tcpSock.close()
+            self.closeTcp()
+            self.tcpDecoder.reset()
+            self.tcpQueue.clear()
+            self.pendingRequests.clear()
             self.tcpSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.channelport = Settings.value(Settings.PORT)
             if self.channelport==None:
                 self.channelport = 7000
                 Settings.setValue(Settings.PORT, int(self.channelport))
-            self.tcpSock.connect(('ggpo-ng.com', int(self.channelport),))
-            self.tcpConnected = True
+            self.tcpSock.connect((self.serverHost, int(self.channelport),))
+            self.attachTcp()
         except Exception:
             self.sigStatusMessage.emit("Cannot connect to FightCade server")
             self.sigServerDisconnected.emit()
@@ -202,9 +339,11 @@ class Controller(QtCore.QObject):
         self.udpConnected = False
         try:
             if self.udpSock:
+                self.loop.unregister(self.udpSock)
                 self.udpSock.close()
             self.udpSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             self.udpSock.bind(('0.0.0.0', port,))
+            self.loop.register(self.udpSock, EVENT_READ, self.onUdpEvent)
             self.udpConnected = True
         except socket.error:
             self.sigStatusMessage.emit("Cannot bind to port udp/{}".format(str(port)))
@@ -234,12 +373,12 @@ class Controller(QtCore.QObject):
             self.dispatchInbandData(seq, data)
 
     def dispatchInbandData(self, seq, data):
-        if not seq in self.tcpCommandsWaitingForResponse:
+        request = self.pendingRequests.pop(seq)
+        if request is None:
             logdebug().error("Sequence {} data {} not matched".format(seq, data))
             return
 
-        origRequest = self.tcpCommandsWaitingForResponse[seq]
-        del self.tcpCommandsWaitingForResponse[seq]
+        origRequest = request.command
 
         if origRequest == Protocol.AUTH:
             self.parseAuthResponse(data)
@@ -250,14 +389,14 @@ class Controller(QtCore.QObject):
         elif origRequest == Protocol.LIST_USERS:
             self.parseListUsersResponse(data)
         elif origRequest == Protocol.SPECTATE:
-            status, data = Protocol.extractInt(data)
+            status, = Protocol.decode('STATUS', data)
             if status != 0:
                 self.sigStatusMessage.emit("Fail to spectate " + str(status))
         elif origRequest in [Protocol.WELCOME, Protocol.JOIN_CHANNEL, Protocol.TOGGLE_AFK,
                              Protocol.SEND_CHALLENGE, Protocol.CHAT, Protocol.ACCEPT_CHALLENGE,
                              Protocol.DECLINE_CHALLENGE, Protocol.CANCEL_CHALLENGE, Protocol.EXTENSION_OUTBOUND]:
             if len(data) == 4:
-                status, data = Protocol.extractInt(data)
+                status, = Protocol.decode('STATUS', data)
                 if status != 0:
                     codestr = Protocol.codeToString(origRequest)
                     logdebug().error("{} failed, data {}".format(codestr, repr(data)))
@@ -274,33 +413,31 @@ class Controller(QtCore.QObject):
             logdebug().error("Not handling {} response; seq {}; data {}".format(
                 Protocol.codeToString(origRequest), seq, repr(data)))
 
+        if request.callback:
+            request.callback(data)
+
+    def expireRequests(self):
+        for request in self.pendingRequests.expire():
+            logdebug().error("{} seq {} timed out after {}s".format(
+                Protocol.codeToString(request.command), request.seq, self.pendingRequests.timeout))
+            self.sigRequestTimedOut.emit(request.seq, request.command)
+
     @staticmethod
-    def extractStateChangesResponse(data):
-        if len(data) >= 4:
-            code, data = Protocol.extractInt(data)
-            p1, data = Protocol.extractTLV(data)
+    def extractStateChangesResponse(reader):
+        if reader.remaining() >= 4:
+            code, p1 = Protocol.Schemas['STATE_CHANGE_HEADER'].decode(reader)
             if code == 0:
                 p2 = ''
-                return PlayerStates.QUIT, p1, p2, None, data
+                return PlayerStates.QUIT, p1, p2, None
             elif code != 1:
                 logdebug().error("Unknown player state change code {}".format(code))
-            state, data = Protocol.extractInt(data)
-            p2, data = Protocol.extractTLV(data)
+            # unknown1 \xff\xff\xff\x9f, unknown2 \x00\x00\x00&, marker \x00\x00\x17y
+            state, p2, ip, unknown1, unknown2, city, cc, country, marker, color = \
+                Protocol.Schemas['STATE_CHANGE'].decode(reader)
             if not p2:
                 p2 = "null"
-            ip, data = Protocol.extractTLV(data)
-            # \xff\xff\xff\x9f
-            # \x00\x00\x00&
-            unknown1, data = Protocol.extractInt(data)
-            unknown2, data = Protocol.extractInt(data)
-            city, data = Protocol.extractTLV(data)
-            cc, data = Protocol.extractTLV(data)
             if cc:
                 cc = cc.lower()
-            country, data = Protocol.extractTLV(data)
-            # \x00\x00\x17y
-            marker, data = Protocol.extractInt(data)
-            color, data = Protocol.extractInt(data)
             color = None if color >= 0x1000000 else QtGui.QColor((color & 0xFF0000) >> 16, (color & 0xFF00) >> 8, color & 0xFF)
             playerinfo = dict(
                 player=p1,
@@ -311,7 +448,7 @@ class Controller(QtCore.QObject):
                 color=color,
                 spectators=0,
             )
-            return state, p1, p2, playerinfo, data
+            return state, p1, p2, playerinfo
 
     def getPlayerChallengerText(self, name):
         extrainfo = []
@@ -338,7 +475,7 @@ class Controller(QtCore.QObject):
         if name == self.username:
             return '#ff0000'
         elif name in self.players:
-            if Settings.value(Settings.DISABLE_AUTOCOLOR_NICKS):
+            if self.disableAutoColorNicks:
                 return '#034456'
             if hasattr(self.players[name], 'id'):
                 return ColorTheme.getPlayerColor(self.players[name].id)
@@ -351,6 +488,13 @@ class Controller(QtCore.QObject):
                 return "<img src=':/flags/{}.png'/> ".format(p.cc)
 
     def getPlayerPrefix(self, name, useFlag):
+        if ColorTheme.SELECTED is not self.prefixTheme:
+            self.prefixTheme = ColorTheme.SELECTED
+            self.prefixCache.clear()
+        key = (name, bool(useFlag))
+        prefix = self.prefixCache.get(key)
+        if prefix is not None:
+            return prefix
         c = self.getPlayerColor(name)
         icon = ''
         if useFlag:
@@ -358,39 +502,24 @@ class Controller(QtCore.QObject):
             if icon==None:
                 icon=''
         if useFlag:
-            return '{}<b><font color="{}">{}</font></b> '.format(icon, c, cgi.escape('<{}>'.format(name)))
+            prefix = '{}<b><font color="{}">{}</font></b> '.format(icon, c, cgi.escape('<{}>'.format(name)))
         else:
-            return '<b><font color="{}">{}</font></b> '.format(c, cgi.escape('<{}>'.format(name)))
-
+            prefix = '<b><font color="{}">{}</font></b> '.format(c, cgi.escape('<{}>'.format(name)))
+        self.prefixCache[key] = prefix
+        return prefix
 
     def ggpoPathJoin(self, *args):
         if self.fba:
             return os.path.join(os.path.dirname(self.fba), *args)
         return os.path.join(*args)
 
-    def handleTcpResponse(self):
-        if self.tcpReadState == self.STATE_TCP_READ_LEN:
-            if len(self.tcpData) >= 4:
-                self.tcpResponseLen, self.tcpData = Protocol.extractInt(self.tcpData)
-                self.tcpReadState = self.STATE_TCP_READ_DATA
-                self.handleTcpResponse()
-        elif self.tcpReadState == self.STATE_TCP_READ_DATA:
-            if len(self.tcpData) >= self.tcpResponseLen:
-                # tcpResponseLen should be >= 4
-                if self.tcpResponseLen < 4:
-                    logdebug().error('Cannot handle TLV payload of less than 4 bytes')
-                    self.tcpData = self.tcpData[self.tcpResponseLen:]
-                    self.tcpResponseLen = 0
-                    self.tcpReadState = self.STATE_TCP_READ_LEN
-                    self.handleTcpResponse()
-                else:
-                    data = self.tcpData[:self.tcpResponseLen]
-                    self.tcpData = self.tcpData[self.tcpResponseLen:]
-                    seq = Protocol.unpackInt(data[0:4])
-                    self.tcpResponseLen = 0
-                    self.tcpReadState = self.STATE_TCP_READ_LEN
-                    self.dispatch(seq, data[4:])
-                    self.handleTcpResponse()
+    def handleTcpResponse(self, data):
+        skipped = self.tcpDecoder.skipped
+        frames = self.tcpDecoder.feed(data)
+        if self.tcpDecoder.skipped != skipped:
+            logdebug().error('Cannot handle TLV payload of less than 4 bytes')
+        for seq, payload in frames:
+            self.dispatch(seq, payload)
 
     def handleUdpResponse(self, dgram, addr):
         if not dgram:
@@ -400,31 +529,35 @@ class Controller(QtCore.QObject):
         remoteip, remoteport = addr
         if command == "GGPO PING":
             self.sendudp("GGPO PONG {}".format(secret), addr)
-            logdebug().info("send GGPO PONG {} to {}".format(secret, repr(addr)))
+            logdebug().info("send GGPO PONG {} to {}".format(repr(secret), repr(addr)))
         if dgram[0:9] == "GGPO PONG":
-            if secret in self.pinglist:
-                ip = self.pinglist[secret][0]
-                name = self.pinglist[secret][1]
-                t1 = self.pinglist[secret][2]
-                t2 = time.time()
-                if ip == remoteip:
-                    self.updatePlayerPing(name, int((t2 - t1) * 1000))
-                del self.pinglist[secret]
+            echo = self.pingPayload and self.pingPayload.unpack(secret, remoteip)
+            for p in self.playerStore.playersAt(remoteip):
+                if echo:
+                    # the payload carries who was pinged and when, the scheduler only hears it was answered
+                    if p.id == echo[0]:
+                        self.pingScheduler.answer(p.player, secret, remoteip)
+                        self.updatePlayerPing(p.player, int(echo[1] * 1000))
+                        break
+                else:
+                    rtt = self.pingScheduler.answer(p.player, secret, remoteip)
+                    if rtt is not None:
+                        self.updatePlayerPing(p.player, int(rtt * 1000))
+                        break
 
     def parseAuthResponse(self, data):
         if len(data) < 4:
             logdebug().error("Unknown auth response {}".format(repr(data)))
             return
-        result, data = Protocol.extractInt(data)
+        result, = Protocol.decode('STATUS', data)
         if result == 0:
-            self.selectTimeout = 15
+            if self.pingTimer is None:
+                self.pingTimer = self.loop.callEvery(self.PING_TICK, self.sendPingQueries)
             self.sigLoginSuccess.emit()
         # password incorrect, user incorrect
         #if result == 0x6 or result == 0x4:
         else:
-            if self.tcpSock:
-                self.tcpSock.close()
-                self.tcpConnected = False
+            self.closeTcp()
             #if self.udpSock:
             #    self.udpSock.close()
             #    self.udpConnected = False
@@ -442,7 +575,7 @@ class Controller(QtCore.QObject):
                 self.sigStatusMessage.emit("Login failed {}".format(result))
 
     def parseChallengeCancelledResponse(self, data):
-        name, data = Protocol.extractTLV(data)
+        name, = Protocol.decode('CHALLENGE_RETRACTED', data)
         if name in list(self.challengers):
             self.challengers.remove(name)
         if name in self.ignored:
@@ -450,7 +583,7 @@ class Controller(QtCore.QObject):
         self.sigChallengeCancelled.emit(name)
 
     def parseChallengeDeclinedResponse(self, data):
-        name, data = Protocol.extractTLV(data)
+        name, = Protocol.decode('CHALLENGE_DECLINED', data)
         if name == self.challenged:
             self.challenged = None
         if name in self.ignored:
@@ -458,24 +591,23 @@ class Controller(QtCore.QObject):
         self.sigChallengeDeclined.emit(name)
 
     def parseChallengeReceivedResponse(self, data):
-        name, data = Protocol.extractTLV(data)
-        rom, data = Protocol.extractTLV(data)
+        name, rom = Protocol.decode('CHALLENGE_RECEIVED', data)
         if rom != self.rom or name in self.ignored:
             return
         self.challengers.add(name)
+        self.pingScheduler.interacted(name)
         self.sigChallengeReceived.emit(name)
 
     def parseChatResponse(self, data):
-        name, data = Protocol.extractTLV(data)
+        name, msg = Protocol.decode('CHAT_DATA', data)
         if name in self.ignored:
             return
-        msg, data = Protocol.extractTLV(data)
         try:
             msg = msg.decode('utf-8')
         except ValueError:
             msg = msg
-        if Settings.value(Settings.USER_LOG_CHAT):
-            loguser().info(u"<{}> {}".format(name, msg))
+        if Settings.value(Settings.USER_LOG_CHAT) and not self.offline:
+            self.userLog.write(CHAT, self.channel, name, msg, u"<{}> {}".format(name, msg))
         self.sigChatReceived.emit(name, msg)
 
     # noinspection PyUnusedLocal
@@ -490,16 +622,12 @@ class Controller(QtCore.QObject):
             logdebug().error('No channels found')
             self.sigChannelsLoaded.emit()
             return
-        status1, data = Protocol.extractInt(data)
-        status2, data = Protocol.extractInt(data)
+        reader = Protocol.PacketReader(data)
+        status1, status2 = Protocol.Schemas['LIST_CHANNELS'].decode(reader)
         logdebug().info("Load channels header " + repr(status1) + repr(status2))
-        while len(data) > 4:
-            room, data = Protocol.extractTLV(data)
-            romname, data = Protocol.extractTLV(data)
-            title, data = Protocol.extractTLV(data)
-            users, data = Protocol.extractInt(data)
-            port, data = Protocol.extractInt(data)
-            index, data = Protocol.extractInt(data)
+        decodeChannel = Protocol.Schemas['CHANNEL'].decode
+        while reader.remaining() > 4:
+            room, romname, title, users, port, index = decodeChannel(reader)
             # 'sfa3': {'title': 'Street Fighter Alpha 3', 'rom': 'sfa3:sfa3u', 'room': 'sfa3'},
             # 'sfa2': {'title': 'Street Fighter Alpha 2', 'rom': 'sfa2', 'room': 'sfa2'},
             channel = {
@@ -512,32 +640,26 @@ class Controller(QtCore.QObject):
             self.channels[room] = channel
         logdebug().info(repr(self.channels))
         self.sigChannelsLoaded.emit()
-        if len(data) > 0:
-            logdebug().error('Channel REMAINING DATA len {} {}'.format(len(data), repr(data)))
+        self.warmConnectionPool()
+        if reader.remaining() > 0:
+            logdebug().error('Channel REMAINING DATA len {} {}'.format(reader.remaining(), repr(reader.rest())))
 
     def parseListUsersResponse(self, data):
+        # the ping schedule survives the refresh, only players missing from the new list are dropped from it
+        before = set(self.playerStore.names())
         self.resetPlayers()
         if not data:
+            for name in before:
+                self.pingScheduler.remove(name)
             return
-        status, data = Protocol.extractInt(data)
-        status2, data = Protocol.extractInt(data)
-        while len(data) > 8:
-            p1, data = Protocol.extractTLV(data)
-            # if len(data) <= 4: break
-            state, data = Protocol.extractInt(data)
-            p2, data = Protocol.extractTLV(data)
-            ip, data = Protocol.extractTLV(data)
-            unk1, data = Protocol.extractInt(data)
-            unk2, data = Protocol.extractInt(data)
-            city, data = Protocol.extractTLV(data)
-            cc, data = Protocol.extractTLV(data)
+        reader = Protocol.PacketReader(data)
+        status, status2 = Protocol.Schemas['LIST_USERS'].decode(reader)
+        decodeUser = Protocol.Schemas['USER'].decode
+        while reader.remaining() > 8:
+            p1, state, p2, ip, unk1, unk2, city, cc, country, port, color, spectators = decodeUser(reader)
             if cc:
                 cc = cc.lower()
-            country, data = Protocol.extractTLV(data)
-            port, data = Protocol.extractInt(data)
-            color, data = Protocol.extractInt(data)
             color = None if color >= 0x1000000 else QtGui.QColor((color & 0xFF0000) >> 16, (color & 0xFF00) >> 8, color & 0xFF)
-            spectators, data = Protocol.extractInt(data)
             self.addUser(
                 player=p1,
                 ip=ip,
@@ -548,46 +670,36 @@ class Controller(QtCore.QObject):
                 color=color,
                 spectators=spectators+1,
             )
-            if state == PlayerStates.AVAILABLE:
-                self.available[p1] = True
-            elif state == PlayerStates.AFK:
-                self.awayfromkb[p1] = True
-            elif state == PlayerStates.PLAYING:
-                if not p2:
-                    p2 = 'null'
-                self.playing[p1] = p2
+            if state == PlayerStates.PLAYING and not p2:
+                p2 = 'null'
+            self.playerStore.setState(p1, state, p2)
+            before.discard(p1)
+        for name in before:
+            self.pingScheduler.remove(name)
         self.sigPlayersLoaded.emit()
-        if len(data) > 0:
-            logdebug().error('List users - REMAINING DATA len {} {}'.format(len(data), repr(data)))
+        if reader.remaining() > 0:
+            logdebug().error('List users - REMAINING DATA len {} {}'.format(reader.remaining(), repr(reader.rest())))
 
     def parseMotdResponse(self, data):
         if not data:
             return
-        status, data = Protocol.extractInt(data)
-        channel, data = Protocol.extractTLV(data)
-        topic, data = Protocol.extractTLV(data)
-        msg, data = Protocol.extractTLV(data)
+        status, channel, topic, msg = Protocol.decode('MOTD', data)
         self.sigMotdReceived.emit(channel, topic, msg)
 
     def parsePlayerAFKResponse(self, p1, playerinfo):
         self.addUser(**playerinfo)
-        self.awayfromkb[p1] = True
-        self.available.pop(p1, None)
-        self.playing.pop(p1, None)
+        self.playerStore.setState(p1, PlayerStates.AFK)
         self.sigPlayerStateChange.emit(p1, PlayerStates.AFK)
 
     def parsePlayerAvailableResponse(self, p1, playerinfo):
         self.addUser(**playerinfo)
-        self.available[p1] = True
-        self.awayfromkb.pop(p1, None)
-        self.playing.pop(p1, None)
+        self.playerStore.setState(p1, PlayerStates.AVAILABLE)
         self.sigPlayerStateChange.emit(p1, PlayerStates.AVAILABLE)
 
     def parsePlayerLeftResponse(self, p1):
         if p1:
-            self.available.pop(p1, None)
-            self.awayfromkb.pop(p1, None)
-            self.playing.pop(p1, None)
+            self.playerStore.setState(p1, PlayerStates.QUIT)
+            self.pingScheduler.remove(p1)
             if p1 in self.challengers:
                 self.challengers.remove(p1)
             if p1 == self.challenged:
@@ -596,19 +708,15 @@ class Controller(QtCore.QObject):
 
     def parsePlayerStartGameResponse(self, p1, p2, playerinfo):
         self.addUser(**playerinfo)
-        self.playing[p1] = p2
-        self.available.pop(p1, None)
-        self.awayfromkb.pop(p1, None)
+        self.playerStore.setState(p1, PlayerStates.PLAYING, p2)
         self.sigPlayerStateChange.emit(p1, PlayerStates.PLAYING)
 
     def parseSpectateResponse(self, data):
-        p1, data = Protocol.extractTLV(data)
-        p2, data = Protocol.extractTLV(data)
+        p1, p2, quark = Protocol.decode('SPECTATE_GRANTED', data)
         # if the guy I challenged accepted, remove him as challenged
         if self.challenged and self.challenged in [p1, p2] and self.username in [p1, p2]:
             self.challenged = None
             # quark len(53) = 'quark:stream,ssf2t,challenge-07389-1393539605.46,7000'
-        quark, data = Protocol.extractTLV(data)
         logdebug().info("Quark " + repr(quark))
         # when someone leaves and p1 is playing vs 'null'
         if quark=='':
@@ -622,9 +730,12 @@ class Controller(QtCore.QObject):
         self.runFBA(quark)
 
     def parseStateChangesResponse(self, data):
-        count, data = Protocol.extractInt(data)
-        while count > 0 and len(data) >= 4:
-            state, p1, p2, playerinfo, data = self.__class__.extractStateChangesResponse(data)
+        reader = Protocol.PacketReader(data)
+        count, = Protocol.Schemas['PLAYER_STATE_CHANGE'].decode(reader)
+        # sigPlayerStateChange fires per entry for extensions, the gui gets one (name, state) list per frame
+        changes = []
+        while count > 0 and reader.remaining() >= 4:
+            state, p1, p2, playerinfo = self.__class__.extractStateChangesResponse(reader)
             if state == PlayerStates.PLAYING:
                 self.parsePlayerStartGameResponse(p1, p2, playerinfo)
                 if self.username == p1:
@@ -633,8 +744,9 @@ class Controller(QtCore.QObject):
                 if self.username == p2:
                     self.playingagainst = p1
                     self.side = 2
-                if Settings.value(Settings.USER_LOG_PLAYHISTORY) and self.username in [p1, p2]:
-                    loguser().info(u"[IN A GAME] {} vs {}".format(p1, p2))
+                if Settings.value(Settings.USER_LOG_PLAYHISTORY) and self.username in [p1, p2] and not self.offline:
+                    line = u"[IN A GAME] {} vs {}".format(p1, p2)
+                    self.userLog.write(GAME, self.channel, '', line, line)
             elif state == PlayerStates.AVAILABLE:
                 self.parsePlayerAvailableResponse(p1, playerinfo)
                 if self.playingagainst == p1:
@@ -651,15 +763,20 @@ class Controller(QtCore.QObject):
                 self.parsePlayerLeftResponse(p1)
             else:
                 logdebug().error(
-                    "Unknown state change payload state: {} {}".format(state, repr(data)))
+                    "Unknown state change payload state: {} {}".format(state, repr(reader.rest())))
+            if state in (PlayerStates.PLAYING, PlayerStates.AVAILABLE, PlayerStates.AFK) or \
+                    (state == PlayerStates.QUIT and p1):
+                changes.append((p1, state))
             if state == PlayerStates.PLAYING:
                 msg = p1 + ' ' + PlayerStates.codeToString(state) + ' ' + p2
             else:
                 msg = p1 + ' ' + PlayerStates.codeToString(state)
             logdebug().info(msg)
             count -= 1
-        #if len(data) > 0:
-        #    logdebug().error("stateChangesResponse, remaining data {}".format(repr(data)))
+        if changes:
+            self.sigPlayerStatesChanged.emit(changes)
+        #if reader.remaining() > 0:
+        #    logdebug().error("stateChangesResponse, remaining data {}".format(repr(reader.rest())))
 
     def killPuncher(self):
         if IS_WINDOWS:
@@ -736,9 +853,8 @@ class Controller(QtCore.QObject):
             self.sigIgnoreRemoved.emit(player)
 
     def resetPlayers(self):
-        self.available = {}
-        self.playing = {}
-        self.awayfromkb = {}
+        self.playerStore.reset()
+        self.prefixCache.clear()
 
     def desktopComposition(self,flag):
         if IS_WINDOWS:
@@ -797,6 +913,8 @@ class Controller(QtCore.QObject):
                 fileinput.close()
 
     def runFBA(self, quark):
+        if self.offline:
+            return
         if "served" in quark:
             self.killEmulator()
             self.killPuncher()
@@ -846,61 +964,65 @@ class Controller(QtCore.QObject):
     def saveIgnored(self):
         Settings.setPythonValue(Settings.IGNORED, self.ignored)
 
+    def onTcpEvent(self, events):
+        if events & EVENT_WRITE:
+            self.flushTcp()
+        if not events & EVENT_READ or not self.tcpConnected:
+            return
+        data = None
+        # noinspection PyBroadException
+        try:
+            data = self.tcpSock.recv(16384)
+        except socket.error, ex:
+            if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            if not self.switchingServer:
+                self.tcpDisconnected()
+            return
+        except:
+            if not self.switchingServer:
+                self.tcpDisconnected()
+            return
+        if data:
+            if self.wireRecorder:
+                self.wireRecorder.record(TCP_IN, data)
+            self.handleTcpResponse(data)
+        elif not self.switchingServer:
+            self.closeTcp()
+            self.tcpDisconnected()
+
+    def onUdpEvent(self, events):
+        dgram = None
+        # on windows xp
+        # Python exception: error: [Errno 10054]
+        # An existing connection was forcibly closed by the remote host
+        # noinspection PyBroadException
+        try:
+            dgram, addr = self.udpSock.recvfrom(64)
+        except:
+            pass
+        if dgram:
+            if self.wireRecorder:
+                self.wireRecorder.record(UDP_IN, dgram, addr)
+            logdebug().info("UDP " + repr(dgram) + " from " + repr(addr))
+            self.handleUdpResponse(dgram, addr)
+
+    def searchUserLog(self, text):
+        def showResults(rows):
+            if not rows:
+                self.sigStatusMessage.emit(u"No logged chat matches {}".format(text))
+            for when, kind, channel, name, msg in rows:
+                stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(when))
+                if kind == CHAT:
+                    self.sigStatusMessage.emit(u"{} [{}] <{}> {}".format(stamp, channel, name, msg))
+                else:
+                    self.sigStatusMessage.emit(u"{} [{}] {}".format(stamp, channel, msg))
+
+        self.userLog.search(text, showResults)
+
     def selectLoop(self):
-        while self.selectLoopRunning:
-            inputs = []
-            if self.udpConnected:
-                inputs.append(self.udpSock)
-            if self.tcpConnected:
-                inputs.append(self.tcpSock)
-                # windows doesn't allow select on 3 empty set
-            if not inputs:
-                time.sleep(1)
-                continue
-            inputready, outputready, exceptready = None, None, None
-            # http://stackoverflow.com/questions/13414029/catch-interrupted-system-call-in-threading
-            try:
-                inputready, outputready, exceptready = select.select(inputs, [], [], self.selectTimeout)
-            except select.error, ex:
-                if ex[0] != errno.EINTR and ex[0] != errno.EBADF:
-                    raise
-            if not inputready:
-                self.sendPingQueries()
-            else:
-                for stream in inputready:
-                    if stream == self.tcpSock:
-                        data = None
-                        # noinspection PyBroadException
-                        try:
-                            data = stream.recv(16384)
-                        except:
-                            if not self.switchingServer:
-                                self.tcpConnected = False
-                                self.selectLoopRunning = False
-                                self.sigServerDisconnected.emit()
-                                return
-                        if data:
-                            self.tcpData += data
-                            self.handleTcpResponse()
-                        else:
-                            if not self.switchingServer:
-                                stream.close()
-                                self.tcpConnected = False
-                                self.selectLoopRunning = False
-                                self.sigServerDisconnected.emit()
-                    elif stream == self.udpSock:
-                        dgram = None
-                        # on windows xp
-                        # Python exception: error: [Errno 10054]
-                        # An existing connection was forcibly closed by the remote host
-                        # noinspection PyBroadException
-                        try:
-                            dgram, addr = self.udpSock.recvfrom(64)
-                        except:
-                            pass
-                        if dgram:
-                            logdebug().info("UDP " + repr(dgram) + " from " + repr(addr))
-                            self.handleUdpResponse(dgram, addr)
+        # runs on the network thread until stop() or a server disconnect
+        self.loop.run()
 
     def sendAcceptChallenge(self, name):
         isFbaPresent = self.checkInstallation()
@@ -916,28 +1038,20 @@ class Controller(QtCore.QObject):
             logdebug().info('Sending {} seq {} {}'.format(Protocol.codeToString(command), self.sequence, repr(data)))
             self.sendtcp(struct.pack('!I', command) + data)
 
-    def sendAndRemember(self, command, data=''):
+    def sendAndRemember(self, command, data='', callback=None):
+        """
+        send a request and remember it until the server answers
+        @param callback: called with the reply payload once the response has been handled
+        """
         with self.sendLock:  # extensions may send messages from separate threads
             logdebug().info('Sending {} seq {} {}'.format(Protocol.codeToString(command), self.sequence, repr(data)))
-            self.tcpCommandsWaitingForResponse[self.sequence] = command
+            self.pendingRequests.add(self.sequence, command, callback)
             self.sendtcp(struct.pack('!I', command) + data)
 
     def sendAuth(self, username, password):
         self.username = username
-        try:
-            port = self.udpSock.getsockname()[1]
-        except:
-            port=6009
-            #raise
-
-        # piggyback the OS and timezone onto the login request since there doesn't seem to be another convenient place to send it.
-        authdata = Protocol.packTLV(username) + Protocol.packTLV(password) + Protocol.packInt(port) + \
-                   Protocol.packInt(copyright.versionNum()) + \
-                   Protocol.packInt(self.os) + \
-                   Protocol.packTLV(str(self.utcoffset))  # There's a string conversion error here if packInt returns any
-                   #Protocol.packInt(self.utcoffset)      # non-ascii bytes.  Send utcoffset as a string for now.
-
-        self.sendAndRemember(Protocol.AUTH, authdata)
+        self.prefixCache.clear()
+        self.sendAndRemember(Protocol.AUTH, self.authPayload(username, password))
 
     def sendCancelChallenge(self, name=None):
         if (name is None and self.challenged) or (name and name == self.challenged):
@@ -955,6 +1069,7 @@ class Controller(QtCore.QObject):
             self.runFBA(self.channel)
         else:
             self.sigStatusMessage.emit("Challenging "+name)
+            self.pingScheduler.interacted(name)
             self.sendAndRemember(Protocol.SEND_CHALLENGE, Protocol.packTLV(name) + Protocol.packTLV(self.rom))
             self.challenged = name
 
@@ -981,18 +1096,26 @@ class Controller(QtCore.QObject):
             else:
                 logdebug().error("Invalid channel {}".format(channel))
 
-        if (int(self.channelport)!=int(self.channels[channel]['port'])):
-            self.switchingServer=True
-            self.channelport = int(self.channels[channel]['port'])
-            Settings.setValue(Settings.PORT, self.channelport)
-            self.tcpSock.close()
-            self.sequence = 0x1
-            self.connectTcp()
-            self.sendWelcome()
-            self.sendAuth(self.username, self.password)
-            if Settings.value(Settings.AWAY):
-                self.sendToggleAFK(1)
-        self.sendAndRemember(Protocol.JOIN_CHANNEL, Protocol.packTLV(self.channel))
+        with self.coalescedSends():
+            if (int(self.channelport)!=int(self.channels[channel]['port'])):
+                self.switchingServer=True
+                self.channelport = int(self.channels[channel]['port'])
+                Settings.setValue(Settings.PORT, self.channelport)
+                conn = self.connectionPool.take(self.channelport)
+                if conn:
+                    logdebug().info("Switching to pooled connection on port {}".format(self.channelport))
+                    self.adoptConnection(conn)
+                    self.sendAuth(self.username, self.password)
+                else:
+                    self.closeTcp()
+                    self.sequence = 0x1
+                    self.connectTcp()
+                    self.sendWelcome()
+                    self.sendAuth(self.username, self.password)
+                if Settings.value(Settings.AWAY):
+                    self.sendToggleAFK(1)
+                self.warmConnectionPool()
+            self.sendAndRemember(Protocol.JOIN_CHANNEL, Protocol.packTLV(self.channel))
 
     def sendListChannels(self):
         self.sendAndRemember(Protocol.LIST_CHANNELS)
@@ -1004,32 +1127,38 @@ class Controller(QtCore.QObject):
         self.sendAndRemember(Protocol.MOTD)
         self.switchingServer=False
 
+    def pingPlayer(self, name):
+        p = self.playerStore.get(name)
+        if p and p.state is not None and p.ip:
+            return self.sendPingQuery(p), p.ip
+
     def sendPingQueries(self):
         if self.udpConnected:
-            for name in self.available.keys() + self.awayfromkb.keys() + self.playing.keys():
-                p = self.players[name]
-                self.sendPingQuery(p)
+            self.pingScheduler.tick()
 
     def sendPingQuery(self, player):
-        if not self.udpConnected:
-            return
-        if not player.ip:
-            return
+        """
+        @return: the secret the PONG will carry
+        """
         if not player.port:
             player.port = 6009
-        num1 = randint(500000, 30000000)
-        num2 = randint(4000000, 900000000)
-        secret = str(num1) + " " + str(num2)
+        if self.pingPayload and player.ip not in self.textPingPeers:
+            secret = self.pingPayload.pack(player.ip, player.id)
+        else:
+            num1 = randint(500000, 30000000)
+            num2 = randint(4000000, 900000000)
+            secret = str(num1) + " " + str(num2)
         message = "GGPO PING " + secret
-        logdebug().info("send GGPO PING {} to {}".format(secret, repr(player.ip)))
+        logdebug().info("send GGPO PING {} to {}".format(repr(secret), repr(player.ip)))
         self.sendudp(message, (player.ip, player.port, ))
-        self.pinglist[secret] = (player.ip, player.player, time.time())
+        return secret
 
     def sendSpectateRequest(self, name):
         isFbaPresent = self.checkInstallation()
         isRomPresent = self.checkRom()
         if not isRomPresent or not isFbaPresent:
             return
+        self.pingScheduler.interacted(name)
         self.sendAndRemember(Protocol.SPECTATE, Protocol.packTLV(name))
 
     def sendToggleAFK(self, afk):
@@ -1043,32 +1172,120 @@ class Controller(QtCore.QObject):
         Settings.setBoolean(Settings.AWAY, state)
 
     def sendWelcome(self):
-        self.sendAndRemember(Protocol.WELCOME, '\x00\x00\x00\x00\x00\x00\x00\x1d\x00\x00\x00\x01')
+        self.sendAndRemember(Protocol.WELCOME, self.WELCOME_PAYLOAD)
 
     def sendtcp(self, msg):
         # length of whole packet = length of sequence + length of msg
         payloadLen = 4 + len(msg)
-        # noinspection PyBroadException
-        try:
-            self.tcpSock.send(struct.pack('!II', payloadLen, self.sequence) + str(msg))
-        except:
-            self.tcpConnected = False
-            self.selectLoopRunning = False
-            self.sigServerDisconnected.emit()
+        frame = struct.pack('!II', payloadLen, self.sequence) + str(msg)
+        if self.wireRecorder:
+            self.wireRecorder.record(TCP_OUT, frame)
+        self.tcpQueue.push(frame)
         self.sequence += 1
+        self.scheduleFlush()
+
+    @contextmanager
+    def coalescedSends(self):
+        """
+        queue everything sent inside the block and write it out in one go
+        """
+        self.tcpQueue.cork()
+        try:
+            yield
+        finally:
+            self.tcpQueue.uncork()
+            self.scheduleFlush()
+
+    def scheduleFlush(self):
+        # may be called from any thread, the write itself happens on the network thread
+        if not self.tcpFlushScheduled:
+            self.tcpFlushScheduled = True
+            self.loop.callSoon(self.flushTcp)
+
+    def flushTcp(self):
+        # anything the socket doesn't take now is written once it becomes writable
+        self.tcpFlushScheduled = False
+        if not self.tcpSock or not self.tcpConnected:
+            return
+        if self.tcpQueue.corked:
+            # coalescedSends() schedules another flush once it uncorks
+            done = True
+        else:
+            # noinspection PyBroadException
+            try:
+                done = self.tcpQueue.flush(self.tcpSock)
+            except:
+                self.tcpDisconnected()
+                return
+        if self.tcpWatchingWrites == done:
+            self.tcpWatchingWrites = not done
+            self.loop.modify(self.tcpSock, EVENT_READ | EVENT_WRITE if self.tcpWatchingWrites else EVENT_READ)
 
     def sendudp(self, msg, address):
+        if self.wireRecorder:
+            self.wireRecorder.record(UDP_OUT, msg, address)
         # noinspection PyBroadException
         try:
             self.udpSock.sendto(msg, address)
         except:
             pass
 
+    def setDisableAutoColorNicks(self, state):
+        self.disableAutoColorNicks = bool(state)
+        self.prefixCache.clear()
+
+    def setKeepalive(self, sock):
+        # the lobby protocol has no keepalive message, let the kernel probe idle connections
+        # noinspection PyBroadException
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.KEEPALIVE_IDLE)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.KEEPALIVE_INTERVAL)
+            elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+                sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, self.KEEPALIVE_IDLE * 1000, self.KEEPALIVE_INTERVAL * 1000))
+        except:
+            pass
+
     def setUnsupportedRom(self, rom):
         self.unsupportedRom = rom
 
+    def requestStats(self):
+        lines = []
+        for command in self.LATENCY_STATS_COMMANDS:
+            pct = self.pendingRequests.percentiles(command)
+            if pct:
+                lines.append("{} {} samples, p50 {:.0f}ms p90 {:.0f}ms p99 {:.0f}ms".format(
+                    Protocol.codeToString(command), self.pendingRequests.samples(command), *[x * 1000 for x in pct]))
+            else:
+                lines.append("{} no samples".format(Protocol.codeToString(command)))
+        lines.append("{} requests pending, {} answered, {} timed out".format(
+            len(self.pendingRequests), self.pendingRequests.answered, self.pendingRequests.expired))
+        lines.append("channel switches: {} from the connection pool, {} reconnected".format(
+            self.connectionPool.hits, self.connectionPool.misses))
+        for provider in self.statsProviders:
+            lines.extend(provider())
+        return lines
+
+    def startWireCapture(self):
+        path = os.path.join(os.path.abspath(os.path.expanduser("~")),
+                            'fightcade-{}.cap'.format(time.strftime('%Y%m%d-%H%M%S')))
+        try:
+            self.wireRecorder = WireRecorder(path)
+            logdebug().info("Recording lobby traffic to {}".format(path))
+        except IOError, ex:
+            logdebug().error("Cannot record lobby traffic to {}: {}".format(path, ex))
+
+    def stop(self):
+        self.loop.stop()
+        self.connectionPool.close()
+        if self.wireRecorder:
+            self.wireRecorder.close()
+        self.latencyCache.close()
+        self.userLog.close()
+
     def statusBarMessage(self):
-        u = len(self.playing) + len(self.available) + len(self.awayfromkb)
+        u = len(self.playerStore)
         if self.channel in self.channels:
             c = self.channels[self.channel]
             title = c['title']
@@ -1079,8 +1296,42 @@ class Controller(QtCore.QObject):
             msg += " - INCOMING CHALLENGE!"
         return msg
 
+    def tcpDisconnected(self):
+        self.tcpConnected = False
+        self.loop.stop()
+        self.connectionPool.close()
+        self.sigServerDisconnected.emit()
+
+    def warmConnectionPool(self):
+        # keep logged in connections ready for the ports of favourite channels
+        favorites = [c for c in (Settings.value(Settings.CHANNELS_FAVORITES) or '').split(',') if c in self.channels]
+        ports = []
+        for channel in favorites:
+            port = int(self.channels[channel]['port'])
+            if port != int(self.channelport) and port not in ports:
+                ports.append(port)
+        if ports and not self.offline:
+            self.connectionPool.warm(ports)
+
     def updatePlayerPing(self, name, ping):
-        if name in self.players:
-            self.players[name].ping = ping
+        p = self.players.get(name)
+        if p:
+            if p.rtt is None:
+                p.rtt = RttStats()
+            p.rtt.add(ping)
+            p.ping = p.rtt.smoothed()
+            p.lastPingTime = time.time()
+            self.latencyCache.record(p.ip, p.ping)
+            self.sigPlayerPingChanged.emit(name)
 #            # DEBUG
 #            self.players[name].ping = 15*abs(ord(self.username[0]) - ord(name[0]))
+
+    def updatePlayerPingLost(self, name):
+        p = self.players.get(name)
+        if p:
+            if p.rtt is None:
+                p.rtt = RttStats()
+            p.rtt.lost()
+            if self.pingPayload and not p.rtt.count and p.rtt.probes > PingScheduler.MAX_RETRIES:
+                # peer may not echo binary payloads, try the text secret from now on
+                self.textPingPeers.add(p.ip)
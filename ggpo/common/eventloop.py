@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+import errno
+import heapq
+import itertools
+import logging
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+
+def socketpair():
+    """ socket.socketpair() for platforms that lack it (windows) """
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        writer.connect(listener.getsockname())
+        reader, _ = listener.accept()
+    finally:
+        listener.close()
+    return reader, writer
+
+
+class Timer(object):
+    __slots__ = ('when', 'interval', 'callback', 'cancelled')
+
+    def __init__(self, when, interval, callback):
+        self.when = when
+        self.interval = interval
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EpollPoller(object):
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    @staticmethod
+    def mask(events):
+        mask = 0
+        if events & EVENT_READ:
+            mask |= select.EPOLLIN
+        if events & EVENT_WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, self.mask(events))
+
+    def poll(self, timeout):
+        try:
+            ready = self.epoll.poll(-1 if timeout is None else timeout)
+        except IOError, ex:
+            if ex.errno == errno.EINTR:
+                return []
+            raise
+        result = []
+        for fd, mask in ready:
+            events = 0
+            # errors and hangups are reported as readable, recv() tells what happened
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                events |= EVENT_READ
+            if mask & select.EPOLLOUT:
+                events |= EVENT_WRITE
+            result.append((fd, events))
+        return result
+
+    def register(self, fd, events):
+        self.epoll.register(fd, self.mask(events))
+
+    def unregister(self, fd):
+        # noinspection PyBroadException
+        try:
+            self.epoll.unregister(fd)
+        except:
+            pass
+
+
+class SelectPoller(object):
+    # the fd sets are replaced rather than mutated, other threads may register while poll() runs
+    def __init__(self):
+        self.readers = frozenset()
+        self.writers = frozenset()
+
+    def modify(self, fd, events):
+        self.readers = self.readers | set([fd]) if events & EVENT_READ else self.readers - set([fd])
+        self.writers = self.writers | set([fd]) if events & EVENT_WRITE else self.writers - set([fd])
+
+    def poll(self, timeout):
+        readers, writers = self.readers, self.writers
+        try:
+            r, w, _ = select.select(readers, writers, [], timeout)
+        except select.error, ex:
+            # a socket closed under us shows up as EBADF, the owner unregisters it
+            if ex[0] in (errno.EINTR, errno.EBADF):
+                return []
+            raise
+        ready = dict.fromkeys(r, EVENT_READ)
+        for fd in w:
+            ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+        return ready.items()
+
+    def register(self, fd, events):
+        self.modify(fd, events)
+
+    def unregister(self, fd):
+        self.modify(fd, 0)
+
+
+class EventLoop(object):
+    """
+    Readiness loop for the controller network thread.
+
+    Sockets are registered once with a callback taking the ready events,
+    timers live in a heap and decide how long the poller may block.  Other
+    threads hand work to the loop with callSoon(), which writes to a wakeup
+    socket so the poller returns immediately instead of waiting for the next
+    timer.  Uses epoll where available and falls back to select.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.poller = EpollPoller() if hasattr(select, 'epoll') else SelectPoller()
+        self.handlers = {}
+        self.timers = []
+        self.timerSequence = itertools.count()
+        self.callbacks = deque()
+        self.running = False
+        self.wakeupPending = False
+        self.wakeupReader, self.wakeupWriter = socketpair()
+        self.wakeupReader.setblocking(0)
+        self.wakeupWriter.setblocking(0)
+        self.register(self.wakeupReader, EVENT_READ, self._drainWakeup)
+
+    def callEvery(self, interval, callback, delay=None):
+        """
+        run callback every interval seconds, first after delay (defaults to interval)
+        @return: Timer, cancel() it to stop
+        """
+        return self._addTimer(Timer(time.time() + (interval if delay is None else delay), interval, callback))
+
+    def callLater(self, delay, callback):
+        return self._addTimer(Timer(time.time() + delay, None, callback))
+
+    def callSoon(self, callback, *args):
+        """ run callback on the loop thread, safe to call from any thread """
+        self.callbacks.append((callback, args))
+        self.wakeup()
+
+    def modify(self, sock, events):
+        with self.lock:
+            fd = sock.fileno()
+            if fd in self.handlers:
+                self.poller.modify(fd, events)
+        self.wakeup()
+
+    def register(self, sock, events, callback):
+        """
+        watch sock for events, callback(events) runs on the loop thread
+        @param events: EVENT_READ and/or EVENT_WRITE
+        """
+        with self.lock:
+            fd = sock.fileno()
+            if fd in self.handlers:
+                self.poller.modify(fd, events)
+            else:
+                self.poller.register(fd, events)
+            self.handlers[fd] = callback
+        self.wakeup()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.runOnce()
+
+    def runOnce(self):
+        for fd, events in self.poller.poll(self._timeout()):
+            callback = self.handlers.get(fd)
+            if callback:
+                self._call(callback, events)
+        self._runTimers()
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            self._call(callback, *args)
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+
+    def unregister(self, sock):
+        """ must be called before sock is closed """
+        with self.lock:
+            # noinspection PyBroadException
+            try:
+                fd = sock.fileno()
+            except:
+                return
+            if self.handlers.pop(fd, None):
+                self.poller.unregister(fd)
+
+    def wakeup(self):
+        if self.wakeupPending:
+            return
+        self.wakeupPending = True
+        try:
+            self.wakeupWriter.send('\0')
+        except socket.error:
+            pass
+
+    def _addTimer(self, timer):
+        with self.lock:
+            heapq.heappush(self.timers, (timer.when, next(self.timerSequence), timer))
+        self.wakeup()
+        return timer
+
+    @staticmethod
+    def _call(callback, *args):
+        # noinspection PyBroadException
+        try:
+            callback(*args)
+        except:
+            logging.getLogger('GGPODebug').exception('Unhandled exception in network thread')
+
+    def _drainWakeup(self, events):
+        # empty the socket before clearing the flag: a wakeup() in between then sends a fresh byte,
+        # one that lands before is covered because runOnce() handles callbacks after this
+        try:
+            while self.wakeupReader.recv(4096):
+                pass
+        except socket.error:
+            pass
+        self.wakeupPending = False
+
+    def _runTimers(self):
+        now = time.time()
+        while True:
+            with self.lock:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                _, _, timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            self._call(timer.callback)
+            if timer.interval is not None and not timer.cancelled:
+                # don't try to catch up on missed runs after a stall
+                timer.when += timer.interval
+                if timer.when <= now:
+                    timer.when = now + timer.interval
+                with self.lock:
+                    heapq.heappush(self.timers, (timer.when, next(self.timerSequence), timer))
+
+    def _timeout(self):
+        if self.callbacks:
+            return 0
+        with self.lock:
+            if not self.timers:
+                return None
+            return max(0, self.timers[0][0] - time.time())
@@ -145,9 +145,8 @@ class _Extension(QtCore.QObject):
             data: Encoded message data
         """
 
-        cmd, data = Protocol.extractTLV(data)
-        extID, cmd = Protocol.extractInt(cmd)
-        prefix, cmd = Protocol.extractInt(cmd)
+        body, = Protocol.decode('EXTENSION', data)
+        extID, prefix, cmd = Protocol.decode('EXTENSION_BODY', body)
         params = None if cmd == '' else json.loads(cmd)
 
         # DEBUG
@@ -195,8 +194,8 @@ class _Extension(QtCore.QObject):
             prefix: extension-defined positive integer
             params: json-serializable python object
         """
-        data = Protocol.packInt(extID) + Protocol.packInt(prefix) + json.dumps(params)
-        self.controller.sendAndRemember(Protocol.EXTENSION_OUTBOUND, Protocol.packTLV(data))
+        data = Protocol.encode('EXTENSION_BODY', extID, prefix, json.dumps(params))
+        self.controller.sendAndRemember(Protocol.EXTENSION_OUTBOUND, Protocol.encode('EXTENSION', data))
 
         # DEBUG
         dispext = "Extension" if extID == 0 else _ExtensionDict[extID].__name__
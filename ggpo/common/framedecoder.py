@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import struct
+
+
+class FrameDecoder(object):
+    """
+    Incremental decoder for the lobby TCP stream.
+
+    The server sends frames encoded as [length:sequence:payload], where length is
+    an int32 covering the sequence and the payload.  Received chunks are appended
+    to a single bytearray and consumed through a read offset, so bytes are only
+    copied once when a complete frame payload is handed out.  The consumed
+    prefix of the buffer is dropped lazily, when it grows past COMPACT_THRESHOLD
+    or when everything has been read.
+    """
+
+    COMPACT_THRESHOLD = 65536
+    _header = struct.Struct('!II')
+    _length = struct.Struct('!I')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.buffer) - self.offset
+
+    def feed(self, data):
+        """
+        append a received chunk to the buffer and return the complete frames
+        @param data: bytes read from the socket
+        @return: list of (sequence, payload) tuples
+        """
+        self.buffer.extend(data)
+        return self.frames()
+
+    def frames(self):
+        """
+        extract every complete frame currently buffered
+        @return: list of (sequence, payload) tuples
+        """
+        frames = []
+        buf = self.buffer
+        end = len(buf)
+        offset = self.offset
+        view = memoryview(buf)
+        try:
+            while end - offset >= 4:
+                length, = self._length.unpack_from(buf, offset)
+                if end - offset - 4 < length:
+                    break
+                if length < 4:
+                    # cannot carry a sequence number, drop it
+                    self.skipped += 1
+                    offset += 4 + length
+                    continue
+                length, seq = self._header.unpack_from(buf, offset)
+                start = offset + 8
+                offset += 4 + length
+                frames.append((seq, view[start:offset].tobytes()))
+        finally:
+            # a bytearray with exported buffers cannot be resized
+            del view
+        self.offset = offset
+        self.compact()
+        return frames
+
+    def compact(self):
+        if self.offset == len(self.buffer):
+            del self.buffer[:]
+            self.offset = 0
+        elif self.offset >= self.COMPACT_THRESHOLD:
+            del self.buffer[:self.offset]
+            self.offset = 0
+
+    def reset(self):
+        del self.buffer[:]
+        self.offset = 0
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 import json
 import os
+import socket
+import struct
+import threading
 import urllib2
+from collections import deque, OrderedDict
+from Queue import Queue, Empty
 from ggpo.common.runtime import *
 from ggpo.common.settings import Settings
 from ggpo.common.util import packagePathJoin
@@ -36,28 +41,144 @@ def freegeoip(ip):
                 'region_name': '',
                 'zipcode': ''}
 
+class GeoResolver(object):
+    """
+    Resolves player addresses with geolookup() on a pool of worker threads.
+
+    resolve() only queues the address.  Workers drain the queue in batches
+    of up to BATCH addresses and hand every batch to the done callback as a
+    list of (ip, (cc, country, city)), so a whole user list costs the caller
+    a handful of callbacks instead of one database lookup per player.
+    Located addresses are kept in an LRU cache of CACHE_SIZE addresses,
+    failures are not, so they resolve once geolookupInit() opens a database.
+    """
+
+    WORKERS = 2
+    BATCH = 512
+    CACHE_SIZE = 8192
+
+    def __init__(self, done):
+        """
+        @param done: callable(results) run on a worker thread with every finished batch
+        """
+        self.done = done
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.queue = Queue()
+        self.workers = []
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, ip):
+        """ @return: (cc, country, city) if ip was resolved before, else None """
+        with self.lock:
+            result = self.cache.pop(ip, None)
+            if result is not None:
+                self.cache[ip] = result
+                self.hits += 1
+            return result
+
+    def resolve(self, ip):
+        if not self.workers:
+            for i in range(self.WORKERS):
+                worker = threading.Thread(target=self._run, name='GeoResolver{}'.format(i))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        self.queue.put(ip)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.BATCH:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            results = []
+            for ip in batch:
+                result = self.cached(ip)
+                if result is None:
+                    result = geolookup(ip)
+                    with self.lock:
+                        self.misses += 1
+                        if not isUnknownCountryCode(result[0]):
+                            self.cache[ip] = result
+                            if len(self.cache) > self.CACHE_SIZE:
+                                self.cache.popitem(last=False)
+                results.append((ip, result))
+            self.done(results)
+
+
+# maxminddb reader, False until geolookupInit() ran, None when it found no database
 _geoIP2Reader = False
+# maxminddb 2 reports the matched network, older versions (the last for python 2) only the record
+_geoIP2HasPrefixLen = False
+_geoIP2Lock = threading.Lock()
+# prefix length -> {network number: (cc, country, city)}, filled from the networks the database matched,
+# at most PREFIX_CACHE_SIZE networks, the oldest is dropped first
+PREFIX_CACHE_SIZE = 8192
+_prefixCache = {}
+_prefixLengths = []
+_prefixOrder = deque()
 
 
 def geolookup(ip):
-    if not _geoIP2Reader:
+    if _geoIP2Reader is False:
         geolookupInit()
-    if _geoIP2Reader:
-        # noinspection PyBroadException
-        try:
-            response = _geoIP2Reader.city(ip)
-            cc = response.country.iso_code.lower()
-            return cc, response.country.name, response.city.name
-        except:
-            pass
-    return 'unknown', '', ''
-
-
-def geolookupInit():
-    global _geoIP2Reader
-    db = findGeoIPDB()
-    if db and os.path.isfile(db):
-        _geoIP2Reader = GeoIP2Reader(db)
+    if _geoIP2Reader is None:
+        return 'unknown', '', ''
+    try:
+        address, = struct.unpack('!I', socket.inet_aton(ip))
+    except (socket.error, TypeError):
+        return 'unknown', '', ''
+    for length in tuple(_prefixLengths):
+        result = _prefixCache.get(length, {}).get(address >> (32 - length))
+        if result is not None:
+            return result
+    result = 'unknown', '', ''
+    # noinspection PyBroadException
+    try:
+        if _geoIP2HasPrefixLen:
+            # the length counts IPv4 bits even in IPv6 databases
+            record, length = _geoIP2Reader.get_with_prefix_len(ip)
+        else:
+            record, length = _geoIP2Reader.get(ip), 32
+        if record:
+            country = record.get('country', {})
+            result = (country['iso_code'].lower(), country.get('names', {}).get('en'),
+                      record.get('city', {}).get('names', {}).get('en'))
+    except:
+        return result
+    with _geoIP2Lock:
+        if length not in _prefixCache:
+            _prefixCache[length] = {}
+            # a matched network has no more specific network inside it, so the first hit is the answer
+            _prefixLengths[:] = sorted(_prefixCache, reverse=True)
+        network = address >> (32 - length)
+        if network not in _prefixCache[length]:
+            _prefixOrder.append((length, network))
+            if len(_prefixOrder) > PREFIX_CACHE_SIZE:
+                oldLength, oldNetwork = _prefixOrder.popleft()
+                del _prefixCache[oldLength][oldNetwork]
+        _prefixCache[length][network] = result
+    return result
+
+
+def geolookupInit(db=None):
+    """ (re)open db, by default the one findGeoIPDB() finds, memory mapped when possible """
+    global _geoIP2Reader, _geoIP2HasPrefixLen
+    with _geoIP2Lock:
+        _prefixCache.clear()
+        del _prefixLengths[:]
+        _prefixOrder.clear()
+        reader = None
+        if db is None:
+            db = findGeoIPDB()
+        if MaxMindOpenDatabase and db and os.path.isfile(db):
+            reader = MaxMindOpenDatabase(db, mode=GeoIP2ModeMMAP)
+        _geoIP2HasPrefixLen = hasattr(reader, 'get_with_prefix_len')
+        _geoIP2Reader = reader
 
 
 def isUnknownCountryCode(cc):
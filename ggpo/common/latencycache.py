@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import struct
+import threading
+import time
+
+MAGIC = 'GGPOLAT1'
+
+_entry = struct.Struct('!4sHI')
+
+
+class LatencyCache(object):
+    """
+    Round trips measured in earlier sessions, kept on disk.
+
+    Every entry is [ip:4][rtt ms:uint16][unix time:uint32], at most
+    MAX_ENTRIES of them and none older than MAX_AGE, newest kept.  A player
+    with no entry of its own gets the latest round trip measured in its /24,
+    which is usually the same ISP and city; the /24 table is rebuilt from
+    the kept entries whenever some are dropped, so it obeys the same limits.
+    Lookups and record() only touch dicts under a lock; the file is
+    rewritten by a background thread every SAVE_INTERVAL seconds when
+    something changed, and once more on close().
+    """
+
+    MAX_ENTRIES = 20000
+    MAX_AGE = 30 * 24 * 3600
+    SAVE_INTERVAL = 60
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.prefixes = {}
+        self.dirty = False
+        self.closed = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def _pack(ip):
+        try:
+            return socket.inet_aton(ip)
+        except (socket.error, TypeError):
+            return None
+
+    def close(self):
+        self.closed.set()
+        if self.thread:
+            self.thread.join(5)
+            self.thread = None
+
+    def estimate(self, ip):
+        """
+        @return: (rtt ms, unix time measured) for ip, or its /24, or None
+        """
+        key = self._pack(ip)
+        if key is None:
+            return None
+        with self.lock:
+            return self.entries.get(key) or self.prefixes.get(key[:3])
+
+    def load(self):
+        """ read the cache file and start the background writer """
+        oldest = time.time() - self.MAX_AGE
+        try:
+            with open(self.path, 'rb') as f:
+                if f.read(len(MAGIC)) == MAGIC:
+                    data = f.read()
+                    for offset in xrange(0, len(data) - _entry.size + 1, _entry.size):
+                        key, rtt, when = _entry.unpack_from(data, offset)
+                        if when >= oldest:
+                            self._store(key, rtt, when)
+        except (IOError, struct.error):
+            pass
+        if not self.thread:
+            self.thread = threading.Thread(target=self._run, name='LatencyCache')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def record(self, ip, rtt):
+        key = self._pack(ip)
+        if key is None:
+            return
+        with self.lock:
+            self._store(key, min(int(rtt), 0xffff), int(time.time()))
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            oldest = time.time() - self.MAX_AGE
+            entries = sorted(self.entries.iteritems(), key=lambda e: e[1][1], reverse=True)[:self.MAX_ENTRIES]
+            while entries and entries[-1][1][1] < oldest:
+                entries.pop()
+            if len(entries) < len(self.entries):
+                self.entries = {}
+                self.prefixes = {}
+                for key, (rtt, when) in entries:
+                    self._store(key, rtt, when)
+        data = ''.join(_entry.pack(key, rtt, when) for key, (rtt, when) in entries)
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(MAGIC)
+                f.write(data)
+            # windows can't rename over an existing file
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass
+
+    def _run(self):
+        # Event.wait() with a timeout wakes up every few milliseconds on python 2,
+        # sleeping a second at a time still notices close() well within its join
+        due = time.time() + self.SAVE_INTERVAL
+        while not self.closed.is_set():
+            time.sleep(1)
+            if time.time() >= due:
+                self.save()
+                due = time.time() + self.SAVE_INTERVAL
+        self.save()
+
+    def _store(self, key, rtt, when):
+        self.entries[key] = (rtt, when)
+        prefix = key[:3]
+        if when >= self.prefixes.get(prefix, (0, 0))[1]:
+            self.prefixes[prefix] = (rtt, when)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import hmac
+import os
+import socket
+import struct
+import time
+
+
+class PingPayload(object):
+    """
+    Self describing GGPO PING payload.
+
+    Peers answer a PING by echoing everything after "GGPO PING " in their
+    PONG, so the payload can carry what the text secret had to be looked up
+    for: [version:1][player id:uint32][send time, microseconds since start:uint64]
+    followed by MAC_SIZE bytes of SHA-1 over a random per-session key, the
+    peer address and the fields.  The message length is fixed, so the keyed
+    prefix hash is as good as an HMAC here at a fraction of the cost.  A PONG
+    that verifies gives the player and the round trip without any table of
+    secrets, and can't be forged or replayed from another address.
+    """
+
+    VERSION = '\xb1'
+    MAC_SIZE = 6
+    _fields = struct.Struct('!IQ')
+    SIZE = 1 + _fields.size + MAC_SIZE
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.start = clock()
+        self.keyed = hashlib.sha1(os.urandom(16))
+
+    def _mac(self, ip, body):
+        try:
+            ip = socket.inet_aton(ip)
+        except socket.error:
+            pass
+        h = self.keyed.copy()
+        h.update(ip + body)
+        return h.digest()[:self.MAC_SIZE]
+
+    def now(self):
+        """ @return: microseconds since the payload key was made, never negative """
+        return max(0, int((self.clock() - self.start) * 1000000))
+
+    def pack(self, ip, playerId):
+        body = self.VERSION + self._fields.pack(playerId & 0xffffffff, self.now())
+        return body + self._mac(ip, body)
+
+    def unpack(self, payload, ip):
+        """
+        @return: (player id, round trip in seconds) for a genuine echo of one of our payloads from ip, or None
+        """
+        if len(payload) != self.SIZE or payload[0] != self.VERSION:
+            return None
+        body = payload[:-self.MAC_SIZE]
+        if not hmac.compare_digest(self._mac(ip, body), payload[-self.MAC_SIZE:]):
+            return None
+        playerId, sent = self._fields.unpack_from(body, 1)
+        rtt = self.now() - sent
+        if rtt < 0:
+            return None
+        return playerId, rtt / 1000000.0
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import heapq
+import threading
+import time
+
+
+class Probe(object):
+    __slots__ = ('name', 'ip', 'sent', 'attempt', 'secret')
+
+    def __init__(self, name, ip, sent, attempt, secret):
+        self.name = name
+        self.ip = ip
+        self.sent = sent
+        self.attempt = attempt
+        self.secret = secret
+
+
+class PingScheduler(object):
+    """
+    Paces GGPO PING probes to the players of a channel.
+
+    Every known player has a time its next probe is due, kept in a heap of
+    (due, name) entries; rescheduling pushes a new entry and the old one is
+    skipped when it surfaces.  tick() pops only the entries that are due into
+    one ready queue per priority, refills a token bucket of RATE probes per
+    second and spends it on the ready players, most interesting first:
+    players shown in the player list or recently challenged or spectated,
+    then available players, then everyone else.
+    An answered probe makes the player's RTT fresh for the REFRESH interval
+    of its priority.  A player has at most one probe outstanding.  Probes
+    without a PONG after TIMEOUT seconds count as lost, their secret is
+    dropped and the player is retried with an exponential backoff, up to
+    MAX_RETRIES times.
+    """
+
+    RATE = 20
+    BURST = 20
+    TIMEOUT = 3
+    MAX_RETRIES = 2
+    RETRY_DELAY = 2
+    # seconds an answer stays fresh, per priority
+    REFRESH = (15, 30, 60)
+    INTERACTION = 120
+
+    (VISIBLE, AVAILABLE, OTHER) = range(3)
+
+    def __init__(self, send, available, lost=None, clock=time.time):
+        """
+        @param send: callable(name) sending a probe, returns (secret, ip) or None when the player can't be pinged
+        @param available: callable(name) telling if the player is available
+        @param lost: optional callable(name) told about every probe given up on
+        """
+        self.send = send
+        self.available = available
+        self.onLost = lost
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.due = {}
+        # heap of (due, name), an entry is current while due[name] still matches and name isn't ready
+        self.schedule = []
+        # name -> due of the players waiting for a token, queued by priority in queues
+        self.ready = {}
+        self.queues = ([], [], [])
+        self.retries = {}
+        self.outstanding = {}
+        self.visible = frozenset()
+        self.interactions = {}
+        self.tokens = self.BURST
+        self.lastRefill = clock()
+        self.sent = 0
+        self.answered = 0
+        self.lost = 0
+
+    def add(self, name):
+        """ probe a newly joined player as soon as tokens allow, a known player keeps its schedule """
+        with self.lock:
+            if name not in self.due:
+                self._schedule(name, 0)
+
+    def answer(self, name, secret, ip):
+        """
+        @return: rtt in seconds if the PONG matches the probe outstanding for name, or None
+        """
+        now = self.clock()
+        with self.lock:
+            probe = self.outstanding.get(name)
+            if probe is None or probe.secret != secret or probe.ip != ip:
+                return None
+            del self.outstanding[name]
+            self.answered += 1
+            self.retries.pop(name, None)
+            if name in self.due:
+                self._schedule(name, now + self.REFRESH[self.priority(name, now)])
+        return max(0, now - probe.sent)
+
+    def clear(self):
+        with self.lock:
+            self.due.clear()
+            self.schedule = []
+            self.ready.clear()
+            self.queues = ([], [], [])
+            self.retries.clear()
+            self.outstanding.clear()
+            self.interactions.clear()
+
+    def interacted(self, name):
+        """ keep the RTT of a player we are dealing with up to date, and measure it now if it's stale """
+        now = self.clock()
+        with self.lock:
+            self.interactions[name] = now
+            if name in self.ready:
+                heapq.heappush(self.queues[self.VISIBLE], (self.ready[name], name))
+            elif self.due.get(name, 0) > now:
+                self._schedule(name, now)
+
+    def priority(self, name, now):
+        if name in self.visible or now - self.interactions.get(name, -self.INTERACTION) < self.INTERACTION:
+            return self.VISIBLE
+        if self.available(name):
+            return self.AVAILABLE
+        return self.OTHER
+
+    def remove(self, name):
+        with self.lock:
+            self.due.pop(name, None)
+            self.ready.pop(name, None)
+            self.retries.pop(name, None)
+            self.interactions.pop(name, None)
+
+    def setVisible(self, names):
+        with self.lock:
+            self.visible = frozenset(names)
+            # players already waiting move up, the rest get their priority when they become due
+            for name in self.visible:
+                if name in self.ready:
+                    heapq.heappush(self.queues[self.VISIBLE], (self.ready[name], name))
+
+    def stats(self):
+        return ["pings: {} sent, {} answered, {} lost, {} outstanding, {} players tracked".format(
+            self.sent, self.answered, self.lost, len(self.outstanding), len(self.due))]
+
+    def tick(self):
+        """ expire unanswered probes and send the ones the token bucket allows """
+        now = self.clock()
+        with self.lock:
+            lost = self._expire(now)
+        if self.onLost:
+            for name in lost:
+                self.onLost(name)
+        with self.lock:
+            self.tokens = min(self.BURST, self.tokens + (now - self.lastRefill) * self.RATE)
+            self.lastRefill = now
+            if self.tokens < 1:
+                return
+            schedule = self.schedule
+            while schedule and schedule[0][0] <= now:
+                when, name = heapq.heappop(schedule)
+                if self.due.get(name) == when and name not in self.ready:
+                    self.ready[name] = when
+                    heapq.heappush(self.queues[self.priority(name, now)], (when, name))
+            batch = []
+            count = int(self.tokens)
+            for prio, queue in enumerate(self.queues):
+                while queue and len(batch) < count:
+                    when, name = heapq.heappop(queue)
+                    if self.ready.get(name) != when:
+                        continue
+                    current = self.priority(name, now)
+                    if current > prio:
+                        # no longer visible, wait behind the players that are
+                        heapq.heappush(self.queues[current], (when, name))
+                        continue
+                    del self.ready[name]
+                    batch.append((prio, name))
+        for prio, name in batch:
+            result = self.send(name)
+            with self.lock:
+                if name not in self.due:
+                    continue
+                if result is None:
+                    # gone or without an address, addUser() will add it again when it's back
+                    self.due.pop(name, None)
+                    self.retries.pop(name, None)
+                    continue
+                secret, ip = result
+                self.outstanding[name] = Probe(name, ip, now, self.retries.get(name, 0), secret)
+                # not due again until the probe is answered or given up on
+                self._schedule(name, now + self.TIMEOUT + self.REFRESH[prio])
+                self.tokens -= 1
+                self.sent += 1
+
+    def _expire(self, now):
+        """ @return: names of the players whose probes were lost """
+        deadline = now - self.TIMEOUT
+        lost = []
+        for name, probe in self.outstanding.items():
+            if probe.sent > deadline:
+                continue
+            del self.outstanding[name]
+            self.lost += 1
+            if probe.name not in self.due:
+                continue
+            lost.append(probe.name)
+            attempt = probe.attempt + 1
+            if attempt <= self.MAX_RETRIES:
+                self.retries[probe.name] = attempt
+                self._schedule(probe.name, now + self.RETRY_DELAY * 2 ** (attempt - 1))
+            else:
+                self.retries.pop(probe.name, None)
+                self._schedule(probe.name, now + self.REFRESH[self.priority(probe.name, now)])
+        return lost
+
+    def _schedule(self, name, when):
+        self.due[name] = when
+        self.ready.pop(name, None)
+        heapq.heappush(self.schedule, (when, name))
+        if len(self.schedule) > 4 * len(self.due) + 64:
+            # drop the superseded entries once they outnumber the live ones
+            self.schedule = [(w, n) for w, n in self.schedule if self.due.get(n) == w]
+            heapq.heapify(self.schedule)
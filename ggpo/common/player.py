@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
-class Player:
+class Player(object):
+    __slots__ = ('id', 'player', 'ip', 'port', 'city', 'cc', 'country', 'ping', 'lastPingTime', 'loc', 'color',
+                 'spectators', 'state', 'opponent', 'rtt')
     _ID = 0
 
     def __init__(self, **kwargs):
-        self.id = self._ID
-        self.__class__._ID += 1
+        self.id = Player._ID
+        Player._ID += 1
         self.player = ''
         self.ip = ''
         self.port = 6009
@@ -16,4 +18,11 @@ class Player:
         self.loc = ''
         self.color = None
         self.spectators = 0
-        vars(self).update(kwargs)
+        # PlayerStates value while in the channel, None once departed
+        self.state = None
+        self.opponent = ''
+        # RttStats once a ping was answered or lost, ping is its smoothed value,
+        # or a cached estimate from an earlier session until the first answer
+        self.rtt = None
+        for k, v in kwargs.iteritems():
+            setattr(self, k, v)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from ggpo.common.player import Player
+from ggpo.common.playerstate import PlayerStates
+
+
+def _intern(name):
+    # intern() only takes byte strings
+    return intern(name) if type(name) is str else name
+
+
+class PlayerStore(object):
+    """
+    Every known player keyed by name, with indexes by state and by IP.
+
+    A player's state and opponent live on the record itself; byState keeps
+    one dict per state (opponent name for PLAYING, True otherwise) so the
+    controller's available/awayfromkb/playing views are plain lookups.
+    Players who quit keep their record, so ping, country and colour survive
+    a quick rejoin.  Departed records are evicted least recently departed
+    first, in batches once there are a quarter more than MAX_DEPARTED.
+    """
+
+    MAX_DEPARTED = 2000
+    STATES = (PlayerStates.AVAILABLE, PlayerStates.AFK, PlayerStates.PLAYING)
+
+    def __init__(self):
+        self.players = {}
+        self.byState = dict((state, {}) for state in self.STATES)
+        self.byIp = {}
+        # name -> departure tick
+        self.departed = {}
+        self.tick = 0
+        self.evicted = 0
+
+    def __contains__(self, name):
+        return name in self.players
+
+    def __len__(self):
+        return sum(len(d) for d in self.byState.itervalues())
+
+    def add(self, **kwargs):
+        """
+        create the record for kwargs['player'], which must not exist yet
+        @return: Player
+        """
+        name = _intern(kwargs['player'])
+        kwargs['player'] = name
+        p = Player(**kwargs)
+        self.players[name] = p
+        self._indexIp(p)
+        return p
+
+    def get(self, name):
+        return self.players.get(name)
+
+    def isPresent(self, name):
+        p = self.players.get(name)
+        return p is not None and p.state is not None
+
+    def names(self):
+        """ @return: list of the players currently in the channel """
+        names = []
+        for d in self.byState.itervalues():
+            names.extend(d)
+        return names
+
+    def playersAt(self, ip):
+        return [self.players[name] for name in self.byIp.get(ip, ())]
+
+    def reset(self):
+        """ everybody left, a full user list follows """
+        for d in self.byState.itervalues():
+            for name in d:
+                self._depart(self.players[name])
+            d.clear()
+        self._evict()
+
+    def setState(self, name, state, opponent=''):
+        p = self.players.get(name)
+        if p is None:
+            return
+        name = p.player
+        if p.state is not None:
+            del self.byState[p.state][name]
+        index = self.byState.get(state)
+        if index is not None:
+            if p.state is None:
+                self.departed.pop(name, None)
+            p.state = state
+            if state == PlayerStates.PLAYING:
+                p.opponent = opponent
+                index[name] = opponent
+            else:
+                p.opponent = ''
+                index[name] = True
+        else:
+            self._depart(p)
+            self._evict()
+
+    def update(self, p, **kwargs):
+        ip = p.ip
+        for k, v in kwargs.iteritems():
+            setattr(p, k, v)
+        if p.ip != ip:
+            names = self.byIp.get(ip)
+            if names:
+                names.discard(p.player)
+                if not names:
+                    del self.byIp[ip]
+            self._indexIp(p)
+
+    def _depart(self, p):
+        p.state = None
+        p.opponent = ''
+        self.tick += 1
+        self.departed[p.player] = self.tick
+
+    def _evict(self):
+        if len(self.departed) <= self.MAX_DEPARTED + self.MAX_DEPARTED // 4:
+            return
+        oldest = sorted(self.departed, key=self.departed.__getitem__)
+        for name in oldest[:len(oldest) - self.MAX_DEPARTED]:
+            del self.departed[name]
+            p = self.players.pop(name)
+            names = self.byIp.get(p.ip)
+            if names:
+                names.discard(name)
+                if not names:
+                    del self.byIp[p.ip]
+            self.evicted += 1
+
+    def _indexIp(self, p):
+        if p.ip:
+            self.byIp.setdefault(p.ip, set()).add(p.player)
@@ -2,8 +2,173 @@
 import struct
 
 
+class MessageSchema(object):
+    """
+    Wire layout of a message body as an ordered list of (name, type) fields.
+
+    The decoder and encoder are generated once when the schema is created:
+    every stretch of consecutive ints becomes a single precompiled
+    struct.Struct and TLVs are sliced or length prefixed inline, so decoding
+    or encoding a record is one function call instead of one call per field.
+    Payloads too short for the fast path are decoded field by field with the
+    PacketReader, which keeps its truncation semantics.  encode() takes the
+    field values in field order and returns the bytes.
+    """
+    INT = 'int'
+    TLV = 'tlv'
+    REST = 'rest'  # whatever is left of the payload, must be last
+
+    _length = struct.Struct('!I')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = tuple(f for f, _ in fields)
+        self.steps = []
+        run = 0
+        for _, kind in list(fields) + [(None, None)]:
+            if kind == self.INT:
+                run += 1
+                continue
+            if run:
+                self.steps.append((self.INT, struct.Struct('!' + 'I' * run), run))
+                run = 0
+            if kind is not None:
+                self.steps.append((kind, None, 1))
+        self.decode = self._buildDecoder()
+        self.encode = self._buildEncoder()
+
+    def _buildDecoder(self):
+        namespace = {'slow': self.decodeSlow, 'unpackLength': self._length.unpack_from}
+        lines = ['def decode(reader):',
+                 '    data = reader.data',
+                 '    o = reader.offset',
+                 '    n = reader.length']
+        names = []
+        for i, (kind, st, count) in enumerate(self.steps):
+            if kind == self.INT:
+                namespace['st{}'.format(i)] = st.unpack_from
+                values = ['v{}_{}'.format(i, j) for j in range(count)]
+                lines += ['    if n - o < {}:'.format(st.size),
+                          '        return slow(reader)',
+                          '    {}, = st{}(data, o)'.format(', '.join(values), i),
+                          '    o += {}'.format(st.size)]
+                names += values
+            elif kind == self.TLV:
+                value = 'v{}'.format(i)
+                lines += ['    if n - o < 4:',
+                          '        return slow(reader)',
+                          '    l, = unpackLength(data, o)',
+                          '    o += 4',
+                          '    {} = data[o:o + l]'.format(value),
+                          '    o += l']
+                names.append(value)
+            else:
+                value = 'v{}'.format(i)
+                lines += ['    {} = data[o:]'.format(value),
+                          '    o = n']
+                names.append(value)
+        lines += ['    reader.offset = o if o < n else n',
+                  '    return [{}]'.format(', '.join(names))]
+        exec('\n'.join(lines), namespace)
+        return namespace['decode']
+
+    def _buildEncoder(self):
+        namespace = {'packLength': self._length.pack}
+        args = []
+        parts = []
+        for i, (kind, st, count) in enumerate(self.steps):
+            if kind == self.INT:
+                namespace['st{}'.format(i)] = st.pack
+                values = ['v{}_{}'.format(i, j) for j in range(count)]
+                parts.append('st{}({})'.format(i, ', '.join(values)))
+                args += values
+            elif kind == self.TLV:
+                value = 'v{}'.format(i)
+                parts += ['packLength(len({}))'.format(value), value]
+                args.append(value)
+            else:
+                value = 'v{}'.format(i)
+                parts.append(value)
+                args.append(value)
+        lines = ['def encode({}):'.format(', '.join(args)),
+                 "    return ''.join(({}))".format(''.join(p + ', ' for p in parts))]
+        exec('\n'.join(lines), namespace)
+        return namespace['encode']
+
+    def decodeSlow(self, reader):
+        """
+        read every field from a Protocol.PacketReader, one at a time
+        @param reader:
+        @return: list of values in field order
+        """
+        values = []
+        for kind, st, count in self.steps:
+            if kind is self.INT:
+                values.extend(reader.readInts(st, count))
+            elif kind is self.TLV:
+                values.append(reader.readTLV())
+            else:
+                values.append(reader.readRest())
+        return values
+
+
+_INT, _TLV, _REST = MessageSchema.INT, MessageSchema.TLV, MessageSchema.REST
+
+
 # noinspection PyClassHasNoInit
 class Protocol:
+    class PacketReader(object):
+        """
+        Cursor over a received payload.  Fields are read in place through an
+        offset instead of returning a copy of the rest of the payload after
+        every field.  Reading past the end behaves like extractInt/extractTLV:
+        missing ints are 0, short values are truncated.
+
+        Buffers other than str are copied once through a memoryview; slicing a
+        str directly is several times cheaper than slicing a memoryview and
+        converting the result back.
+        """
+        _int = struct.Struct("!I")
+
+        def __init__(self, data):
+            if not isinstance(data, str):
+                data = memoryview(data).tobytes()
+            self.data = data
+            self.offset = 0
+            self.length = len(data)
+
+        def readInt(self):
+            offset = self.offset
+            if self.length - offset < 4:
+                self.offset = self.length
+                return 0
+            self.offset = offset + 4
+            return self._int.unpack_from(self.data, offset)[0]
+
+        def readTLV(self):
+            length = self.readInt()
+            start = self.offset
+            self.offset = min(start + length, self.length)
+            return self.data[start:self.offset]
+
+        def readInts(self, st, count):
+            offset = self.offset
+            if self.length - offset < st.size:
+                return [self.readInt() for _ in xrange(count)]
+            self.offset = offset + st.size
+            return st.unpack_from(self.data, offset)
+
+        def readRest(self):
+            value = self.rest()
+            self.offset = self.length
+            return value
+
+        def remaining(self):
+            return self.length - self.offset
+
+        def rest(self):
+            return self.data[self.offset:]
+
     # IN BAND
     WELCOME = 0x0
     AUTH = 0x1
@@ -65,6 +230,48 @@ class Protocol:
         0xffffffff: 'JOINING_A_CHANNEL',
     }
 
+    # Message layouts.  Records repeated inside a reply (users, channels, state
+    # changes) have their own schema, read in a loop after the reply header.
+    Schemas = dict((schema.name, schema) for schema in [
+        MessageSchema('AUTH', [('username', _TLV), ('password', _TLV), ('port', _INT), ('version', _INT),
+                               ('os', _INT), ('utcoffset', _TLV)]),
+        MessageSchema('STATUS', [('status', _INT)]),
+        MessageSchema('MOTD', [('status', _INT), ('channel', _TLV), ('topic', _TLV), ('msg', _TLV)]),
+        MessageSchema('LIST_CHANNELS', [('status1', _INT), ('status2', _INT)]),
+        MessageSchema('CHANNEL', [('room', _TLV), ('romname', _TLV), ('title', _TLV), ('users', _INT),
+                                  ('port', _INT), ('index', _INT)]),
+        MessageSchema('LIST_USERS', [('status', _INT), ('status2', _INT)]),
+        MessageSchema('USER', [('player', _TLV), ('state', _INT), ('opponent', _TLV), ('ip', _TLV),
+                               ('unknown1', _INT), ('unknown2', _INT), ('city', _TLV), ('cc', _TLV),
+                               ('country', _TLV), ('port', _INT), ('color', _INT), ('spectators', _INT)]),
+        MessageSchema('PLAYER_STATE_CHANGE', [('count', _INT)]),
+        MessageSchema('STATE_CHANGE_HEADER', [('code', _INT), ('player', _TLV)]),
+        MessageSchema('STATE_CHANGE', [('state', _INT), ('opponent', _TLV), ('ip', _TLV), ('unknown1', _INT),
+                                       ('unknown2', _INT), ('city', _TLV), ('cc', _TLV), ('country', _TLV),
+                                       ('marker', _INT), ('color', _INT)]),
+        MessageSchema('CHAT_DATA', [('name', _TLV), ('msg', _TLV)]),
+        MessageSchema('CHALLENGE_RECEIVED', [('name', _TLV), ('rom', _TLV)]),
+        MessageSchema('CHALLENGE_DECLINED', [('name', _TLV)]),
+        MessageSchema('CHALLENGE_RETRACTED', [('name', _TLV)]),
+        MessageSchema('SPECTATE_GRANTED', [('p1', _TLV), ('p2', _TLV), ('quark', _TLV)]),
+        MessageSchema('EXTENSION', [('body', _TLV)]),
+        MessageSchema('EXTENSION_BODY', [('extID', _INT), ('prefix', _INT), ('params', _REST)]),
+    ])
+
+    @staticmethod
+    def decode(name, data):
+        """
+        decode a whole payload with the named schema
+        @param name: key in Protocol.Schemas
+        @param data:
+        @return: list of values in field order
+        """
+        return Protocol.Schemas[name].decode(Protocol.PacketReader(data))
+
+    @staticmethod
+    def encode(name, *values):
+        return Protocol.Schemas[name].encode(*values)
+
     @staticmethod
     def codeToString(code):
         if code in Protocol.AllReverseMap:
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque, OrderedDict
+
+
+class PendingRequest(object):
+    __slots__ = ('seq', 'command', 'sent', 'callback')
+
+    def __init__(self, seq, command, sent, callback=None):
+        self.seq = seq
+        self.command = command
+        self.sent = sent
+        self.callback = callback
+
+
+class RequestTracker(object):
+    """
+    In band requests waiting for a reply, keyed by sequence number.
+
+    Every entry remembers when it was sent and an optional callback to run
+    with the reply.  Entries older than timeout seconds are handed back by
+    expire(), and the round trip of every answered request is kept in a
+    rolling window of SAMPLES per command for percentile queries.
+    """
+
+    SAMPLES = 200
+
+    def __init__(self, timeout=30, clock=time.time):
+        self.timeout = timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        # sequence numbers only grow, so insertion order is also send order
+        self.pending = OrderedDict()
+        self.latencies = {}
+        self.answered = 0
+        self.expired = 0
+
+    def __contains__(self, seq):
+        return seq in self.pending
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, seq, command, callback=None):
+        with self.lock:
+            self.pending[seq] = PendingRequest(seq, command, self.clock(), callback)
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+
+    def expire(self, now=None):
+        """
+        drop every request that has been waiting longer than the timeout
+        @return: list of expired PendingRequest
+        """
+        if now is None:
+            now = self.clock()
+        deadline = now - self.timeout
+        expired = []
+        with self.lock:
+            while self.pending:
+                seq, request = next(self.pending.iteritems())
+                if request.sent > deadline:
+                    break
+                del self.pending[seq]
+                expired.append(request)
+            self.expired += len(expired)
+        return expired
+
+    def percentiles(self, command, points=(50, 90, 99)):
+        """
+        @return: list of latencies in seconds for the given percentiles, None without samples
+        """
+        with self.lock:
+            samples = sorted(self.latencies.get(command, ()))
+        if not samples:
+            return None
+        last = len(samples) - 1
+        return [samples[min(last, int(round(last * p / 100.0)))] for p in points]
+
+    def pop(self, seq):
+        """
+        remove an answered request and record its round trip
+        @return: PendingRequest or None if seq was not pending
+        """
+        now = self.clock()
+        with self.lock:
+            request = self.pending.pop(seq, None)
+            if request is None:
+                return None
+            window = self.latencies.get(request.command)
+            if window is None:
+                window = self.latencies[request.command] = deque(maxlen=self.SAMPLES)
+            window.append(max(0, now - request.sent))
+            self.answered += 1
+        return request
+
+    def samples(self, command):
+        return len(self.latencies.get(command, ()))
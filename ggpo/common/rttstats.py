@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from array import array
+
+
+class RttStats(object):
+    """
+    Round trip statistics of one player.
+
+    Keeps the last SAMPLES round trips in milliseconds in a fixed array and
+    the outcome of the last WINDOW probes as bits of an int, set for a lost
+    probe.  The smoothed RTT and jitter are running averages in the style of
+    TCP's SRTT and RTP's interarrival jitter, so one late PONG moves them by
+    a fraction instead of replacing the value shown.
+    """
+    __slots__ = ('samples', 'count', 'srtt', 'jitter', 'last', 'outcomes', 'probes')
+
+    SAMPLES = 16
+    WINDOW = 32
+    ALPHA = 1 / 8.0
+    JITTER_GAIN = 1 / 16.0
+
+    def __init__(self):
+        self.samples = array('H', [0] * self.SAMPLES)
+        self.count = 0
+        self.srtt = None
+        self.jitter = 0.0
+        self.last = None
+        self.outcomes = 0
+        self.probes = 0
+
+    def add(self, rtt):
+        """ record an answered probe, rtt in milliseconds """
+        rtt = min(int(rtt), 0xffff)
+        self.samples[self.count % self.SAMPLES] = rtt
+        self.count += 1
+        if self.srtt is None:
+            self.srtt = float(rtt)
+        else:
+            self.srtt += (rtt - self.srtt) * self.ALPHA
+        if self.last is not None:
+            self.jitter += (abs(rtt - self.last) - self.jitter) * self.JITTER_GAIN
+        self.last = rtt
+        self._outcome(0)
+
+    def loss(self):
+        """ @return: fraction of the recent probes that were lost """
+        if not self.probes:
+            return 0.0
+        return bin(self.outcomes).count('1') / float(self.probes)
+
+    def lost(self):
+        """ record a probe that was never answered """
+        self._outcome(1)
+
+    def minimum(self):
+        if not self.count:
+            return None
+        return min(self.samples[:min(self.count, self.SAMPLES)])
+
+    def smoothed(self):
+        """ @return: smoothed RTT in whole milliseconds, None before the first answer """
+        if self.srtt is None:
+            return None
+        return int(round(self.srtt))
+
+    def _outcome(self, bit):
+        self.outcomes = ((self.outcomes << 1) | bit) & ((1 << self.WINDOW) - 1)
+        self.probes = min(self.probes + 1, self.WINDOW)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 import platform
 
-__all__ = ['IS_WINDOWS', 'IS_OSX', 'IS_LINUX', 'IS_WINDOWS_XP', 'Phonon', 'GeoIP2Reader', 'winsound']
+__all__ = ['IS_WINDOWS', 'IS_OSX', 'IS_LINUX', 'IS_WINDOWS_XP', 'Phonon', 'GeoIP2Reader', 'GeoIP2ModeMMAP',
+           'MaxMindOpenDatabase', 'winsound']
 
 IS_WINDOWS = False
 IS_OSX = False
@@ -30,6 +31,13 @@ try:
 except ImportError:
     pass
 
+GeoIP2ModeMMAP = None
+MaxMindOpenDatabase = None
+try:
+    from maxminddb import MODE_MMAP as GeoIP2ModeMMAP, open_database as MaxMindOpenDatabase
+except ImportError:
+    pass
+
 winsound = None
 if IS_WINDOWS:
     try:
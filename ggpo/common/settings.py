@@ -49,6 +49,12 @@ class Settings:
     DISABLE_AUTO_ANNOUNCE_UNSUPPORTED = 'disableAutoAnnounceUnsupported'
     CHANNELS_FAVORITES = 'channelsFavorites'
     FILTER_FAVORITES = 'filterFavorites'
+    REQUEST_TIMEOUT = 'requestTimeout'
+    WIRE_CAPTURE = 'wireCapture'
+    SERVER_HOST = 'serverHost'
+    TEXT_PING = 'textPing'
+    CHAT_HISTORY_LINES = 'chatHistoryLines'
+    STALL_MONITOR = 'stallMonitor'
 
     _settings = QSettings(os.path.join(os.path.abspath(os.path.expanduser("~")), 'ggpo-ng.ini'), QSettings.IniFormat)
 
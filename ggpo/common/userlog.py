@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import Queue
+import sqlite3
+import threading
+import time
+from ggpo.common.util import logdebug, loguser
+
+CHAT, GAME = 'chat', 'game'
+
+
+def _text(s):
+    # sqlite wants unicode, names and undecodable messages arrive as byte strings
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s or u''
+
+
+class UserLog(object):
+    """
+    Chat and play history, written off the network thread.
+
+    write() only puts the line on a queue.  A background thread, started by
+    the first write() or search(), appends everything queued to the rotating
+    fightcade.log as before and to an SQLite archive, one transaction per
+    batch.  The archive has a full text index when the sqlite build has
+    FTS4 and falls back to LIKE otherwise.  search() is queued behind the
+    pending writes and its callback runs on the writer thread with the
+    newest MAX_RESULTS matches, oldest first.
+    """
+
+    MAX_RESULTS = 20
+    BATCH = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.fts = False
+
+    def close(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread:
+            self.queue.put(None)
+            thread.join(5)
+
+    def search(self, text, callback):
+        """
+        callback(list of (unix time, kind, channel, name, text)), called from the writer thread
+        """
+        self._start()
+        self.queue.put((self._search, text, callback))
+
+    def write(self, kind, channel, name, text, line):
+        """ line goes to the text log, the other fields to the archive """
+        self._start()
+        self.queue.put((self._insert, (time.time(), kind, _text(channel), _text(name), _text(text)), line))
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS log '
+                   '(id INTEGER PRIMARY KEY, time REAL, kind TEXT, channel TEXT, name TEXT, text TEXT)')
+        try:
+            db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS logtext USING fts4(text)')
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        db.commit()
+        return db
+
+    def _insert(self, db, row, line):
+        if line:
+            loguser().info(line)
+        if db:
+            cursor = db.execute('INSERT INTO log (time, kind, channel, name, text) VALUES (?, ?, ?, ?, ?)', row)
+            if self.fts:
+                db.execute('INSERT INTO logtext (docid, text) VALUES (?, ?)', (cursor.lastrowid, row[4]))
+
+    def _query(self, db, columns, text):
+        if self.fts:
+            # a phrase query, so user input can't be FTS syntax
+            return db.execute(columns + 'JOIN logtext ON logtext.docid = log.id WHERE logtext MATCH ? '
+                              'ORDER BY log.id DESC LIMIT ?',
+                              (u'"{}"'.format(_text(text).replace(u'"', u'""')), self.MAX_RESULTS)).fetchall()
+        pattern = u'%{}%'.format(_text(text).replace(u'\\', u'\\\\').replace(u'%', u'\\%').replace(u'_', u'\\_'))
+        return db.execute(columns + "WHERE log.text LIKE ? ESCAPE '\\' ORDER BY log.id DESC LIMIT ?",
+                          (pattern, self.MAX_RESULTS)).fetchall()
+
+    def _run(self):
+        try:
+            db = self._connect()
+        except sqlite3.Error:
+            # keep the text log going without an archive
+            db = None
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.BATCH:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            for item in items:
+                if item is None:
+                    break
+                func, arg, extra = item
+                try:
+                    func(db, arg, extra)
+                except Exception:
+                    logdebug().exception('User log writer failed')
+            if db:
+                try:
+                    db.commit()
+                except sqlite3.Error:
+                    pass
+            if None in items:
+                break
+        if db:
+            db.close()
+
+    def _search(self, db, text, callback):
+        rows = []
+        if db:
+            columns = 'SELECT log.time, log.kind, log.channel, log.name, log.text FROM log '
+            try:
+                rows = self._query(db, columns, text)
+            except sqlite3.Error:
+                pass
+            rows.reverse()
+        callback(rows)
+
+    def _start(self):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, name='UserLog')
+                self.thread.daemon = True
+                self.thread.start()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import socket
+import struct
+import threading
+import time
+
+MAGIC = 'GGPOCAP1'
+
+(TCP_IN, TCP_OUT, UDP_IN, UDP_OUT, TCP_OPEN) = range(1, 6)
+
+_record = struct.Struct('!BdI')
+_address = struct.Struct('!4sH')
+
+
+def packAddress(addr):
+    try:
+        ip = socket.inet_aton(addr[0])
+    except socket.error:
+        ip = '\0\0\0\0'
+    return _address.pack(ip, addr[1])
+
+
+def unpackAddress(data):
+    ip, port = _address.unpack_from(data)
+    return socket.inet_ntoa(ip), port
+
+
+class WireRecorder(object):
+    """
+    Writes raw lobby traffic to a capture file.
+
+    Every record is [kind:uint8][seconds since start:double][length:uint32]
+    followed by the data: received TCP chunks as they came off the socket,
+    outbound TCP frames, and UDP datagrams prefixed with the packed peer
+    address.  A TCP_OPEN record, just the packed server address, marks the
+    start of every lobby connection so a replay knows where the byte stream
+    of one connection ends and the next begins.  Timestamps never go
+    backwards even if the wall clock does.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fileobj = open(path, 'wb')
+        self.fileobj.write(MAGIC)
+        self.start = time.time()
+        self.last = 0.0
+        self.records = 0
+
+    def close(self):
+        with self.lock:
+            if self.fileobj:
+                self.fileobj.close()
+                self.fileobj = None
+
+    def record(self, kind, data, addr=None):
+        if addr is not None:
+            data = packAddress(addr) + data
+        with self.lock:
+            if not self.fileobj:
+                return
+            self.last = max(self.last, time.time() - self.start)
+            self.fileobj.write(_record.pack(kind, self.last, len(data)))
+            self.fileobj.write(data)
+            self.records += 1
+
+
+def readCapture(path):
+    """
+    @return: generator of (kind, timestamp, data, addr) records, addr is None for TCP_IN and TCP_OUT
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a wire capture'.format(path))
+        while True:
+            header = f.read(_record.size)
+            if len(header) < _record.size:
+                return
+            kind, timestamp, length = _record.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            addr = None
+            if kind in (UDP_IN, UDP_OUT, TCP_OPEN):
+                addr = unpackAddress(data)
+                data = data[_address.size:]
+            yield kind, timestamp, data, addr
+
+
+def replayCapture(controller, path, realtime=False):
+    """
+    push a capture through a controller without touching the network
+    @param controller: a Controller(offline=True), it can be reused for several replays
+    @param realtime: keep the recorded pacing instead of replaying as fast as possible
+    @return: dict of counters and the elapsed time
+    """
+    stats = dict(records=0, tcpBytes=0, requests=0, datagrams=0, connections=0, elapsed=0.0)
+    # drop whatever a previous replay left half decoded or unanswered
+    controller.tcpDecoder.reset()
+    controller.pendingRequests.clear()
+    start = time.time()
+    for kind, timestamp, data, addr in readCapture(path):
+        if realtime:
+            delay = timestamp - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        if kind == TCP_IN:
+            controller.handleTcpResponse(data)
+            stats['tcpBytes'] += len(data)
+        elif kind == TCP_OUT and len(data) >= 12:
+            # register our requests so the in band replies are matched like they were live,
+            # fire and forget ones are never answered and just stay pending
+            length, seq, command = struct.unpack_from('!III', data)
+            controller.pendingRequests.add(seq, command)
+            stats['requests'] += 1
+        elif kind == TCP_OPEN:
+            # a new connection, after a channel switch for instance, starts a fresh frame stream
+            controller.tcpDecoder.reset()
+            controller.pendingRequests.clear()
+            stats['connections'] += 1
+        elif kind == UDP_IN:
+            controller.handleUdpResponse(data, addr)
+            stats['datagrams'] += 1
+        stats['records'] += 1
+    stats['elapsed'] = time.time() - start
+    return stats
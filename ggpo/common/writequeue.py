@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import errno
+import socket
+import threading
+from collections import deque
+
+_WOULDBLOCK = set([errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)])
+
+
+class WriteQueue(object):
+    """
+    Outbound frames waiting to be written to a non-blocking socket.
+
+    Frames queued back to back are coalesced into a single send() of up to
+    MAX_WRITE bytes.  A partial write keeps the unsent tail at the head of the
+    queue, and EAGAIN just leaves everything queued until the socket becomes
+    writable again.  While corked, frames are only queued, which lets a burst
+    of requests go out in one write.
+    """
+
+    MAX_WRITE = 65536
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.frames = deque()
+        self.queuedBytes = 0
+        self.corked = 0
+        self.framesSent = 0
+        self.bytesSent = 0
+        self.writes = 0
+
+    def bytesInFlight(self):
+        return self.queuedBytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.queuedBytes = 0
+
+    def cork(self):
+        with self.lock:
+            self.corked += 1
+
+    def depth(self):
+        return len(self.frames)
+
+    def flush(self, sock):
+        """
+        write as much of the queue as the socket accepts
+        @param sock: non-blocking socket
+        @return: True when the queue is empty, False if the socket is full
+        @raise socket.error: on anything but EAGAIN/EINTR
+        """
+        with self.lock:
+            if self.corked:
+                return not self.frames
+            while self.frames:
+                data = self._coalesce()
+                try:
+                    sent = sock.send(data)
+                except socket.error, ex:
+                    if ex.errno in _WOULDBLOCK:
+                        return False
+                    raise
+                self.writes += 1
+                self.bytesSent += sent
+                self._consume(sent)
+                if sent < len(data):
+                    return False
+            return True
+
+    def push(self, frame):
+        with self.lock:
+            self.frames.append(frame)
+            self.queuedBytes += len(frame)
+
+    def uncork(self):
+        with self.lock:
+            if self.corked:
+                self.corked -= 1
+
+    def _coalesce(self):
+        if len(self.frames) == 1:
+            return self.frames[0]
+        parts = []
+        size = 0
+        for frame in self.frames:
+            if parts and size + len(frame) > self.MAX_WRITE:
+                break
+            parts.append(frame)
+            size += len(frame)
+        return ''.join(parts)
+
+    def _consume(self, sent):
+        self.queuedBytes -= sent
+        while sent:
+            frame = self.frames[0]
+            if sent >= len(frame):
+                self.frames.popleft()
+                self.framesSent += 1
+                sent -= len(frame)
+            else:
+                self.frames[0] = frame[sent:]
+                sent = 0
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+from collections import deque, OrderedDict
+from PyQt4 import QtCore, QtGui
+from PyQt4.QtCore import Qt
+
+
+class ChatLine(object):
+    __slots__ = ('html', 'width', 'height')
+
+    def __init__(self, html):
+        self.html = html
+        # width the line was last painted at and its height there, the height stands in
+        # as a guess at other widths until the line is painted again, 0 if never painted
+        self.width = -1
+        self.height = 0
+
+
+class ChatHistoryModel(QtCore.QAbstractListModel):
+    """
+    The last maxLines chat lines as HTML fragments.
+
+    Lines live in a ring buffer; appending to a full buffer drops the oldest
+    line with a proper row removal so views keep their scroll position.
+    """
+
+    DEFAULT_MAX_LINES = 2000
+
+    def __init__(self, maxLines=DEFAULT_MAX_LINES, parent=None):
+        super(ChatHistoryModel, self).__init__(parent)
+        self.lines = deque()
+        self.maxLines = maxLines
+
+    def append(self, html):
+        self.extend([html])
+
+    def clear(self):
+        self.beginResetModel()
+        self.lines.clear()
+        self.endResetModel()
+
+    def data(self, index, role=None):
+        if index.isValid() and 0 <= index.row() < len(self.lines):
+            if role == Qt.DisplayRole:
+                return self.lines[index.row()].html
+
+    def extend(self, fragments):
+        fragments = fragments[-self.maxLines:]
+        overflow = len(self.lines) + len(fragments) - self.maxLines
+        if overflow > 0:
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, overflow - 1)
+            for _ in xrange(overflow):
+                self.lines.popleft()
+            self.endRemoveRows()
+        if fragments:
+            first = len(self.lines)
+            self.beginInsertRows(QtCore.QModelIndex(), first, first + len(fragments) - 1)
+            self.lines.extend(ChatLine(html) for html in fragments)
+            self.endInsertRows()
+
+    def line(self, row):
+        return self.lines[row]
+
+    def rowCount(self, parent=None, *args, **kwargs):
+        if parent is not None and parent.isValid():
+            return 0
+        return len(self.lines)
+
+    def setMaxLines(self, maxLines):
+        self.maxLines = max(1, maxLines)
+        overflow = len(self.lines) - self.maxLines
+        if overflow > 0:
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, overflow - 1)
+            for _ in xrange(overflow):
+                self.lines.popleft()
+            self.endRemoveRows()
+
+
+class ChatHistoryDelegate(QtGui.QStyledItemDelegate):
+    """
+    Draws a chat line with QTextDocument.
+
+    Only painted lines are laid out.  sizeHint() answers from the height
+    kept on the line, or a one line guess for a line that was never painted,
+    so laying out the view doesn't measure the whole history on first show
+    or on every width change.  paint() measures the line at its width and
+    emits sizeHintChanged when the guess was wrong.  The documents of the
+    most recently painted lines are kept for hit testing and repaints.
+    """
+
+    DOCUMENTS = 200
+    MARGIN = 2
+
+    def __init__(self, parent=None):
+        super(ChatHistoryDelegate, self).__init__(parent)
+        self.documents = OrderedDict()
+
+    def document(self, line, font, width):
+        key = id(line)
+        doc = self.documents.pop(key, None)
+        if doc is None or doc[0] is not line:
+            textDoc = QtGui.QTextDocument()
+            textDoc.setDocumentMargin(self.MARGIN)
+            textDoc.setDefaultFont(font)
+            textDoc.setHtml(line.html)
+            doc = (line, textDoc)
+        else:
+            doc[1].setDefaultFont(font)
+        doc[1].setTextWidth(width)
+        self.documents[key] = doc
+        if len(self.documents) > self.DOCUMENTS:
+            self.documents.popitem(last=False)
+        return doc[1]
+
+    def invalidate(self):
+        self.documents.clear()
+
+    def paint(self, painter, option, index):
+        line = index.model().line(index.row())
+        doc = self.document(line, option.font, option.rect.width())
+        if line.width != option.rect.width():
+            line.width = option.rect.width()
+            height = int(doc.size().height())
+            if height != line.height:
+                line.height = height
+                # noinspection PyUnresolvedReferences
+                self.sizeHintChanged.emit(index)
+        painter.save()
+        if option.state & QtGui.QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        painter.translate(option.rect.topLeft())
+        ctx = QtGui.QAbstractTextDocumentLayout.PaintContext()
+        ctx.palette = option.palette
+        if option.state & QtGui.QStyle.State_Selected:
+            ctx.palette.setColor(QtGui.QPalette.Text, option.palette.color(QtGui.QPalette.HighlightedText))
+        ctx.clip = QtCore.QRectF(0, 0, option.rect.width(), option.rect.height())
+        painter.setClipRect(ctx.clip)
+        doc.documentLayout().draw(painter, ctx)
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        line = index.model().line(index.row())
+        width = option.rect.width()
+        if width <= 0 and option.widget:
+            width = option.widget.viewport().width()
+        height = line.height
+        if not height:
+            height = QtGui.QFontMetrics(option.font).lineSpacing() + 2 * self.MARGIN
+        return QtCore.QSize(width, height)
+
+
+class ChatHistoryView(QtGui.QListView):
+    """
+    Chat history that only lays out the lines on screen.
+
+    Stands in for the QTextBrowser it replaced: append(), clear(), setHtml()
+    and the anchorClicked(QUrl) signal work the same.  Whole lines can be
+    selected and copied as plain text.
+
+    Lines are queued by post(), append() and setHtml() go through it too so
+    lines keep their order; everything posted before control returns to the
+    event loop goes in as one row insertion with one scroll, at most
+    MAX_LINES_PER_FLUSH lines per pass so a flood can't stall the window.
+    While the view is scrolled to the bottom it stays there when lines grow
+    to their measured height.
+    """
+
+    MAX_LINES_PER_FLUSH = 200
+
+    anchorClicked = QtCore.pyqtSignal(QtCore.QUrl)
+
+    def __init__(self, parent=None):
+        super(ChatHistoryView, self).__init__(parent)
+        self.pending = []
+        self.atBottom = True
+        self.flushTimer = QtCore.QTimer(self)
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.setInterval(0)
+        self.flushTimer.timeout.connect(self.flushPending)
+        self.historyModel = ChatHistoryModel(parent=self)
+        self.delegate = ChatHistoryDelegate(self)
+        self.setModel(self.historyModel)
+        self.setItemDelegate(self.delegate)
+        self.setSelectionMode(QtGui.QAbstractItemView.ExtendedSelection)
+        self.setVerticalScrollMode(QtGui.QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setResizeMode(QtGui.QListView.Adjust)
+        # measure long histories a batch at a time instead of in one go
+        self.setLayoutMode(QtGui.QListView.Batched)
+        self.setBatchSize(100)
+        self.setWordWrap(True)
+        self.setMouseTracking(True)
+        self.verticalScrollBar().valueChanged.connect(self.onScrolled)
+        self.verticalScrollBar().rangeChanged.connect(self.onScrollRangeChanged)
+        self.setContextMenuPolicy(Qt.ActionsContextMenu)
+        copyAction = QtGui.QAction("Copy", self)
+        copyAction.setShortcut(QtGui.QKeySequence.Copy)
+        copyAction.setShortcutContext(Qt.WidgetShortcut)
+        copyAction.triggered.connect(self.copy)
+        self.addAction(copyAction)
+        selectAllAction = QtGui.QAction("Select All", self)
+        selectAllAction.triggered.connect(self.selectAll)
+        self.addAction(selectAllAction)
+
+    def anchorAt(self, pos):
+        index = self.indexAt(pos)
+        if not index.isValid():
+            return None
+        rect = self.visualRect(index)
+        doc = self.delegate.document(self.historyModel.line(index.row()), self.font(), rect.width())
+        anchor = doc.documentLayout().anchorAt(QtCore.QPointF(pos - rect.topLeft()))
+        return anchor or None
+
+    def append(self, html):
+        self.post(html)
+
+    def changeEvent(self, evt):
+        if evt.type() == QtCore.QEvent.FontChange:
+            self.delegate.invalidate()
+            for line in self.historyModel.lines:
+                line.width = -1
+            self.scheduleDelayedItemsLayout()
+        super(ChatHistoryView, self).changeEvent(evt)
+
+    def clear(self):
+        self.flushTimer.stop()
+        self.pending = []
+        self.delegate.invalidate()
+        self.historyModel.clear()
+
+    def copy(self):
+        rows = sorted(index.row() for index in self.selectedIndexes())
+        if rows:
+            text = []
+            for row in rows:
+                doc = QtGui.QTextDocument()
+                doc.setHtml(self.historyModel.line(row).html)
+                text.append(doc.toPlainText())
+            QtGui.QApplication.clipboard().setText('\n'.join(text))
+
+    def extend(self, fragments):
+        """ append lines, following the conversation if the view was scrolled to the bottom """
+        scrollbar = self.verticalScrollBar()
+        atBottom = scrollbar.value() >= scrollbar.maximum()
+        self.historyModel.extend(fragments)
+        if atBottom:
+            self.scrollToBottom()
+
+    def flushPending(self):
+        pending = self.pending
+        # lines that would fall out of the history right away are never laid out
+        if len(pending) > self.historyModel.maxLines:
+            del pending[:-self.historyModel.maxLines]
+        batch = pending[:self.MAX_LINES_PER_FLUSH]
+        del pending[:len(batch)]
+        self.extend(batch)
+        if pending:
+            self.flushTimer.start()
+
+    def mouseMoveEvent(self, evt):
+        if self.anchorAt(evt.pos()):
+            self.viewport().setCursor(Qt.PointingHandCursor)
+        else:
+            self.viewport().unsetCursor()
+        super(ChatHistoryView, self).mouseMoveEvent(evt)
+
+    def mouseReleaseEvent(self, evt):
+        if evt.button() == Qt.LeftButton:
+            anchor = self.anchorAt(evt.pos())
+            if anchor:
+                # noinspection PyUnresolvedReferences
+                self.anchorClicked.emit(QtCore.QUrl(anchor))
+        super(ChatHistoryView, self).mouseReleaseEvent(evt)
+
+    def onScrollRangeChanged(self, minimum, maximum):
+        if self.atBottom:
+            self.verticalScrollBar().setValue(maximum)
+
+    def onScrolled(self, value):
+        self.atBottom = value >= self.verticalScrollBar().maximum()
+
+    def post(self, html):
+        self.pending.append(html)
+        if not self.flushTimer.isActive():
+            self.flushTimer.start()
+
+    def resizeEvent(self, evt):
+        super(ChatHistoryView, self).resizeEvent(evt)
+        # heights depend on the width, the delegate measures again lazily
+        self.scheduleDelayedItemsLayout()
+
+    def setHtml(self, html):
+        self.clear()
+        self.append(html)
+
+    def setMaxLines(self, maxLines):
+        self.historyModel.setMaxLines(maxLines)
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from bisect import bisect_left
 from PyQt4.QtCore import Qt, QAbstractItemModel, QModelIndex, QEvent
 from PyQt4.QtGui import QLineEdit, QCompleter
 from ggpo.common.cliclient import CLI
@@ -6,13 +7,66 @@ from ggpo.common.playerstate import PlayerStates
 
 
 class PlayerNameCompletionModel(QAbstractItemModel):
+    """
+    Player names and CLI commands, filtered by prefix for the completer.
+
+    Everything is kept in one list of (case folded key, text) sorted by key,
+    so the matches of a prefix are the contiguous slice found with two
+    bisections.  Commands are indexed with and without their leading slash.
+    Joins and quits are queued and applied by applyPendingChanges(), at the
+    latest before the next filter; players joining or leaving while a filter
+    is set are inserted into or removed from the visible rows with the
+    matching row notifications.
+    """
+
     def __init__(self, parent=None):
         super(PlayerNameCompletionModel, self).__init__(parent)
         self.controller = None
-        self._prefix = ''
-        self._data = CLI.commands.keys()
-        self._filtered = self._data
-        self._rowcount = len(self._data)
+        self._prefix = u''
+        self._names = set()
+        self._index = []
+        self._first = 0
+        self._rowcount = 0
+        self._pending = []
+        self.rebuild([])
+
+    @staticmethod
+    def fold(text):
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        return text.lower()
+
+    @classmethod
+    def keys(cls, text):
+        key = cls.fold(text)
+        if key.startswith('/'):
+            return [key, key[1:]]
+        return [key]
+
+    def add(self, name):
+        if name in self._names:
+            return
+        self._names.add(name)
+        for key in self.keys(name):
+            pos = bisect_left(self._index, (key, name))
+            if key.startswith(self._prefix):
+                row = pos - self._first
+                self.beginInsertRows(QModelIndex(), row, row)
+                self._index.insert(pos, (key, name))
+                self._rowcount += 1
+                self.endInsertRows()
+            else:
+                self._index.insert(pos, (key, name))
+                if key < self._prefix:
+                    self._first += 1
+
+    def applyPendingChanges(self):
+        pending, self._pending = self._pending, []
+        for name, state in pending:
+            if state == PlayerStates.QUIT:
+                self.remove(name)
+            else:
+                self.add(name)
 
     def columnCount(self, parent=None, *args, **kwargs):
         return 1
@@ -22,7 +76,7 @@ class PlayerNameCompletionModel(QAbstractItemModel):
             row = index.row()
             col = index.column()
             if col == 0 and 0 <= row < self.rowCount():
-                return self._filtered[row]
+                return self._index[self._first + row][1]
 
     def index(self, row, column, parent=None, *args, **kwargs):
         if column == 0:
@@ -33,28 +87,41 @@ class PlayerNameCompletionModel(QAbstractItemModel):
     def parent(self, childIndex=None):
         return QModelIndex()
 
-    def playerStateChange(self, name, state):
-        if state == PlayerStates.QUIT and name in self._data:
-            self._data.remove(name)
-            self._filtered = self._data
-            self._rowcount = len(self._data)
-            # noinspection PyUnresolvedReferences
-            self.dataChanged.emit(self.createIndex(0, 0), self.createIndex(self._rowcount - 1, 0))
-        #if state == PlayerStates.AVAILABLE and name not in self._data:
-        elif name not in self._data:
-            self._data.append(name)
-            self._filtered = self._data
-            self._rowcount = len(self._data)
-            # noinspection PyUnresolvedReferences
-            self.dataChanged.emit(self.createIndex(0, 0), self.createIndex(self._rowcount - 1, 0))
+    def playerStatesChanged(self, changes):
+        self._pending.extend(changes)
 
     def playersLoaded(self):
-        self._data = CLI.commands.keys() + \
-                     [p for p in self.controller.available.keys()] + \
-                     [p for p, p2 in self.controller.playing.items()] + \
-                     [p for p in self.controller.awayfromkb.keys()]
-        self._filtered = self._data
-        self._rowcount = len(self._data)
+        self.rebuild(self.controller.available.keys() +
+                     self.controller.playing.keys() +
+                     self.controller.awayfromkb.keys())
+
+    def rebuild(self, players):
+        self._pending = []
+        self.beginResetModel()
+        self._names = set(players)
+        self._index = sorted((key, text) for text in CLI.commands.keys() + list(self._names)
+                             for key in self.keys(text))
+        self._select()
+        self.endResetModel()
+
+    def remove(self, name):
+        if name not in self._names:
+            return
+        self._names.discard(name)
+        for key in self.keys(name):
+            pos = bisect_left(self._index, (key, name))
+            if pos >= len(self._index) or self._index[pos] != (key, name):
+                continue
+            if key.startswith(self._prefix):
+                row = pos - self._first
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self._index[pos]
+                self._rowcount -= 1
+                self.endRemoveRows()
+            else:
+                del self._index[pos]
+                if key < self._prefix:
+                    self._first -= 1
 
     def rowCount(self, parent=None, *args, **kwargs):
         return self._rowcount
@@ -62,19 +129,22 @@ class PlayerNameCompletionModel(QAbstractItemModel):
     def setController(self, controller):
         self.controller = controller
         controller.sigPlayersLoaded.connect(self.playersLoaded)
-        controller.sigPlayerStateChange.connect(self.playerStateChange)
+        controller.sigPlayerStatesChanged.connect(self.playerStatesChanged)
 
     def setFilter(self, prefix):
-        self._prefix = prefix.lower()
-        self._filtered=[]
-        for x in self._data:
-            if x.lower().find(self._prefix, 0) == 0:
-                self._filtered.append(x)
-            if x.startswith("/") and x.lower().find(self._prefix, 0) == 1:
-                self._filtered.append(x)
-        self._rowcount = len(self._filtered)
-        # noinspection PyUnresolvedReferences
-        self.dataChanged.emit(self.createIndex(0, 0), self.createIndex(self._rowcount - 1, 0))
+        self.applyPendingChanges()
+        prefix = self.fold(prefix)
+        if prefix == self._prefix:
+            return
+        self.beginResetModel()
+        self._prefix = prefix
+        self._select()
+        self.endResetModel()
+
+    def _select(self):
+        # the keys starting with the prefix sort between the prefix and the prefix followed by the last code point
+        self._first = bisect_left(self._index, (self._prefix,))
+        self._rowcount = bisect_left(self._index, (self._prefix + u'\uffff',)) - self._first
 
 
 class PlayerNameCompleter(QCompleter):
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import cgi
 import logging
 import logging.handlers
 import os
@@ -14,17 +13,20 @@ import ggpo.common.sound
 from ggpo.common.geolookup import geolookupInit
 from ggpo.common.runtime import *
 from ggpo.common import copyright
+from ggpo.common.chatrenderer import ChatRenderer
 from ggpo.common.cliclient import CLI
 from ggpo.common.playerstate import PlayerStates
+from ggpo.common.protocol import Protocol
 from ggpo.common.settings import Settings
-from ggpo.common.util import logdebug, openURL, findURLs, nl2br, replaceURLs, replaceReplayID, findGamesavesDir, \
-    defaultdictinit, findFba
+from ggpo.common.util import logdebug, openURL, nl2br, replaceURLs, findGamesavesDir, defaultdictinit, findFba
 from ggpo.common.unsupportedsavestates import UnsupportedSavestates
 from ggpo.common.allgames import *
 from ggpo.gui.customemoticonsdialog import CustomEmoticonsDialog
 from ggpo.gui.emoticonsdialog import EmoticonDialog
 from ggpo.gui.playermodel import PlayerModel
+from ggpo.gui.refreshscheduler import RefreshScheduler
 from ggpo.gui.savestatesdialog import SavestatesDialog
+from ggpo.gui.stallmonitor import StallMonitor
 from ggpo.gui.ui.ggpowindow_ui import Ui_MainWindow
 from ggpo.common.extensions.extension import Extension
 
@@ -55,6 +57,18 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.addSplitterHandleToggleButton()
         self.uiChatHistoryTxtB.anchorClicked.connect(self.onAnchorClicked)
         self.autoAnnounceUnsupportedTime = 0
+        self.stallMonitor = None
+        if Settings.value(Settings.STALL_MONITOR):
+            # diagnostic for /stats, off unless stallMonitor is set in the ini file
+            self.stallMonitor = StallMonitor(self)
+            self.stallMonitor.start()
+        self.chatRenderer = ChatRenderer()
+        self.refresher = RefreshScheduler(self)
+        self.refresher.register('statusBar', self.updateStatusBar)
+        self.refresher.register('channelCount', self.updateChannelCount)
+        self.refresher.register('visiblePlayers', self.refreshVisiblePlayers)
+        self.refresher.register('listRequests', self.refreshLists)
+        self.refresher.register('completer', self.uiChatInputEdit.completer().model().applyPendingChanges)
         self.refreshChannelsListTime = time.time()
         self.refreshListUsersTime = time.time()
         self.savestatesChecked = False
@@ -92,7 +106,7 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
     def appendChat(self, text):
         if Settings.value(Settings.SHOW_TIMESTAMP_IN_CHAT):
             text = time.strftime("%H:%M ") + text
-        self.uiChatHistoryTxtB.append(text)
+        self.uiChatHistoryTxtB.post(text)
 
     @staticmethod
     def buildInSmoothingToActionName(smooth):
@@ -303,16 +317,11 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
         if name=="System" and "GAME: " in txt and not Settings.value(Settings.HIDE_INGAME_CHAT):
             txt = re.sub(r'<System> ', r'', txt)
         prefix = self.controller.getPlayerPrefix(name, Settings.value(Settings.SHOW_COUNTRY_FLAG_IN_CHAT))
-        if (self.controller.username+" ".lower() in txt.lower() or " "+self.controller.username.lower() in txt.lower() or txt.lower()==self.controller.username.lower()):
-            txt = cgi.escape(txt.strip()).replace(self.controller.username, "<b>{}</b>".format(self.controller.username))
+        self.chatRenderer.setUsername(self.controller.username)
+        html, mentioned = self.chatRenderer.render(txt.strip())
+        if mentioned:
             ggpo.common.sound.notify()
-        else:
-            txt = cgi.escape(txt.strip())
-        urls = findURLs(txt)
-        chat = prefix + txt
-        if urls:
-            chat = prefix + replaceURLs(txt)
-        self.appendChat(replaceReplayID(chat))
+        self.appendChat(prefix + html)
 
     def onChannelJoined(self):
         self.updateStatusBar()
@@ -440,27 +449,22 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
             QtCore.QTimer.singleShot(1000, lambda: self.controller.sendChat("* I'm playing {}".format(desc)))
             self.autoAnnounceUnsupportedTime = time.time()
 
-    def onPlayerStateChange(self, name, state):
+    def onPlayerStatesChanged(self, changes):
         if Settings.value(Settings.NOTIFY_PLAYER_STATE_CHANGE):
-            if state == PlayerStates.QUIT:
-                self.notifyStateChange(name, " left")
-            elif state == PlayerStates.AVAILABLE:
-                self.notifyStateChange(name, " becomes available")
-            elif state == PlayerStates.PLAYING:
-                self.notifyStateChange(name, " is in a game")
-            elif state == PlayerStates.AFK:
-                self.notifyStateChange(name, " is away")
-        self.updateStatusBar()
-
-        # refresh the channel list
-        sizes = self.uiSplitter.sizes()
-        if time.time() - self.refreshChannelsListTime > 300 and sizes[0] > 0:
-            self.refreshChannelsListTime = time.time()
-            self.controller.sendListChannels()
-
-        if time.time() - self.refreshListUsersTime > 120:
-            self.refreshListUsersTime = time.time()
-            self.controller.sendListUsers()
+            for name, state in changes:
+                if state == PlayerStates.QUIT:
+                    self.notifyStateChange(name, " left")
+                elif state == PlayerStates.AVAILABLE:
+                    self.notifyStateChange(name, " becomes available")
+                elif state == PlayerStates.PLAYING:
+                    self.notifyStateChange(name, " is in a game")
+                elif state == PlayerStates.AFK:
+                    self.notifyStateChange(name, " is away")
+        self.refresher.invalidate('statusBar', 'channelCount', 'visiblePlayers', 'listRequests', 'completer')
+
+    def onRequestTimedOut(self, seq, command):
+        if command in self.controller.LATENCY_STATS_COMMANDS:
+            self.appendChat(ColorTheme.statusHtml("Server did not answer {} request".format(Protocol.codeToString(command))))
 
     def onStatusMessage(self, msg):
         self.appendChat(ColorTheme.statusHtml(msg))
@@ -546,6 +550,10 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
         fontsetting = Settings.pythonValue(Settings.CHAT_HISTORY_FONT)
         if fontsetting:
             self.uiChatHistoryTxtB.setFont(QtGui.QFont(*fontsetting))
+        try:
+            self.uiChatHistoryTxtB.setMaxLines(int(Settings.value(Settings.CHAT_HISTORY_LINES)))
+        except (TypeError, ValueError):
+            pass
         self.restoreStateAndGeometry()
 
     def restoreStateAndGeometry(self):
@@ -568,6 +576,22 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
             self.uiChannelsTree.setColumnWidth(0,50)
             self.uiChannelsTree.setColumnWidth(1,300)
 
+    def refreshLists(self):
+        # refresh the channel list
+        sizes = self.uiSplitter.sizes()
+        if time.time() - self.refreshChannelsListTime > 300 and sizes[0] > 0:
+            self.refreshChannelsListTime = time.time()
+            self.controller.sendListChannels()
+
+        if time.time() - self.refreshListUsersTime > 120:
+            self.refreshListUsersTime = time.time()
+            self.controller.sendListUsers()
+
+    def refreshVisiblePlayers(self):
+        self.updateVisiblePlayers()
+        # pings and flags change in place, repaint what's on screen once
+        self.uiPlayersTableV.viewport().update()
+
     def returnPressed(self):
         line = self.uiChatInputEdit.text().strip()
         if line:
@@ -610,12 +634,13 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.setupUserTable()
         self.uiChatInputEdit.setController(controller)
         controller.sigChannelJoined.connect(self.onChannelJoined)
-        controller.sigPlayersLoaded.connect(self.updateStatusBar)
+        controller.sigPlayersLoaded.connect(lambda: self.refresher.invalidate('statusBar', 'channelCount'))
         controller.sigChannelsLoaded.connect(self.onListChannelsReceived)
         controller.sigMotdReceived.connect(self.onMOTDReceived)
         controller.sigActionFailed.connect(self.onActionFailed)
         controller.sigPlayerNewlyJoined.connect(self.onPlayerNewlyJoined)
-        controller.sigPlayerStateChange.connect(self.onPlayerStateChange)
+        controller.sigPlayerStatesChanged.connect(self.onPlayerStatesChanged)
+        controller.sigRequestTimedOut.connect(self.onRequestTimedOut)
         controller.sigChatReceived.connect(self.onChatReceived)
         controller.sigChallengeDeclined.connect(self.onChallengeDeclined)
         controller.sigChallengeReceived.connect(self.onChallengeReceived)
@@ -623,6 +648,9 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
         controller.sigIgnoreAdded.connect(self.ignoreAdded)
         controller.sigIgnoreRemoved.connect(self.ignoreRemoved)
         controller.sigStatusMessage.connect(self.onStatusMessage)
+        if self.stallMonitor:
+            controller.statsProviders.append(self.stallMonitor.stats)
+        controller.statsProviders.append(self.refresher.stats)
         controller.sigServerDisconnected.connect(
             lambda: self.onStatusMessage("Disconnected from server. Please restart application"))
 
@@ -740,7 +768,7 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.uiShowTimestampInChatAct.toggled.connect(self.__class__.toggleShowTimestampInChatAct)
         self.uiHideInGameChatAct.toggled.connect(self.__class__.toggleHideInGameChatAct)
         #self.uiDisableAutoAnnounceAct.toggled.connect(self.__class__.toggleDisableAutoAnnounceUnsupported)
-        self.uiDisableAutoColorNicks.toggled.connect(self.__class__.toggleDisableAutoColorNicks)
+        self.uiDisableAutoColorNicks.toggled.connect(self.toggleDisableAutoColorNicks)
         self.uiHideGamesWithoutRomAct.toggled.connect(self.toggleHideGamesWithoutRomAct)
         self.uiFilterFavoriteLobbies.toggled.connect(self.toggleFilterFavoriteLobbies)
         if Settings.value(Settings.DEBUG_LOG):
@@ -979,6 +1007,11 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.uiPlayersTableV.setSortingEnabled(True)
         self.uiPlayersTableV.sortByColumn(PlayerModel.DEFAULT_SORT, Qt.AscendingOrder)
         hh.sortIndicatorChanged.connect(self.sortIndicatorChanged)
+        # the rows on screen get their pings first
+        invalidate = lambda *args: self.refresher.invalidate('visiblePlayers')
+        self.uiPlayersTableV.verticalScrollBar().valueChanged.connect(invalidate)
+        model.modelReset.connect(invalidate)
+        model.layoutChanged.connect(invalidate)
 
     def sortIndicatorChanged(self, index, order):
         if index not in self.uiPlayersTableV.model().sortableColumns:
@@ -992,9 +1025,9 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
     def toggleDisableAutoAnnounceUnsupported(state):
         Settings.setBoolean(Settings.DISABLE_AUTO_ANNOUNCE_UNSUPPORTED, state)
 
-    @staticmethod
-    def toggleDisableAutoColorNicks(state):
+    def toggleDisableAutoColorNicks(self, state):
         Settings.setBoolean(Settings.DISABLE_AUTOCOLOR_NICKS, state)
+        self.controller.setDisableAutoColorNicks(state)
 
     @staticmethod
     def toggleNotifyPlayerStateChange(state):
@@ -1034,5 +1067,28 @@ class GGPOWindow(QtGui.QMainWindow, Ui_MainWindow):
     def toggleNotifySound(state):
         Settings.setBoolean(Settings.MUTE_NOTIFY_SOUND, state)
 
+    def updateChannelCount(self):
+        """ show the live user count of the current channel until the next channel list arrives """
+        root = self.uiChannelsTree.invisibleRootItem()
+        for i in range(root.childCount()):
+            item = root.child(i)
+            if self.channels.get(item.text(1)) == self.controller.channel:
+                item.setText(0, str(len(self.controller.playerStore)))
+                break
+
+    # noinspection PyUnusedLocal
+    def updateVisiblePlayers(self, *args):
+        view = self.uiPlayersTableV
+        model = view.model()
+        first = view.rowAt(0)
+        if first < 0:
+            self.controller.pingScheduler.setVisible(())
+            return
+        last = view.rowAt(view.viewport().height() - 1)
+        if last < 0:
+            last = model.rowCount() - 1
+        self.controller.pingScheduler.setVisible(
+            model.players[row][PlayerModel.PLAYER] for row in xrange(first, last + 1))
+
     def updateStatusBar(self):
         self.uiStatusbar.showMessage(self.controller.statusBarMessage())
@@ -79,8 +79,9 @@ class LoginDialog(QtGui.QDialog, Ui_DialogLogin):
             return -1
 
         self.controller.password = password
-        self.controller.sendWelcome()
-        self.controller.sendAuth(username, password)
+        with self.controller.coalescedSends():
+            self.controller.sendWelcome()
+            self.controller.sendAuth(username, password)
 
     def onLoginFailed(self):
         self.uiLoginBtn.setEnabled(True)
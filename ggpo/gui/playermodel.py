@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
-import operator
+from bisect import bisect_left
 
 from PyQt4 import QtCore, QtGui
 from PyQt4.QtCore import Qt
+from ggpo.common.playerstate import PlayerStates
 
 
 #noinspection PyClassHasNoInit
@@ -12,6 +13,29 @@ class PlayerModelState:
     AFK = 2
     NSTATES = 3
 
+    fromPlayerState = {
+        PlayerStates.AVAILABLE: AVAILABLE,
+        PlayerStates.PLAYING: PLAYING,
+        PlayerStates.AFK: AFK,
+    }
+
+
+class _Descending(object):
+    """ inverts the ordering of a sort key component so one ascending row index serves both orders """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
 
 class PlayerModel(QtCore.QAbstractTableModel):
     STATE = 0
@@ -38,15 +62,18 @@ class PlayerModel(QtCore.QAbstractTableModel):
         self.controller = controller
         # [state, player, ping, opponent, ignored, country, opponent_country]
         self.players = []
+        # sort key of every row, kept sorted in step with self.players
+        self.keys = []
+        self.keyOf = {}
         self.lastSort = PlayerModel.DEFAULT_SORT
         self.lastSortOrder = QtCore.Qt.AscendingOrder
-        controller.sigPlayerStateChange.connect(self.reloadPlayers)
+        controller.sigPlayerPingChanged.connect(self.onPlayerPingChanged)
+        controller.sigPlayerStatesChanged.connect(self.onPlayerStatesChanged)
         controller.sigPlayersLoaded.connect(self.reloadPlayers)
-        # TODO: optimize to only update challenge column?
-        controller.sigChallengeDeclined.connect(self.reloadPlayers)
-        # This is very heavy-handed for handling the CLI add/remove changes
-        controller.sigIgnoreAdded.connect(self.reloadPlayers)
-        controller.sigIgnoreRemoved.connect(self.reloadPlayers)
+        controller.sigPlayersGeoResolved.connect(self.onPlayersGeoResolved)
+        controller.sigChallengeDeclined.connect(self.refreshStateColumn)
+        controller.sigIgnoreAdded.connect(lambda name: self.setIgnored(name, Qt.Checked))
+        controller.sigIgnoreRemoved.connect(lambda name: self.setIgnored(name, Qt.Unchecked))
 
     # noinspection PyMethodMayBeStatic
     def columnCount(self, QModelIndex_parent=None, *args, **kwargs):
@@ -60,7 +87,15 @@ class PlayerModel(QtCore.QAbstractTableModel):
         col = modelIndex.column()
 
         if role == Qt.DisplayRole:
-            if col in [PlayerModel.PLAYER, PlayerModel.PING, PlayerModel.SPECTATORS, PlayerModel.OPPONENT]:
+            if col == PlayerModel.PING:
+                # pings are updated in place by the controller, rows only keep the value they were sorted with
+                name = self.players[row][PlayerModel.PLAYER]
+                ping = self.getPlayerStat(name, 'ping')
+                rtt = self.getPlayerStat(name, 'rtt')
+                if ping != '' and not (rtt and rtt.count):
+                    return '~{}'.format(ping)
+                return ping
+            if col in [PlayerModel.PLAYER, PlayerModel.SPECTATORS, PlayerModel.OPPONENT]:
                 return self.players[row][col]
         elif role == Qt.ToolTipRole and col==PlayerModel.STATE:
             val = self.players[row][col]
@@ -77,6 +112,16 @@ class PlayerModel(QtCore.QAbstractTableModel):
                     return self.controller.players[name].country + ', ' + self.controller.players[name].city
                 else:
                     return self.controller.players[name].country
+        elif role == Qt.ToolTipRole and col == PlayerModel.PING:
+            rtt = self.getPlayerStat(self.players[row][PlayerModel.PLAYER], 'rtt')
+            if rtt:
+                tip = []
+                if rtt.count:
+                    tip.append('min {}ms, jitter {:.0f}ms'.format(rtt.minimum(), rtt.jitter))
+                tip.append('{:.0%} of the last {} pings lost'.format(rtt.loss(), rtt.probes))
+                return ', '.join(tip)
+            elif self.getPlayerStat(self.players[row][PlayerModel.PLAYER], 'ping') != '':
+                return 'Estimated from an earlier session'
         elif role == Qt.CheckStateRole and col == PlayerModel.IGNORE:
             return self.players[row][col]
         elif role == Qt.DecorationRole:
@@ -177,42 +222,155 @@ class PlayerModel(QtCore.QAbstractTableModel):
                 self.dataChanged.emit(idx1, idx2)
         if col == PlayerModel.PING:
             name=self.players[row][col-1]
-            self.controller.sendPingQuery(self.controller.players[name])
+            self.controller.pingScheduler.interacted(name)
             idx1 = self.createIndex(0, PlayerModel.PING)
             idx2 = self.createIndex(len(self.players) - 1, PlayerModel.PING)
             self.dataChanged.emit(idx1, idx2)
 
+    def buildRow(self, p, state):
+        ignored = (p in self.controller.ignored) and Qt.Checked or Qt.Unchecked
+        if state == PlayerModelState.PLAYING:
+            p2 = self.controller.playing.get(p, '')
+            return [state, p, self.getPlayerStat(p, 'ping'), p2, self.getPlayerStat(p, 'spectators'), ignored,
+                    self.getPlayerStat(p, 'cc'), self.getPlayerStat(p2, 'cc'), self.getPlayerStat(p, 'color')]
+        return [state, p, self.getPlayerStat(p, 'ping'), '', '', ignored,
+                self.getPlayerStat(p, 'cc'), '', self.getPlayerStat(p, 'color')]
+
+    def findRow(self, name):
+        key = self.keyOf.get(name)
+        if key is None:
+            return -1
+        return bisect_left(self.keys, key)
+
+    def onPlayersGeoResolved(self, names):
+        """ refresh the flags of the rows of the located players and of their opponents """
+        rows = set()
+        for name in names:
+            row = self.findRow(name)
+            if row < 0:
+                continue
+            r = self.players[row]
+            r[PlayerModel.COUNTRY] = self.getPlayerStat(name, 'cc')
+            rows.add(row)
+            # opponents play each other, the opponent's row shows this player
+            opponentRow = self.findRow(r[PlayerModel.OPPONENT]) if r[PlayerModel.OPPONENT] else -1
+            if opponentRow >= 0 and self.players[opponentRow][PlayerModel.OPPONENT] == name:
+                self.players[opponentRow][PlayerModel.OPPONENT_COUNTRY] = r[PlayerModel.COUNTRY]
+                rows.add(opponentRow)
+        # one dataChanged per run of adjacent rows
+        first = last = None
+        for row in sorted(rows) + [None]:
+            if first is not None and row == last + 1:
+                last = row
+                continue
+            if first is not None:
+                # noinspection PyUnresolvedReferences
+                self.dataChanged.emit(self.createIndex(first, PlayerModel.PLAYER),
+                                      self.createIndex(last, PlayerModel.OPPONENT))
+            first = last = row
+
+    def onPlayerPingChanged(self, name):
+        row = self.findRow(name)
+        if row < 0:
+            return
+        r = self.players[row]
+        if self.lastSort == PlayerModel.PING and r[PlayerModel.PING] != self.getPlayerStat(name, 'ping'):
+            # the row is sorted by the ping it was built with, move it to where the new one belongs
+            self.updatePlayer(name, r[PlayerModel.STATE])
+        else:
+            idx = self.createIndex(row, PlayerModel.PING)
+            # noinspection PyUnresolvedReferences
+            self.dataChanged.emit(idx, idx)
+
+    def onPlayerStatesChanged(self, changes):
+        for name, state in changes:
+            state = PlayerModelState.fromPlayerState.get(state)
+            if state is None:
+                self.removePlayer(name)
+            else:
+                self.updatePlayer(name, state)
+
+    def refreshStateColumn(self, *args):
+        if self.players:
+            # noinspection PyUnresolvedReferences
+            self.dataChanged.emit(self.createIndex(0, PlayerModel.STATE),
+                                  self.createIndex(len(self.players) - 1, PlayerModel.STATE))
+
     # noinspection PyUnusedLocal
     def reloadPlayers(self, *args):
+        self.beginResetModel()
         self.players = []
         for p in self.controller.available.keys():
-            ignored = (p in self.controller.ignored) and Qt.Checked or Qt.Unchecked
-            self.players.append([PlayerModelState.AVAILABLE,
-                                 p, self.getPlayerStat(p, 'ping'),
-                                 '', '', ignored,
-                                 self.getPlayerStat(p, 'cc'), '',
-                                 self.getPlayerStat(p, 'color')])
-        for p, p2 in self.controller.playing.items():
-            ignored = (p in self.controller.ignored) and Qt.Checked or Qt.Unchecked
-            self.players.append([PlayerModelState.PLAYING,
-                                 p, self.getPlayerStat(p, 'ping'),
-                                 p2,
-                                 self.getPlayerStat(p, 'spectators'),
-                                 ignored,
-                                 self.getPlayerStat(p, 'cc'),
-                                 self.getPlayerStat(p2, 'cc'),
-                                 self.getPlayerStat(p, 'color')])
+            self.players.append(self.buildRow(p, PlayerModelState.AVAILABLE))
+        for p in self.controller.playing.keys():
+            self.players.append(self.buildRow(p, PlayerModelState.PLAYING))
         for p in self.controller.awayfromkb.keys():
-            ignored = (p in self.controller.ignored) and Qt.Checked or Qt.Unchecked
-            self.players.append([PlayerModelState.AFK,
-                                 p, self.getPlayerStat(p, 'ping'),
-                                 '', '', ignored,
-                                 self.getPlayerStat(p, 'cc'), '',
-                                 self.getPlayerStat(p, 'color')])
-        self.sort(self.lastSort, self.lastSortOrder)
-        # idx1 = self.createIndex(0, 0)
-        # idx2 = self.createIndex(len(self.players) - 1, PlayerModel.N_DISPLAY_COLS-1)
-        # self.dataChanged.emit(idx1, idx2)
+            self.players.append(self.buildRow(p, PlayerModelState.AFK))
+        self.sortRows()
+        self.endResetModel()
+
+    def removePlayer(self, name):
+        row = self.findRow(name)
+        if row < 0:
+            return
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        del self.players[row]
+        del self.keys[row]
+        del self.keyOf[name]
+        self.endRemoveRows()
+
+    def rowKey(self, row):
+        value = row[self.lastSort]
+        if self.lastSort in [PlayerModel.PLAYER, PlayerModel.OPPONENT]:
+            value = value.lower()
+        if self.lastSortOrder == QtCore.Qt.DescendingOrder:
+            value = _Descending(value)
+        # the name makes every key unique, rows can be found again by bisecting for their key
+        return row[PlayerModel.STATE], value, row[PlayerModel.PLAYER]
+
+    def setIgnored(self, name, value):
+        row = self.findRow(name)
+        if row >= 0 and self.players[row][PlayerModel.IGNORE] != value:
+            self.players[row][PlayerModel.IGNORE] = value
+            idx = self.createIndex(row, PlayerModel.IGNORE)
+            # noinspection PyUnresolvedReferences
+            self.dataChanged.emit(idx, idx)
+
+    def sortRows(self):
+        self.keys = [self.rowKey(row) for row in self.players]
+        order = sorted(xrange(len(self.players)), key=self.keys.__getitem__)
+        self.players = [self.players[i] for i in order]
+        self.keys = [self.keys[i] for i in order]
+        self.keyOf = dict((row[PlayerModel.PLAYER], key) for row, key in zip(self.players, self.keys))
+
+    def updatePlayer(self, name, state):
+        """ insert, move or refresh the row of a player whose state or details changed """
+        newRow = self.buildRow(name, state)
+        newKey = self.rowKey(newRow)
+        row = self.findRow(name)
+        if row < 0:
+            dest = bisect_left(self.keys, newKey)
+            self.beginInsertRows(QtCore.QModelIndex(), dest, dest)
+            self.players.insert(dest, newRow)
+            self.keys.insert(dest, newKey)
+            self.keyOf[name] = newKey
+            self.endInsertRows()
+            return
+        # position once the old row is gone, beginMoveRows wants it in terms of the list before the move
+        dest = bisect_left(self.keys, newKey)
+        moveTo = dest
+        if dest > row:
+            dest -= 1
+        moved = dest != row and self.beginMoveRows(QtCore.QModelIndex(), row, row, QtCore.QModelIndex(), moveTo)
+        del self.players[row]
+        del self.keys[row]
+        self.players.insert(dest, newRow)
+        self.keys.insert(dest, newKey)
+        self.keyOf[name] = newKey
+        if moved:
+            self.endMoveRows()
+        # noinspection PyUnresolvedReferences
+        self.dataChanged.emit(self.createIndex(dest, 0), self.createIndex(dest, PlayerModel.N_DISPLAY_COLS - 1))
 
     def rowCount(self, QModelIndex_parent=None, *args, **kwargs):
         return len(self.players)
@@ -233,17 +391,8 @@ class PlayerModel(QtCore.QAbstractTableModel):
 
     def sort(self, col, order=None):
         if col in PlayerModel.sortableColumns:
-            reverse = False
-            if order == QtCore.Qt.DescendingOrder:
-                reverse = True
             self.lastSort = col
             self.lastSortOrder = order
-            getter = operator.itemgetter(col)
-            if col in [PlayerModel.PLAYER, PlayerModel.OPPONENT]:
-                keyfunc = lambda x: getter(x).lower()
-            else:
-                keyfunc = getter
             self.emit(QtCore.SIGNAL("layoutAboutToBeChanged()"))
-            self.players = sorted(self.players, key=keyfunc, reverse=reverse)
-            self.players = sorted(self.players, key=operator.itemgetter(PlayerModel.STATE))
+            self.sortRows()
             self.emit(QtCore.SIGNAL("layoutChanged()"))
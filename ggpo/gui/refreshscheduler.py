@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import time
+from PyQt4 import QtCore
+
+
+class RefreshScheduler(QtCore.QObject):
+    """
+    Coalesces widget refreshes to at most MAX_RATE per second.
+
+    Widgets register a callback under a name and controller signal handlers
+    call invalidate(name) instead of redrawing.  The first invalidation
+    starts a single shot timer, later ones only set the dirty flag, and the
+    timer runs every dirty callback once.  A burst of hundreds of state
+    changes therefore costs one status bar update and one repaint.
+    """
+
+    MAX_RATE = 10
+
+    def __init__(self, parent=None):
+        super(RefreshScheduler, self).__init__(parent)
+        self.targets = {}
+        self.dirty = set()
+        self.lastFlush = 0
+        self.invalidations = 0
+        self.flushes = 0
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+    def flush(self):
+        self.lastFlush = time.time()
+        self.flushes += 1
+        dirty, self.dirty = self.dirty, set()
+        for name in dirty:
+            self.targets[name]()
+
+    def invalidate(self, *names):
+        self.invalidations += 1
+        self.dirty.update(names)
+        if not self.timer.isActive():
+            wait = self.lastFlush + 1.0 / self.MAX_RATE - time.time()
+            self.timer.start(max(0, int(wait * 1000)))
+
+    def register(self, name, callback):
+        self.targets[name] = callback
+
+    def stats(self):
+        return ["gui refreshes: {} invalidations, {} flushes".format(self.invalidations, self.flushes)]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import deque
+from PyQt4 import QtCore
+
+
+class StallMonitor(QtCore.QObject):
+    """
+    Measures how late a short repeating timer fires on the gui thread.
+
+    Lateness is the time the event loop spent on something else, like
+    reloading the player list or rendering chat, while input and paint events
+    waited.  The last SAMPLES measurements are kept for percentiles.
+    """
+
+    INTERVAL = 50
+    SAMPLES = 1200
+    STALL = 0.1
+
+    def __init__(self, parent=None):
+        super(StallMonitor, self).__init__(parent)
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(self.INTERVAL)
+        self.timer.timeout.connect(self.onTimeout)
+        self.samples = deque(maxlen=self.SAMPLES)
+        self.expected = 0
+        self.stalls = 0
+        self.worst = 0
+
+    def onTimeout(self):
+        now = time.time()
+        late = max(0, now - self.expected)
+        self.samples.append(late)
+        if late >= self.STALL:
+            self.stalls += 1
+        self.worst = max(self.worst, late)
+        self.expected = now + self.INTERVAL / 1000.0
+
+    def start(self):
+        self.expected = time.time() + self.INTERVAL / 1000.0
+        self.timer.start()
+
+    def stats(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return ["gui event loop: no samples"]
+        last = len(samples) - 1
+        p50, p99 = samples[last // 2], samples[int(last * 0.99)]
+        return ["gui event loop lateness p50 {:.0f}ms p99 {:.0f}ms worst {:.0f}ms, {} stalls over {:.0f}ms".format(
+            p50 * 1000, p99 * 1000, self.worst * 1000, self.stalls, self.STALL * 1000)]
@@ -323,11 +323,8 @@ class Ui_MainWindow(object):
         self.horizontalLayout_10.addWidget(self.uiTmBtnMod)
         self.verticalLayout_13.addWidget(self.uiTmBracketFrm)
         self.verticalLayout.addWidget(self.uiTmPanel)
-        self.uiChatHistoryTxtB = QtGui.QTextBrowser(self.layoutWidget)
+        self.uiChatHistoryTxtB = ChatHistoryView(self.layoutWidget)
         self.uiChatHistoryTxtB.setAcceptDrops(False)
-        self.uiChatHistoryTxtB.setReadOnly(True)
-        self.uiChatHistoryTxtB.setOpenExternalLinks(False)
-        self.uiChatHistoryTxtB.setOpenLinks(False)
         self.uiChatHistoryTxtB.setObjectName(_fromUtf8("uiChatHistoryTxtB"))
         self.verticalLayout.addWidget(self.uiChatHistoryTxtB)
         self.horizontalLayout = QtGui.QHBoxLayout()
@@ -817,4 +814,5 @@ class Ui_MainWindow(object):
         self.actionReport_an_issue.setText(_translate("MainWindow", "Report an issue", None))
         self.uiHideInGameChatAct.setText(_translate("MainWindow", "Hide in-game Chat on Lobby", None))
 
+from ggpo.gui.chathistory import ChatHistoryView
 from ggpo.gui.completionlineedit import CompletionLineEdit
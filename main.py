@@ -42,6 +42,13 @@ def main(argv=None):
     thread.started.connect(controller.selectLoop)
     thread.start()
 
+    def shutdown():
+        controller.stop()
+        thread.quit()
+        thread.wait(2000)
+
+    QtCore.QCoreApplication.instance().aboutToQuit.connect(shutdown)
+
     def loggedIn():
         if started==False:
             window = GGPOWindow()
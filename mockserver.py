@@ -0,0 +1,387 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# Stand-in lobby server for load and latency testing, no network access needed.
+#
+#   python2 mockserver.py [--profile churn] [--port 7000] [--users N] [--changes N] [--chat N]
+#
+# Point the client at it by setting serverHost=127.0.0.1 (and port=7000) in
+# ~/ggpo-ng.ini, any username/password logs in.  Channel i is served on
+# --port + i, so joining a game channel from the lobby switches connections
+# the way the real server does.  Every --report seconds the
+# server prints how far behind each client is in reading what it was sent.
+#
+
+import argparse
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from SocketServer import ThreadingTCPServer, BaseRequestHandler
+
+from ggpo.common.framedecoder import FrameDecoder
+from ggpo.common.protocol import Protocol
+
+try:
+    import fcntl
+    import termios
+    _TIOCOUTQ = getattr(termios, 'TIOCOUTQ', None)
+except ImportError:
+    fcntl = None
+    _TIOCOUTQ = None
+
+(AVAILABLE, AFK, PLAYING) = range(3)
+
+PROFILES = {
+    # users in the lobby, state changes per second, chat lines per second
+    'idle': dict(users=50, changes=0, chat=0),
+    'lobby5k': dict(users=5000, changes=0, chat=0),
+    'churn': dict(users=5000, changes=200, chat=2),
+    'chatflood': dict(users=500, changes=5, chat=100),
+    'stress': dict(users=5000, changes=200, chat=100),
+}
+
+CHANNELS = [
+    ('lobby', 'lobby', 'FightCade Lobby'),
+    ('sfiii3n', 'sfiii3n', 'Street Fighter III 3rd Strike'),
+    ('ssf2t', 'ssf2t', 'Super Street Fighter II Turbo'),
+    ('kof98', 'kof98', 'The King of Fighters 98'),
+]
+
+CITIES = [('Tokyo', 'JP', 'Japan'), ('Madrid', 'ES', 'Spain'), ('Sao Paulo', 'BR', 'Brazil'),
+          ('Chicago', 'US', 'United States'), ('Paris', 'FR', 'France'), ('Seoul', 'KR', 'Korea, Republic of')]
+
+CHAT_LINES = [
+    'gg', 'anyone up for ft5?', 'lag on my end, sorry', 'watch http://www.fightcade.com/replay/{} pls',
+    '@{} rematch?', 'that parry was insane', 'https://www.youtube.com/watch?v=abc123 good tutorial',
+]
+
+TICK = 0.05
+
+
+def frame(seq, payload):
+    return struct.pack('!II', len(payload) + 4, seq) + payload
+
+
+class Lobby(object):
+    """ the simulated channel population, changed by the load generator """
+
+    def __init__(self, users, seed=1):
+        self.lock = threading.Lock()
+        self.rnd = random.Random(seed)
+        self.users = {}
+        self.serial = 0
+        for _ in xrange(users):
+            self.join()
+
+    def join(self):
+        self.serial += 1
+        name = 'mock{}'.format(self.serial)
+        city, cc, country = self.rnd.choice(CITIES)
+        self.users[name] = dict(state=AVAILABLE, opponent='', ip='192.0.2.{}'.format(self.serial % 254 + 1),
+                                city=city, cc=cc, country=country, color=self.rnd.randint(0, 0xffffff),
+                                spectators=0)
+        return name
+
+    def stateEntry(self, name):
+        u = self.users.get(name)
+        if u is None:
+            return Protocol.encode('STATE_CHANGE_HEADER', 0, name)
+        return Protocol.encode('STATE_CHANGE_HEADER', 1, name) + \
+            Protocol.encode('STATE_CHANGE', u['state'], u['opponent'], u['ip'], 0, 0, u['city'], u['cc'],
+                            u['country'], 6009, u['color'])
+
+    def userRecord(self, name):
+        u = self.users[name]
+        return Protocol.encode('USER', name, u['state'], u['opponent'], u['ip'], 0, 0, u['city'], u['cc'],
+                               u['country'], 6009, u['color'], u['spectators'])
+
+    def listUsers(self):
+        with self.lock:
+            return Protocol.encode('LIST_USERS', 0, 0) + ''.join(self.userRecord(n) for n in self.users)
+
+    def randomChanges(self, count):
+        """ @return: list of encoded state change entries """
+        entries = []
+        with self.lock:
+            names = self.users.keys()
+            for _ in xrange(count):
+                roll = self.rnd.random()
+                if roll < 0.05 and names:
+                    name = self.rnd.choice(names)
+                    if name in self.users:
+                        del self.users[name]
+                elif roll < 0.10 or not names:
+                    name = self.join()
+                else:
+                    name = self.rnd.choice(names)
+                    u = self.users.get(name)
+                    if u is None:
+                        continue
+                    u['state'] = self.rnd.choice([AVAILABLE, AFK, PLAYING])
+                    u['opponent'] = self.rnd.choice(names) if u['state'] == PLAYING else ''
+                entries.append(self.stateEntry(name))
+        return entries
+
+    def randomName(self):
+        with self.lock:
+            return self.rnd.choice(self.users.keys()) if self.users else 'mock0'
+
+
+class Session(object):
+    """ one connected client, written to by its own thread so a slow reader only delays itself """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.username = ''
+        self.joined = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.outbound = deque()
+        self.backlog = 0
+        self.maxBacklog = 0
+        self.offered = 0
+        self.offeredFrames = 0
+        self.blocked = 0.0
+        self.writer = threading.Thread(target=self.writeLoop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def kernelBacklog(self):
+        """ bytes sent but not yet acknowledged by the client, None where unsupported """
+        if fcntl is None or _TIOCOUTQ is None:
+            return None
+        # noinspection PyBroadException
+        try:
+            return struct.unpack('i', fcntl.ioctl(self.sock.fileno(), _TIOCOUTQ, '\0\0\0\0'))[0]
+        except:
+            return None
+
+    def send(self, data, frames=1):
+        with self.cond:
+            if self.closed:
+                return
+            self.outbound.append(data)
+            self.backlog += len(data)
+            self.maxBacklog = max(self.maxBacklog, self.backlog)
+            self.offered += len(data)
+            self.offeredFrames += frames
+            self.cond.notify()
+
+    def writeLoop(self):
+        while True:
+            with self.cond:
+                while not self.outbound and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                data = ''.join(self.outbound)
+                self.outbound.clear()
+            t0 = time.time()
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                self.close()
+                return
+            with self.cond:
+                self.blocked += time.time() - t0
+                self.backlog -= len(data)
+
+
+class ChannelServer(ThreadingTCPServer):
+    """ listener for the port of one more channel, sessions share the MockServer's lobby """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, mock):
+        ThreadingTCPServer.__init__(self, address, LobbyHandler)
+        self.mock = mock
+
+
+class MockServer(ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, args):
+        ThreadingTCPServer.__init__(self, address, LobbyHandler)
+        self.mock = self
+        self.args = args
+        self.port = address[1]
+        self.channelServers = [ChannelServer((address[0], self.channelPort(i)), self)
+                               for i in xrange(1, len(CHANNELS))]
+        t0 = time.time()
+        self.lobby = Lobby(args.users)
+        print 'lobby of {} users ready in {:.0f} ms'.format(args.users, (time.time() - t0) * 1000)
+        self.sessions = []
+        self.sessionsLock = threading.Lock()
+
+    def broadcast(self, data, frames=1):
+        with self.sessionsLock:
+            sessions = [s for s in self.sessions if s.joined and not s.closed]
+        for s in sessions:
+            s.send(data, frames)
+
+    def channelPort(self, index):
+        return self.port + index
+
+    def addSession(self, session):
+        with self.sessionsLock:
+            self.sessions.append(session)
+
+    def removeSession(self, session):
+        session.close()
+        with self.sessionsLock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def generateLoad(self):
+        """ push state changes and chat to every joined client at the configured rates """
+        args = self.args
+        changeCredit = chatCredit = 0.0
+        nextTick = time.time()
+        while True:
+            nextTick += TICK
+            delay = nextTick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            changeCredit += args.changes * TICK
+            chatCredit += args.chat * TICK
+            count = int(changeCredit)
+            changeCredit -= count
+            if count:
+                entries = self.lobby.randomChanges(count)
+                frames = []
+                for i in xrange(0, len(entries), args.batch):
+                    batch = entries[i:i + args.batch]
+                    frames.append(frame(Protocol.PLAYER_STATE_CHANGE,
+                                        Protocol.encode('PLAYER_STATE_CHANGE', len(batch)) + ''.join(batch)))
+                self.broadcast(''.join(frames), len(frames))
+            lines = int(chatCredit)
+            chatCredit -= lines
+            if lines:
+                frames = []
+                for _ in xrange(lines):
+                    line = random.choice(CHAT_LINES).format(random.choice(['1-a2b3c4', self.lobby.randomName()]))
+                    frames.append(frame(Protocol.CHAT_DATA, Protocol.encode('CHAT_DATA', self.lobby.randomName(), line)))
+                self.broadcast(''.join(frames), len(frames))
+
+    def report(self):
+        last = {}
+        while True:
+            time.sleep(self.args.report)
+            with self.sessionsLock:
+                sessions = list(self.sessions)
+            for s in sessions:
+                offered, frames, blocked = last.get(s, (0, 0, 0.0))
+                kernel = s.kernelBacklog()
+                print '{:<16} {:>7.0f} frames/s {:>8.1f} KB/s  backlog {:>8.1f} KB{}  max {:>8.1f} KB  ' \
+                      'writer blocked {:>3.0f}%'.format(
+                          s.username or s.address[0],
+                          (s.offeredFrames - frames) / self.args.report,
+                          (s.offered - offered) / 1024.0 / self.args.report,
+                          s.backlog / 1024.0,
+                          '' if kernel is None else ' (+{:.1f} KB unacked)'.format(kernel / 1024.0),
+                          s.maxBacklog / 1024.0,
+                          (s.blocked - blocked) * 100 / self.args.report)
+                last[s] = (s.offered, s.offeredFrames, s.blocked)
+            sys.stdout.flush()
+
+    def start(self):
+        for target in [self.generateLoad, self.report] + [s.serve_forever for s in self.channelServers]:
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+        self.serve_forever()
+
+
+class LobbyHandler(BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.session = Session(self.request, self.client_address)
+        self.server.mock.addSession(self.session)
+
+    def finish(self):
+        self.server.mock.removeSession(self.session)
+
+    def handle(self):
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = self.request.recv(16384)
+            except socket.error:
+                return
+            if not data:
+                return
+            for seq, payload in decoder.feed(data):
+                if len(payload) >= 4:
+                    command, = struct.unpack('!I', payload[:4])
+                    self.dispatch(seq, command, payload[4:])
+
+    def reply(self, seq, payload=Protocol.packInt(0)):
+        self.session.send(frame(seq, payload))
+
+    def dispatch(self, seq, command, body):
+        server = self.server.mock
+        if command == Protocol.AUTH:
+            self.session.username = Protocol.decode('AUTH', body)[0]
+            print '{} logged in from {}'.format(self.session.username, self.client_address[0])
+            self.reply(seq)
+        elif command == Protocol.MOTD:
+            self.reply(seq, Protocol.encode('MOTD', 0, 'lobby', 'mock server',
+                                            'Load profile: {}'.format(server.args.describe)))
+        elif command == Protocol.LIST_CHANNELS:
+            self.reply(seq, Protocol.encode('LIST_CHANNELS', 0, 0) + ''.join(
+                Protocol.encode('CHANNEL', room, rom, title, len(server.lobby.users), server.channelPort(i), i)
+                for i, (room, rom, title) in enumerate(CHANNELS)))
+        elif command == Protocol.LIST_USERS:
+            self.reply(seq, server.lobby.listUsers())
+        elif command == Protocol.JOIN_CHANNEL:
+            self.reply(seq)
+            self.session.send(frame(Protocol.JOINING_A_CHANNEL, ''))
+            self.session.joined = True
+        elif command == Protocol.CHAT:
+            self.reply(seq)
+            msg = Protocol.PacketReader(body).readTLV()
+            server.broadcast(frame(Protocol.CHAT_DATA, Protocol.encode('CHAT_DATA', self.session.username, msg)))
+        elif command == Protocol.SEND_CHALLENGE:
+            self.reply(seq)
+            name = Protocol.PacketReader(body).readTLV()
+            # nobody behind the mock users, decline after a moment
+            threading.Timer(1, lambda: self.session.send(
+                frame(Protocol.CHALLENGE_DECLINED, Protocol.encode('CHALLENGE_DECLINED', name)))).start()
+        else:
+            # WELCOME, TOGGLE_AFK, ACCEPT/DECLINE/CANCEL_CHALLENGE, SPECTATE, EXTENSION_OUTBOUND ...
+            self.reply(seq)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='stand-in lobby server for load testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7000)
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='idle', help='load profile')
+    parser.add_argument('--users', type=int, help='lobby size, overrides the profile')
+    parser.add_argument('--changes', type=float, help='player state changes per second, overrides the profile')
+    parser.add_argument('--chat', type=float, help='chat lines per second, overrides the profile')
+    parser.add_argument('--batch', type=int, default=20, help='state changes per PLAYER_STATE_CHANGE frame')
+    parser.add_argument('--report', type=float, default=5, help='seconds between drain reports')
+    args = parser.parse_args(argv[1:])
+    for k, v in PROFILES[args.profile].items():
+        if getattr(args, k) is None:
+            setattr(args, k, v)
+    args.describe = '{} ({} users, {} changes/s, {} chat/s)'.format(args.profile, args.users, args.changes, args.chat)
+    print 'listening on {}:{}-{}, {}'.format(args.host, args.port, args.port + len(CHANNELS) - 1, args.describe)
+    MockServer((args.host, args.port), args).start()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+from ggpo.common.eventloop import EventLoop
+
+
+class WakeupDuringDrain(object):
+    """ wakeup socket reader that runs onRecv while the loop is draining it """
+
+    def __init__(self, sock, onRecv):
+        self.sock = sock
+        self.onRecv = onRecv
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, size):
+        if self.onRecv:
+            onRecv, self.onRecv = self.onRecv, None
+            onRecv()
+        return self.sock.recv(size)
+
+
+class EventLoopWakeupTest(unittest.TestCase):
+    TIMEOUT = 5
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.thread = None
+
+    def tearDown(self):
+        self.loop.stop()
+        if self.thread:
+            self.thread.join(self.TIMEOUT)
+
+    def startLoop(self):
+        self.thread = threading.Thread(target=self.loop.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def testWakeupWhileDrainingRunsCallbackInSamePass(self):
+        ran = []
+        self.loop.wakeupReader = WakeupDuringDrain(
+            self.loop.wakeupReader, lambda: self.loop.callSoon(ran.append, 'during drain'))
+        self.loop.callSoon(ran.append, 'first')
+        self.loop.runOnce()
+        self.assertEqual(ran, ['first', 'during drain'])
+        self.assertFalse(self.loop.wakeupPending)
+
+        # the next wakeup must reach a loop blocked without timers
+        done = threading.Event()
+        self.startLoop()
+        self.loop.callSoon(done.set)
+        self.assertTrue(done.wait(self.TIMEOUT))
+
+    def testEveryCallbackRunsWhileOtherThreadsWakeTheLoop(self):
+        passes = []
+        poll = self.loop.poller.poll
+
+        def countingPoll(timeout):
+            passes.append(timeout)
+            return poll(timeout)
+
+        self.loop.poller.poll = countingPoll
+        self.startLoop()
+
+        def producer():
+            for _ in xrange(500):
+                self.loop.wakeup()
+
+        producers = [threading.Thread(target=producer) for _ in xrange(4)]
+        for t in producers:
+            t.start()
+        # no timers are registered, a lost wakeup leaves the loop blocked and done unset
+        for i in xrange(500):
+            done = threading.Event()
+            self.loop.callSoon(done.set)
+            self.assertTrue(done.wait(self.TIMEOUT), 'callback {} never ran'.format(i))
+        for t in producers:
+            t.join(self.TIMEOUT)
+        done = threading.Event()
+        before = len(passes)
+        self.loop.callSoon(done.set)
+        self.assertTrue(done.wait(self.TIMEOUT))
+        # a single select pass picks it up, two at most if the loop was just past the poll
+        self.assertLessEqual(len(passes) - before, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()